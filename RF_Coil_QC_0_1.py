@@ -19,6 +19,11 @@ images so all the DICOMs selected should be acquired with the phantom in the sam
 The thresholds should be adjusted until the displayed mask covers the entirity of the phantom.
 To produce the phantom mask the accepted mask is contracted by 4 pixels and to 
 produce the in air mask the accepted mask is inverted and contracted by 5 pixels.
+Accepted masks are stored for each scanner, coil and image matrix.  On the next
+analysis the stored mask is re-aligned to the new combined image and reused
+without asking the user if it still fits the phantom.
+Otherwise masks are produced for a grid of thresholds around the coil defaults
+and the best is accepted automatically: the user is only asked if its score is low.
 
 SNR is calculated via 3 methods: the NEMA subtraction method which requires 
 two identically acquired images and two methods which only require a sinle image. 
@@ -51,35 +56,812 @@ Tables and Graphs require baseline values for each parameter to be established i
 
 import pydicom
 from pydicom.tag import Tag
+from pydicom.fileset import FileSet
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
 import os
+import argparse
+import fnmatch
 import shutil
+import sqlite3
+import tempfile
+import zipfile
+import tarfile
+import time
+import datetime
+import threading
+import queue
+import glob
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import tkinter as tk
 import numpy as np
 from matplotlib import pyplot as plt
 from PIL import ImageTk,Image
 from tkinter import filedialog, messagebox
 import skimage.segmentation as seg
+from scipy import stats
 import openpyxl
 import cv2
 import pandas as pd
 import dataframe_image as dfi             
+try:
+    #optional: only required to receive images over the network (--listen)
+    from pynetdicom import AE, evt, StoragePresentationContexts, VerificationPresentationContexts
+except ImportError:
+    AE = None
+try:
+    #optional: compiles the fused statistics kernel (calculate_results.Moments_Loop)
+    import numba
+except ImportError:
+    numba = None
                 
 
-root = tk.Tk()
-root.title("Moriel QC")
-root.geometry("800x800")
-
 class main:
     #root path to search for images
     Quarterly_path = "S:/"
+    class dicom_catalog:
+        """
+        On disk (SQLite) index of the DICOM headers previously read.  Each 
+        file is stored with its size and modification time so on a rescan 
+        only new or changed files need to be parsed.  Files which could not 
+        be read are also stored (with their error) so they aren't retried 
+        unless they change.
+        
+        The index can be queried for SNR series without opening any of the 
+        DICOM files e.g. Query_Series("SE_SNR_ND", "0000", "20240101")
+        """
+        def __init__(self, catalog_path, header_tags):
+            """
+            Parameters
+            ----------
+            catalog_path : str
+                Path of the SQLite file.  Created if it doesn't exist
+            header_tags : list of str
+                DICOM keywords stored for each file
+            """
+            self.header_tags = list(header_tags)
+            self.Initialise_Directory(os.path.dirname(catalog_path))
+            #several processes may use the catalog at once (watch folder mode)
+            self.connection = sqlite3.connect(catalog_path, timeout=60)
+            columns = ["path", "size", "mtime", "error"] + self.header_tags
+            existing_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(dicoms)")]
+            if existing_columns != columns:
+                #header_tags have changed: the catalog is only a cache so rebuild it
+                self.connection.execute("DROP TABLE IF EXISTS dicoms")
+                self.connection.execute("CREATE TABLE dicoms (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, error TEXT, " + 
+                                        ", ".join(self.header_tags) + ")")
+                self.connection.execute("CREATE INDEX series_index ON dicoms (SeriesDescription, DeviceSerialNumber)")
+                self.connection.commit()
+        
+        @classmethod
+        def Open(cls, catalog_path, header_tags):
+            """
+            Returns the catalog at catalog_path or None if catalog_path is None 
+            or the catalog can't be opened (e.g. the drive isn't mapped).  
+            The catalog is only a cache so the run continues without it.
+            """
+            if catalog_path is None:
+                return None
+            try:
+                return cls(catalog_path, header_tags)
+            except (OSError, sqlite3.Error) as e:
+                print("WARNING: catalog " + catalog_path + " could not be opened, continuing without it: " + 
+                      type(e).__name__ + ": " + str(e))
+                return None
+        
+        def Initialise_Directory(self, path):
+            if path != "" and not os.path.exists(path):
+                os.makedirs(path)
+        
+        def Row_To_Header(self, row):
+            """Convert the header columns of a catalog row to a DICOM (header only)"""
+            header = pydicom.Dataset()
+            for tag_name, value in zip(self.header_tags, row):
+                if value is not None:
+                    if tag_name == "ImageType":
+                        value = value.split("\\")
+                    setattr(header, tag_name, value)
+            return header
+        
+        def Get_Header(self, path, size, mtime):
+            """
+            Returns
+            -------
+            found : bool
+                True if path is in the catalog and hasn't changed since it was indexed
+            header : DICOM or None
+                Header of path. None if the file couldn't be read
+            error : str or None
+            """
+            row = self.connection.execute("SELECT size, mtime, error, " + ", ".join(self.header_tags) + 
+                                          " FROM dicoms WHERE path = ?", (path,)).fetchone()
+            if row is None or row[0] != size or row[1] != mtime:
+                return False, None, None
+            if row[2] is not None:
+                return True, None, row[2]
+            return True, self.Row_To_Header(row[3:]), None
+        
+        def Add(self, path, size, mtime, header, error=None):
+            """Add or replace the entry for path.  Call Commit once all files have been added."""
+            values = []
+            for tag_name in self.header_tags:
+                value = None if header is None else getattr(header, tag_name, None)
+                if value is None:
+                    pass
+                elif isinstance(value, pydicom.multival.MultiValue):
+                    value = "\\".join([str(v) for v in value])
+                elif isinstance(value, int):
+                    value = int(value)
+                elif isinstance(value, float):
+                    value = float(value)
+                else:
+                    value = str(value)
+                values.append(value)
+            self.connection.execute("INSERT OR REPLACE INTO dicoms VALUES (" + ", ".join(["?"]*(4+len(values))) + ")", 
+                                    [path, size, mtime, error] + values)
+        
+        def Remove_Missing(self, root_dir, seen_paths):
+            """Remove entries inside root_dir which weren't found by the latest scan"""
+            seen_paths = set(seen_paths)
+            root_dir = os.path.join(root_dir, "")
+            rows = self.connection.execute("SELECT path FROM dicoms WHERE substr(path, 1, ?) = ?", 
+                                           (len(root_dir), root_dir)).fetchall()
+            for (path,) in rows:
+                if path not in seen_paths:
+                    self.connection.execute("DELETE FROM dicoms WHERE path = ?", (path,))
+        
+        def Get_Stats(self, root_dir=None):
+            """
+            Returns
+            -------
+            stats : dict
+                {<path>:(<size>, <mtime>)} of the entries inside root_dir 
+                (all entries if None)
+            """
+            if root_dir is None:
+                rows = self.connection.execute("SELECT path, size, mtime FROM dicoms")
+            else:
+                root_dir = os.path.join(root_dir, "")
+                rows = self.connection.execute("SELECT path, size, mtime FROM dicoms WHERE substr(path, 1, ?) = ?", 
+                                               (len(root_dir), root_dir))
+            return {path:(size, mtime) for path, size, mtime in rows}
+        
+        def Commit(self):
+            self.connection.commit()
+        
+        def Close(self):
+            self.connection.commit()
+            self.connection.close()
+        
+        def Query_Series(self, series_description, scanner_ID=None, since_date=None):
+            """
+            Parameters
+            ----------
+            series_description : str
+            scanner_ID : str
+                DeviceSerialNumber. If None all scanners are returned
+            since_date : str
+                Date of the form YYYYMMDD. If None all dates are returned
+            
+            Returns
+            -------
+            series : dict
+                Dictionary of the form {(<scanner ID>, <Date>, <Series Time>):[<path>]}
+            
+            Uses only the catalog: none of the DICOM files are opened.
+            """
+            query = "SELECT path, DeviceSerialNumber, COALESCE(SeriesDate, AcquisitionDate), SeriesTime FROM dicoms WHERE SeriesDescription = ?"
+            parameters = [series_description]
+            if scanner_ID is not None:
+                query += " AND DeviceSerialNumber = ?"
+                parameters.append(scanner_ID)
+            if since_date is not None:
+                query += " AND COALESCE(SeriesDate, AcquisitionDate) >= ?"
+                parameters.append(since_date)
+            series = {}
+            for path, serial_number, date, series_time in self.connection.execute(query + " ORDER BY path", parameters):
+                key = (serial_number, date, series_time)
+                if key not in series:
+                    series[key] = []
+                series[key].append(path)
+            return series
+    
+    class dicom_source:
+        """
+        Opens DICOMs stored either as files or as members of zip/ tar 
+        exports so they can be read without extracting the archive first.  
+        An archive member is refered to by the path 
+        <archive path>::<member name> e.g. "S:/export.zip::DICOM/IM_0001".
+        
+        Open archives are kept open per thread until Close_Archives, which 
+        is called once each batch of reads has finished, and are reopened 
+        if the archive has changed (size or modification time) since it 
+        was opened.  Members of zip files and uncompressed tar files are 
+        read directly.  Members of compressed tar files can only be read in 
+        order (each seek backwards decompresses the archive again from the 
+        start) so the archive is extracted once, in member order, to a 
+        temporary directory shared by all threads (Get_Extracted) which is 
+        removed by Close_Archives.
+        """
+        separator = "::"
+        archive_patterns = ["*.zip", "*.tar", "*.tar.gz", "*.tgz", "*.tar.bz2", "*.tar.xz"]
+        compressed_tar_patterns = ["*.tar.gz", "*.tgz", "*.tar.bz2", "*.tar.xz"]
+        open_archives = threading.local()
+        #every archive opened by any thread (closed by Close_Archives)
+        opened_archives = []
+        opened_archives_lock = threading.Lock()
+        #compressed tars extracted by Get_Extracted 
+        #{<archive path>:((<size>, <mtime>), <temporary directory>, {<member name>:<extracted path>})}
+        extracted_archives = {}
+        extracted_archives_lock = threading.Lock()
+        
+        @staticmethod
+        def Is_Archive(path):
+            name = os.path.basename(path).lower()
+            return any([fnmatch.fnmatch(name, pattern) for pattern in main.dicom_source.archive_patterns])
+        
+        @staticmethod
+        def Is_Compressed_Tar(path):
+            name = os.path.basename(path).lower()
+            return any([fnmatch.fnmatch(name, pattern) for pattern in main.dicom_source.compressed_tar_patterns])
+        
+        @staticmethod
+        def Split_Path(path):
+            """Return (<archive path>, <member name>) or (path, None) for a normal file"""
+            if main.dicom_source.separator in path:
+                archive_path, member_name = path.split(main.dicom_source.separator, 1)
+                return archive_path, member_name
+            return path, None
+        
+        @staticmethod
+        def Get_Archive(archive_path):
+            """
+            Return the open ZipFile/ TarFile for archive_path (opened once per 
+            thread).  Reopened if it has been closed or the archive has been 
+            replaced since it was opened.  Not used for compressed tars 
+            (Get_Extracted)
+            """
+            archives = main.dicom_source.open_archives.__dict__
+            stat = os.stat(archive_path)
+            version = (stat.st_size, stat.st_mtime)
+            if archive_path in archives:
+                archive, archive_version = archives[archive_path]
+                closed = archive.fp is None if isinstance(archive, zipfile.ZipFile) else archive.closed
+                if archive_version == version and not closed:
+                    return archive
+                archive.close()
+            if zipfile.is_zipfile(archive_path):
+                archive = zipfile.ZipFile(archive_path)
+            else:
+                archive = tarfile.open(archive_path)
+            archives[archive_path] = (archive, version)
+            with main.dicom_source.opened_archives_lock:
+                main.dicom_source.opened_archives.append(archive)
+            return archive
+        
+        @staticmethod
+        def Get_Extracted(archive_path):
+            """
+            Return {<member name>:<extracted path>} of the files in the 
+            compressed tar archive_path.  The archive is decompressed once, in 
+            one pass in member order, and extracted to a temporary directory 
+            (again if it has changed since).  Members are extracted to numbered 
+            files so member names are never used as paths.
+            """
+            stat = os.stat(archive_path)
+            version = (stat.st_size, stat.st_mtime)
+            with main.dicom_source.extracted_archives_lock:
+                extracted_archives = main.dicom_source.extracted_archives
+                if archive_path in extracted_archives:
+                    extracted_version, temp_directory, members = extracted_archives.pop(archive_path)
+                    if extracted_version == version:
+                        extracted_archives[archive_path] = (extracted_version, temp_directory, members)
+                        return members
+                    shutil.rmtree(temp_directory, ignore_errors=True)
+                temp_directory = tempfile.mkdtemp(prefix="dicom_export_")
+                members = {}
+                try:
+                    #stream mode: members can only be read in order
+                    with tarfile.open(archive_path, "r|*") as archive:
+                        for info in archive:
+                            if info.isfile():
+                                extracted_path = os.path.join(temp_directory, str(len(members)))
+                                with archive.extractfile(info) as source, open(extracted_path, "wb") as destination:
+                                    shutil.copyfileobj(source, destination)
+                                members[info.name] = extracted_path
+                except Exception:
+                    shutil.rmtree(temp_directory, ignore_errors=True)
+                    raise
+                extracted_archives[archive_path] = (version, temp_directory, members)
+                return members
+        
+        @staticmethod
+        def Close_Archives():
+            """
+            Close the archives opened by every thread and remove the extracted 
+            compressed tars.  Only call once no reads are in progress e.g. when 
+            the thread pool of a batch of reads has finished: threads which 
+            still hold a closed archive reopen it
+            """
+            with main.dicom_source.opened_archives_lock:
+                archives = main.dicom_source.opened_archives
+                main.dicom_source.opened_archives = []
+            for archive in archives:
+                archive.close()
+            main.dicom_source.open_archives.__dict__.clear()
+            with main.dicom_source.extracted_archives_lock:
+                for version, temp_directory, members in main.dicom_source.extracted_archives.values():
+                    shutil.rmtree(temp_directory, ignore_errors=True)
+                main.dicom_source.extracted_archives.clear()
+        
+        @staticmethod
+        def Get_Members(archive_path):
+            """Return a list of the paths (<archive path>::<member name>) of the files in archive_path"""
+            if main.dicom_source.Is_Compressed_Tar(archive_path):
+                #only the member headers are needed: list them in one pass without extracting
+                with tarfile.open(archive_path, "r|*") as archive:
+                    names = [info.name for info in archive if info.isfile()]
+            else:
+                archive = main.dicom_source.Get_Archive(archive_path)
+                if isinstance(archive, zipfile.ZipFile):
+                    names = [info.filename for info in archive.infolist() if not info.is_dir()]
+                else:
+                    names = [info.name for info in archive.getmembers() if info.isfile()]
+            return [archive_path + main.dicom_source.separator + name for name in names]
+        
+        @staticmethod
+        def Open(path):
+            """
+            Return a binary file object for path.  Members are streamed from 
+            the archive (from the extracted file for compressed tars)
+            """
+            archive_path, member_name = main.dicom_source.Split_Path(path)
+            if member_name is None:
+                return open(path, "rb")
+            if main.dicom_source.Is_Compressed_Tar(archive_path):
+                return open(main.dicom_source.Get_Extracted(archive_path)[member_name], "rb")
+            archive = main.dicom_source.Get_Archive(archive_path)
+            if isinstance(archive, zipfile.ZipFile):
+                return archive.open(member_name)
+            return archive.extractfile(member_name)
+        
+        @staticmethod
+        def Get_Size_And_Mtime(path):
+            """Return the (uncompressed) size and modification time of path.  Members have the archive's mtime"""
+            archive_path, member_name = main.dicom_source.Split_Path(path)
+            mtime = os.stat(archive_path).st_mtime
+            if member_name is None:
+                return os.stat(path).st_size, mtime
+            if main.dicom_source.Is_Compressed_Tar(archive_path):
+                return os.stat(main.dicom_source.Get_Extracted(archive_path)[member_name]).st_size, mtime
+            archive = main.dicom_source.Get_Archive(archive_path)
+            if isinstance(archive, zipfile.ZipFile):
+                return archive.getinfo(member_name).file_size, mtime
+            return archive.getmember(member_name).size, mtime
+    
+    class pixel_cache:
+        """
+        Least recently used cache of decoded pixel arrays keyed by path.  
+        Arrays are decoded when they are first requested and the least 
+        recently used arrays are released once the total size of the cached 
+        arrays exceeds max_bytes.  Cached arrays are read only.
+        """
+        def __init__(self, max_bytes, n_decode_workers=0):
+            """
+            Parameters
+            ----------
+            max_bytes : int
+                Memory budget for decoded pixel arrays
+            n_decode_workers : int
+                Number of processes used by Prefetch to decode pixel data. 
+                0 = decode in this process
+            """
+            self.max_bytes = max_bytes
+            self.n_decode_workers = n_decode_workers
+            self.arrays = OrderedDict()
+            self.n_bytes = 0
+            self.lock = threading.Lock()
+        
+        @staticmethod
+        def Map_Pixel_Array(path):
+            """
+            Parameters
+            ----------
+            path : str
+            Returns
+            -------
+            pixel_array : read only np array or None
+                View of the Pixel Data of path memory mapped at its offset in 
+                the file.  No data is read or copied until it is used.  None 
+                if the pixel data can't be mapped: compressed or big endian 
+                transfer syntaxes, multi frame/ colour images, signed data 
+                which needs sign extending and archive members.
+            """
+            archive_path, member_name = main.dicom_source.Split_Path(path)
+            if member_name is not None:
+                return None
+            with open(path, "rb") as f:
+                #pydicom leaves the file at the start of the Pixel Data element
+                dcm = pydicom.read_file(f, stop_before_pixels=True)
+                element_start = f.tell()
+                element_header = f.read(12)
+            transfer_syntax = dcm.file_meta.TransferSyntaxUID
+            if element_header[0:4] != b"\xe0\x7f\x10\x00":
+                return None
+            if transfer_syntax == ExplicitVRLittleEndian and element_header[4:6] in [b"OB", b"OW"]:
+                length = int.from_bytes(element_header[8:12], "little")
+                offset = element_start + 12
+            elif transfer_syntax == ImplicitVRLittleEndian:
+                length = int.from_bytes(element_header[4:8], "little")
+                offset = element_start + 8
+            else:
+                return None
+            if dcm.get("SamplesPerPixel", 1) != 1 or int(dcm.get("NumberOfFrames", 1)) != 1:
+                return None
+            if dcm.BitsAllocated not in [8, 16, 32]:
+                return None
+            if dcm.PixelRepresentation == 1:
+                if dcm.BitsStored != dcm.BitsAllocated:
+                    return None
+                dtype = np.dtype("<i" + str(dcm.BitsAllocated//8))
+            else:
+                dtype = np.dtype("<u" + str(dcm.BitsAllocated//8))
+            shape = (dcm.Rows, dcm.Columns)
+            if length == 0xFFFFFFFF or length < dcm.Rows*dcm.Columns*dtype.itemsize:
+                return None
+            return np.asarray(np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape))
+        
+        @staticmethod
+        def Read_Pixel_Array(path):
+            """
+            Return the pixel array of the DICOM at path.  Uncompressed pixel 
+            data is memory mapped (Map_Pixel_Array), otherwise the DICOM is 
+            read and decoded by pydicom.
+            """
+            pixel_array = main.pixel_cache.Map_Pixel_Array(path)
+            if pixel_array is not None:
+                return pixel_array
+            with main.dicom_source.Open(path) as f:
+                dcm = pydicom.read_file(f)
+            if dcm.file_meta.TransferSyntaxUID.is_compressed:
+                dcm.decompress()
+            return dcm.pixel_array
+        
+        def Add(self, path, pixel_array):
+            pixel_array.flags.writeable = False
+            with self.lock:
+                if path in self.arrays:
+                    self.n_bytes -= self.arrays[path].nbytes
+                self.arrays[path] = pixel_array
+                self.n_bytes += pixel_array.nbytes
+                #release least recently used arrays. The newest array is always kept
+                while self.n_bytes > self.max_bytes and len(self.arrays) > 1:
+                    old_path, old_array = self.arrays.popitem(last=False)
+                    self.n_bytes -= old_array.nbytes
+        
+        def Get(self, path):
+            with self.lock:
+                if path in self.arrays:
+                    self.arrays.move_to_end(path)
+                    return self.arrays[path]
+            pixel_array = self.Read_Pixel_Array(path)
+            self.Add(path, pixel_array)
+            return pixel_array
+        
+        def Prefetch(self, handles):
+            """
+            Decode the pixel data of the dicom_handles in handles (as many as 
+            fit in max_bytes) in a process pool of n_decode_workers.  Does 
+            nothing if n_decode_workers is 0.
+            """
+            if self.n_decode_workers == 0:
+                return
+            paths = []
+            with self.lock:
+                n_bytes = self.n_bytes
+                for handle in handles:
+                    if handle.path not in self.arrays:
+                        n_bytes += handle.Rows*handle.Columns*handle.BitsAllocated//8
+                        if n_bytes > self.max_bytes:
+                            break
+                        paths.append(handle.path)
+            if paths == []:
+                return
+            with ProcessPoolExecutor(max_workers=self.n_decode_workers) as pool:
+                for path, pixel_array in zip(paths, pool.map(self.Read_Pixel_Array, paths)):
+                    self.Add(path, pixel_array)
+        
+        def Release(self, paths):
+            """Remove the decoded arrays of paths from the cache"""
+            with self.lock:
+                for path in paths:
+                    if path in self.arrays:
+                        self.n_bytes -= self.arrays.pop(path).nbytes
+        
+        def Clear(self):
+            with self.lock:
+                self.arrays.clear()
+                self.n_bytes = 0
+    
+    class dicom_handle:
+        """
+        Lightweight stand in for a DICOM: holds the path and the header (no 
+        pixel data).  Header attributes are accessed as for a pydicom DICOM 
+        e.g. handle.SeriesTime, handle[Tag(0x0200013)].  pixel_array is 
+        decoded on demand through a pixel_cache.
+        """
+        def __init__(self, path, header, cache):
+            self.path = path
+            self.header = header
+            self.cache = cache
+        
+        def __getattr__(self, name):
+            #only called for attributes which aren't set in __init__
+            if name.startswith("__") or name in ["path", "header", "cache"]:
+                raise AttributeError(name)
+            return getattr(self.header, name)
+        
+        def __getitem__(self, key):
+            return self.header[key]
+        
+        def __contains__(self, key):
+            return key in self.header
+        
+        @property
+        def pixel_array(self):
+            return self.cache.Get(self.path)
+        
+        def Release(self):
+            """Remove the decoded pixel array from the cache"""
+            self.cache.Release([self.path])
+    
+    class element_stack:
+        """
+        The individual element images of one slice of a repeat held as one 
+        contiguous (elements x rows x columns) array, so they can be 
+        exported and analysed with single numpy operations over axis 0.  
+        The header values are held in __slots__ (no per instance __dict__).
+        
+        Built from (From_Dict) the {<element number>:{"path":<path>, 
+        "dcm":<DICOM>}} level of a sorted dcm_dict.  The pixel data is only 
+        read when Load is called.
+        """
+        __slots__ = ["date", "series_time", "repeat", "slice_n", "element_ns", "paths", "dcms", "pixel_arrays"]
+        
+        def __init__(self, element_ns, paths, dcms, date=None, series_time=None, repeat=None, slice_n=None):
+            self.element_ns = element_ns
+            self.paths = paths
+            self.dcms = dcms
+            self.date = date
+            self.series_time = series_time
+            self.repeat = repeat
+            self.slice_n = slice_n
+            self.pixel_arrays = None
+        
+        @classmethod
+        def From_Dict(cls, elements, date=None, series_time=None, repeat=None, slice_n=None):
+            """elements : {<element number>:{"path":<path>, "dcm":<DICOM>}}"""
+            element_ns = list(elements.keys())
+            return cls(element_ns, [elements[element_n]["path"] for element_n in element_ns], 
+                       [elements[element_n]["dcm"] for element_n in element_ns], date, series_time, repeat, slice_n)
+        
+        def Load(self):
+            """
+            Returns the (elements x rows x columns) array of the element 
+            images.  Each image is copied into the stack and its dicom_handle 
+            released so the pixel data is only held once.
+            """
+            if self.pixel_arrays is None:
+                first_array = self.dcms[0].pixel_array
+                self.pixel_arrays = np.empty((len(self.dcms),) + first_array.shape, dtype=first_array.dtype)
+                for i, dcm in enumerate(self.dcms):
+                    self.pixel_arrays[i] = dcm.pixel_array
+                    if isinstance(dcm, main.dicom_handle):
+                        dcm.Release()
+            return self.pixel_arrays
+        
+        def Release(self):
+            self.pixel_arrays = None
+        
+        def To_Uint8(self):
+            """Each element image rescaled to 0-255 (as Convert_to_PNG)"""
+            pixel_arrays = self.Load().astype(float)
+            return np.uint8(np.maximum(pixel_arrays, 0) / np.max(pixel_arrays, axis=(1,2), keepdims=True) * 255.0)
+    
+    class mask_plan:
+        """
+        The phantom and air masks of a slice converted once into what the 
+        SNR and uniformity calculations need, so each image is reduced with 
+        np.take rather than rescanning a full frame boolean mask.  For each 
+        region ("phantom", "air"):
+            "indices": flat indices of the voxels in the image
+            "bbox": (first row, last row + 1, first column, last column + 1) 
+                of the voxels, expanded by crop_margin (within the image)
+            "crop_indices": flat indices of the voxels in the image cropped to bbox
+            "count": number of voxels
+        The plan only holds arrays (To_Arrays) so it can be stored with the mask.
+        """
+        __slots__ = ["shape", "regions"]
+        #pixels around the voxels included in the crops: filtering a crop with 
+        #a 3x3 filter then gives the same values at the voxels as the full image
+        crop_margin = 1
+        
+        def __init__(self, phantom_mask=None, air_mask=None):
+            self.regions = {}
+            self.shape = None
+            for region, mask in [("phantom", phantom_mask), ("air", air_mask)]:
+                if mask is not None:
+                    self.Add_Region(region, mask)
+        
+        def Add_Region(self, region, mask):
+            self.shape = mask.shape
+            rows, columns = np.nonzero(mask)
+            if len(rows) == 0:
+                bbox = (0, 0, 0, 0)
+            else:
+                bbox = (max(rows.min() - self.crop_margin, 0), min(rows.max() + 1 + self.crop_margin, mask.shape[0]), 
+                        max(columns.min() - self.crop_margin, 0), min(columns.max() + 1 + self.crop_margin, mask.shape[1]))
+            self.regions[region] = {"indices":np.ravel_multi_index((rows, columns), mask.shape), 
+                                    "bbox":np.array(bbox), 
+                                    "crop_indices":np.ravel_multi_index((rows - bbox[0], columns - bbox[2]), 
+                                                                        (bbox[1] - bbox[0], bbox[3] - bbox[2])), 
+                                    "count":len(rows)}
+        
+        def Indices(self, region):
+            """Flat indices of the voxels of region (none if the plan has no mask for region)"""
+            if region not in self.regions:
+                return np.zeros(0, dtype=np.intp)
+            return self.regions[region]["indices"]
+        
+        def Take(self, image, region):
+            """
+            Voxels of region in image: (voxels) array for an image or 
+            (images x voxels) for a stack of images
+            """
+            return np.take(image.reshape(image.shape[:-2] + (-1,)), self.regions[region]["indices"], axis=-1)
+        
+        def Crop(self, image, region):
+            """View of image (or a stack of images) cropped to the bbox of region"""
+            row_start, row_stop, column_start, column_stop = self.regions[region]["bbox"]
+            return image[..., row_start:row_stop, column_start:column_stop]
+        
+        def Take_Cropped(self, cropped_image, region):
+            """Voxels of region in an image already cropped to the bbox of region (e.g. filtered crop)"""
+            cropped_image = np.ascontiguousarray(cropped_image)
+            return np.take(cropped_image.reshape(cropped_image.shape[:-2] + (-1,)), self.regions[region]["crop_indices"], axis=-1)
+        
+        def Mask(self, region):
+            """Boolean mask of region"""
+            mask = np.zeros(self.shape, dtype=np.bool_)
+            mask.flat[self.regions[region]["indices"]] = True
+            return mask
+        
+        def To_Arrays(self):
+            """{<region>_<key>:<array>} e.g. for np.savez"""
+            arrays = {"shape":np.array(self.shape)}
+            for region, values in self.regions.items():
+                for key, value in values.items():
+                    arrays[region + "_" + key] = np.asarray(value)
+            return arrays
+        
+        @classmethod
+        def From_Arrays(cls, arrays):
+            plan = cls()
+            plan.shape = tuple(int(n) for n in arrays["shape"])
+            for region in ["phantom", "air"]:
+                if region + "_indices" in arrays:
+                    plan.regions[region] = {key:arrays[region + "_" + key] for key in ["indices", "bbox", "crop_indices"]}
+                    plan.regions[region]["count"] = int(arrays[region + "_count"])
+            return plan
+    
     class initialise_analysis:    
         
         #Acceptable list of sequence names
         SNR_sequence_names = ["SE_SNR_ND"]
+        #header tags read to filter and sort the DICOMs before any pixel data is read
+        header_tags = ["SeriesDescription", "DeviceSerialNumber", "SeriesDate", "SeriesTime", 
+                       "AcquisitionDate", "AcquisitionTime", "ContentTime", "InstanceCreationTime", 
+                       "InstanceNumber", "SeriesNumber", "ProtocolName", "ImageType", "AcquisitionNumber", 
+                       "ReceiveCoilName", "SOPInstanceUID", "StudyInstanceUID"]
+        #number of threads used to read DICOMs.  Reading is limited by the 
+        #latency of the file share rather than the CPU
+        n_read_workers = 8
+        #number of processes used to decode compressed pixel data. 0 = no process pool
+        n_decode_workers = 0
+        #memory budget for decoded pixel arrays (bytes)
+        pixel_cache_bytes = 512*1024**2
+        #glob patterns matched against file and directory names when searching for DICOMs
+        include_patterns = ["*"]
+        exclude_patterns = ["VERSION", "DICOMDIR", "*.pdf", "*.jpg", "*.jpeg", "*.png", "*.bmp", 
+                            "*.txt", "*.log", "*.xml", "*.html", "*.ini", "*.exe", "*.dll"]
+        exclude_dir_patterns = []
+        #SQLite index of previously read headers so rescans only read new/ changed files 
+        #e.g. "S:/dicom_catalog.sqlite". None = no catalog
+        catalog_path = None
         #root location to store PNG images e.g. graphs, tables and magnitude images
         png_archive = "S:/"
         #dictionary of form {<scanner ID>: <scanner name>}
         scanner_ID_dict = {"0000":"My_MRI_Scanner"}        
+        #dictionary of form {<scanner ID>: <key of sort_rules for the scanner>}
+        scanner_sort_methods = {"0000":"Elition_X_PHT"}
+        #rules used by Sort_Dicom_Dict_By_Rules to sort the DICOMs from each type of scanner:
+        #   "date": tag giving the date of the images
+        #   "series_time": tag giving the series time
+        #   "series_time_format": "raw" (as in the DICOM), "zfill" (whole seconds, 6 digits) or "int" (whole seconds)
+        #   "series_tolerance": seconds. Images with series times up to this long after the first 
+        #       image of a series belong to that series (individual element and combined images are 
+        #       saved as separate series a fraction of a second apart)
+        #   "pair_series": True if each repeat is a separate series: consecutive series are paired
+        #   "select": (<tag>, <prefix>) only images where the tag starts with prefix are used. None = all images
+        #   "group_by": tags which split a series into groups of images classified together
+        #   "image_type": how an image is classified as "Combined" or "DelRec" (individual element):
+        #       "DelRec" = all images are individual elements, "NORM" = combined images have NORM in 
+        #       the ImageType, "count" = by the number of images in the group (slices * "count_factor"
+        #       = combined, slices * elements * "count_factor" = individual elements).  "count_factor" 
+        #       is a number or "expected_repeats" (all the repeats are in the group)
+        #   "count_per": "group" or "repeat" (images in the group with the same repeat as the first image)
+        #   "repeat": {<image type>: <tag> or "instance_block" (InstanceNumber-1)//elements + 
+        #       "repeat_start" or "series" (the series time of a paired series)}
+        #   "element": "instance_modulo" (InstanceNumber % elements + 1), "instance_cycle" 
+        #       ((InstanceNumber-1) % elements + 1) or "rank" (order of "rank_tag" within the repeat and slice)
+        #   "rank_as_float": True if "rank_tag" is ordered by its numerical value
+        #   "slice": tag giving the slice number. None = 1 slice
+        #   "combined": "stored" or "sum_of_squares" (calculated from the individual elements)
+        #   "check_counts": raise an exception if a repeat doesn't have the slices/ elements in coil_dict
+        sort_rules = {
+            "Ambition_X_PHT":{"date":"AcquisitionDate", "series_time":"SeriesTime", "series_time_format":"raw", 
+                              "series_tolerance":0, "pair_series":False, "select":("ProtocolName", "DelRec"), 
+                              "group_by":[], "image_type":"DelRec", "repeat":{"DelRec":"AcquisitionTime"}, 
+                              "element":"instance_modulo", "slice":None, "combined":"sum_of_squares", 
+                              "check_counts":True},
+            "Elition_X_PHT":{"date":"SeriesDate", "series_time":"SeriesTime", "series_time_format":"raw", 
+                             "series_tolerance":0, "pair_series":False, "select":("ProtocolName", "DelRec"), 
+                             "group_by":[], "image_type":"DelRec", "repeat":{"DelRec":"instance_block"}, 
+                             "repeat_start":0, "element":"instance_modulo", "slice":None, 
+                             "combined":"sum_of_squares", "check_counts":True},
+            "Siemens":{"date":"AcquisitionDate", "series_time":"SeriesTime", "series_time_format":"raw", 
+                       "series_tolerance":1, "pair_series":True, "select":None, "group_by":[], 
+                       "image_type":"NORM", "repeat":{"Combined":"series", "DelRec":"series"}, 
+                       "element":"rank", "rank_tag":"ContentTime", "rank_as_float":False, 
+                       "slice":"InstanceNumber", "combined":"stored", "check_counts":True},
+            "Siemens_Avanto_RBH_PHT":{"date":"AcquisitionDate", "series_time":"SeriesTime", "series_time_format":"raw", 
+                                      "series_tolerance":1, "pair_series":False, "select":None, 
+                                      "group_by":["SeriesNumber"], "image_type":"count", "count_per":"repeat", 
+                                      "count_factor":1, "repeat":{"Combined":"InstanceNumber", "DelRec":"InstanceNumber"}, 
+                                      "element":"rank", "rank_tag":"InstanceCreationTime", "rank_as_float":True, 
+                                      "slice":None, "combined":"stored", "check_counts":False},
+            "Siemens_Avanto_DCH":{"date":"AcquisitionDate", "series_time":"SeriesTime", "series_time_format":"zfill", 
+                                  "series_tolerance":1, "pair_series":False, "select":None, 
+                                  "group_by":["SeriesNumber"], "image_type":"count", "count_per":"repeat", 
+                                  "count_factor":1, "repeat":{"Combined":"InstanceNumber", "DelRec":"InstanceNumber"}, 
+                                  "element":"rank", "rank_tag":"InstanceCreationTime", "rank_as_float":True, 
+                                  "slice":None, "combined":"stored", "check_counts":False},
+            "Siemens_Sola_RBH":{"date":"AcquisitionDate", "series_time":"SeriesTime", "series_time_format":"raw", 
+                                "series_tolerance":1, "pair_series":False, "select":None, 
+                                "group_by":["SeriesNumber"], "image_type":"count", "count_per":"group", 
+                                "count_factor":"expected_repeats", 
+                                "repeat":{"Combined":"InstanceNumber", "DelRec":"instance_block"}, 
+                                "repeat_start":1, "element":"instance_cycle", "slice":None, "combined":"stored", 
+                                "check_counts":False},
+            "Siemens_Sola_DCH":{"date":"SeriesDate", "series_time":"SeriesTime", "series_time_format":"int", 
+                                "series_tolerance":1, "pair_series":False, "select":None, 
+                                "group_by":["SeriesNumber"], "image_type":"count", "count_per":"group", 
+                                "count_factor":"expected_repeats", 
+                                "repeat":{"Combined":"InstanceNumber", "DelRec":"instance_block"}, 
+                                "repeat_start":1, "element":"instance_cycle", "slice":None, "combined":"stored", 
+                                "check_counts":False},
+            }
+        #dictionary of form {<scanner ID>: True if the scanner stores combined element images}
+        #(Philips combined images are calculated by the sum of squares)
+        scanner_combined_images = {"0000":False}
+        #number of repeats acquired for each coil
+        expected_repeats = 2
+        #dtype sum of squares combined images are calculated in.  np.float32 halves the memory 
+        #used: the combined image then agrees with np.float64 to a relative difference < 1e-6
+        sum_of_squares_dtype = np.float64
+        #dictionary of form {<scanner ID>:{<ReceiveCoilName in the DICOM header>:<coil name in coil_dict>}}
+        #used to identify the coil when there is no user to ask (watch folder mode)
+        receive_coil_dict = {"0000":{}}
         coil_dict = {
             "0000": {
                  "Anterior_74":{"n_slices":1, "n_elements":28, "lower_threshold":0.1, "upper_threshold":0.1},
@@ -102,14 +884,37 @@ class main:
             
              }
             
-        def __init__(self, images_root_dir):
+        def __init__(self, images_root_dir, dcm_paths=None, coil_name=None, archive_directory=None, 
+                     figures=False, excel_export=False):
                 """
                 Parameters
                 ----------
                 images_root_dir : str
                     Directory to open file dialogue for selecting directory 
                     containing all dicom files.
+                dcm_paths : list of str
+                    If specified these DICOMs are analysed and no dialogues are 
+                    shown (headless: watch folder mode).  images_root_dir is 
+                    then the directory the DICOMs are in and the remaining 
+                    parameters replace the user's answers.
+                coil_name : str
+                    Headless only: key of coil_dict.  If None the coil is 
+                    identified from the DICOM header (Identify_Coil)
+                archive_directory : str
+                    Headless only: directory to archive the DICOMs to. None = no archive
+                figures : bool
+                    Headless only: produce PNGs
+                excel_export : bool
+                    Headless only: export results to excel
                 """
+                if dcm_paths is not None:
+                    self.base_directory = images_root_dir
+                    self.archive = archive_directory is not None
+                    self.archive_directory = archive_directory
+                    self.figures = figures
+                    self.excel_export = excel_export
+                    self.Initialise_Headless(dcm_paths, coil_name)
+                    return
                 self.base_directory = self.Select_Directory(images_root_dir, 
                                                             "Select directory containing all dicom images to be analysed.")
                 #Ask if the user wants to copy the images selected to the archive directory in a sorted format
@@ -124,25 +929,60 @@ class main:
                 
                 #Ask if results should be exported to excel
                 self.Export_To_Excel()
-                #get all dicom files inside base_directory
-                self.dcm_paths = self.Get_Files(self.base_directory)
-                self.dcm_dict = self.Get_Dicom_Dict(self.dcm_paths)
+                #get all dicom files inside base_directory.  If the directory 
+                #contains a DICOMDIR only the SNR series listed in it are read
+                self.dcm_paths = None
+                dicomdir_path = self.Find_DICOMDIR(self.base_directory)
+                if dicomdir_path is not None:
+                    self.dcm_paths = self.Get_Files_From_DICOMDIR(dicomdir_path)
+                if self.dcm_paths is None:
+                    self.dcm_paths = self.Get_Files(self.base_directory, check_dicom=False)
+                    self.dcm_dict = self.Get_Dicom_Dict(self.dcm_paths, self.base_directory, check_dicom=True)
+                else:
+                    self.dcm_dict = self.Get_Dicom_Dict(self.dcm_paths)
+                if self.dcm_dict == {}:
+                    raise Exception("No SNR images found in " + self.base_directory)
                 self.Get_Coil_Name(self.dcm_dict)
-                #Sort Dicoms (the sort method varies depending on the scanner)
-                if self.scanner_ID == "0000":
-                    self.sorted_dcm_dict = self.Sort_Dicom_Dict_Elition_X_PHT(self.dcm_dict)
+                self.Sort_And_Archive()
+        
+        def Initialise_Headless(self, dcm_paths, coil_name=None):
+            """
+            Read, sort and archive dcm_paths without any dialogues.  Used by 
+            the watch folder mode.
+            """
+            self.dcm_paths = dcm_paths
+            self.dcm_dict = self.Get_Dicom_Dict(self.dcm_paths)
+            if self.dcm_dict == {}:
+                raise Exception("No SNR images found in " + self.base_directory)
+            path = list(self.dcm_dict.keys())[0]
+            if coil_name is None:
+                coil_name = self.Identify_Coil(self.dcm_dict[path])
+                if coil_name is None:
+                    raise Exception("Coil could not be identified for " + path + 
+                                    ". Add the receive coil name to receive_coil_dict")
+            self.Get_Coil_Name(self.dcm_dict, coil_name)
+            self.Sort_And_Archive()
+        
+        def Sort_And_Archive(self):
+            """
+            Sort the DICOMs in self.dcm_dict, archive them and produce PNGs (if 
+            required) and initialise the default mask thresholds
+            """
+            #Sort Dicoms (the sort method varies depending on the scanner)
+            self.sorted_dcm_dict = self.Sort_Dicom_Dict(self.dcm_dict)
                
-                #archive DICOMs in a sorted format
-                if self.archive == True:
-                    self.Archive_Images(self.sorted_dcm_dict, self.archive_directory)
-                #produce PNGs of magnitude images
-                if self.figures == True:
-                    self.Archive_PNGs(self.sorted_dcm_dict)
-                #Get the default thresholds used for producing the mask for the coil selected
-                #If different thresholds are required this may indicate a fault.
-                self.lower_threshold = self.coil_dict[self.scanner_ID][self.coil_name]["lower_threshold"]
-                self.upper_threshold = self.coil_dict[self.scanner_ID][self.coil_name]["upper_threshold"]
-                
+            #archive DICOMs in a sorted format
+            if self.archive == True:
+                self.Archive_Images(self.sorted_dcm_dict, self.archive_directory)
+            #produce PNGs of magnitude images
+            if self.figures == True:
+                self.Archive_PNGs(self.sorted_dcm_dict)
+            self.Print_Ingest_Report()
+            #Get the default thresholds used for producing the mask for the coil selected
+            #If different thresholds are required this may indicate a fault.
+            self.lower_threshold = self.coil_dict[self.scanner_ID][self.coil_name]["lower_threshold"]
+            self.upper_threshold = self.coil_dict[self.scanner_ID][self.coil_name]["upper_threshold"]
+        
         def Select_Directory(self, initial_dir, window_title):
             """
             Parameters
@@ -169,59 +1009,423 @@ class main:
             return user_selected_directory
     
     
-        def Get_Files(self, starting_dir):
+        @staticmethod
+        def Is_Dicom_File(path):
+            """
+            Parameters
+            ----------
+            path : str
+            Returns
+            -------
+            True/ False
+            
+            Checks the first bytes of the file.  DICOM files (Part 10) have a 
+            128 byte preamble followed by "DICM".  Some older exports have no 
+            preamble: these are accepted if the file starts with a little 
+            endian tag from the command/ file meta (0002) or identifying (0008) 
+            group followed by either a valid explicit VR or a plausible 
+            implicit VR length.
+            """
+            try:
+                with main.dicom_source.Open(path) as f:
+                    start = f.read(132)
+            except (OSError, KeyError, zipfile.BadZipFile, tarfile.TarError):
+                return False
+            if len(start) == 132 and start[128:132] == b"DICM":
+                return True
+            if len(start) < 8:
+                return False
+            group = int.from_bytes(start[0:2], "little")
+            if group not in [0x0002, 0x0008]:
+                return False
+            VR = start[4:6]
+            if VR.isalpha() and VR.isupper():
+                return True
+            #implicit VR: the first element (e.g. SpecificCharacterSet) is short
+            return int.from_bytes(start[4:8], "little") < 0x10000
+        
+        def Is_Included(self, file_name):
+            """True if file_name matches include_patterns and doesn't match exclude_patterns"""
+            if not any([fnmatch.fnmatch(file_name, pattern) for pattern in self.include_patterns]):
+                return False
+            return not any([fnmatch.fnmatch(file_name, pattern) for pattern in self.exclude_patterns])
+        
+        def Get_Archive_Files(self, archive_path, skip_paths=set(), check_dicom=True):
+            """
+            Parameters
+            ----------
+            archive_path : str
+                zip/ tar export
+            skip_paths : set of str
+                Member paths which are not checked or returned
+            check_dicom : bool
+                As Get_Files
+            Returns
+            -------
+            paths : generator of str
+                <archive path>::<member name> of each member which looks like a DICOM
+            """
+            try:
+                member_paths = main.dicom_source.Get_Members(archive_path)
+            except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+                print("Could not open " + archive_path + ": " + str(e))
+                return
+            for member_path in member_paths:
+                if member_path in skip_paths:
+                    continue
+                if self.Is_Included(os.path.basename(member_path)) and (check_dicom == False or self.Is_Dicom_File(member_path)):
+                    yield member_path
+        
+        def Get_Files(self, starting_dir, skip_paths=None, check_dicom=True):
             """
             Parameters
             ----------
             starting_dir: str
-                Every file not called VERSION inside 
-                starting_dir will be assumed to be a dicom of interest.
+                Directory to search for DICOMs
+            skip_paths : set of str
+                Paths which are not checked or returned (e.g. already read)
+            check_dicom : bool
+                False = files aren't opened here: the caller checks them 
+                (Read_Dicom/ Get_Dicom_Dict with check_dicom=True) in its 
+                read pool, only when they aren't already in the catalog
             
             Returns
             -------
-            paths : list of str
-                list of dicom_paths inside starting_dir.
+            paths : generator of str
+                dicom_paths inside starting_dir.
+            
+            Walks starting_dir with os.scandir and yields the path of each file 
+            which matches include_patterns, doesn't match exclude_patterns and 
+            looks like a DICOM (Is_Dicom_File, if check_dicom).  Directories matching 
+            exclude_dir_patterns are skipped.  Paths are yielded as they are 
+            found so reading can start before the walk has finished.  Files 
+            are yielded in the same order as os.walk.
+            
+            zip/ tar exports (starting_dir itself or inside it) are searched 
+            without extracting them: their members are yielded as 
+            <archive path>::<member name> (see dicom_source).
             """
+            if skip_paths is None:
+                skip_paths = set()
+            if main.dicom_source.Is_Archive(starting_dir) and os.path.isfile(starting_dir):
+                yield from self.Get_Archive_Files(starting_dir, skip_paths, check_dicom)
+                return
+            dirs_to_scan = [starting_dir]
+            while dirs_to_scan != []:
+                current_dir = dirs_to_scan.pop()
+                sub_dirs = []
+                try:
+                    entries = os.scandir(current_dir)
+                except OSError as e:
+                    print("Could not scan " + current_dir + ": " + str(e))
+                    continue
+                with entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not any([fnmatch.fnmatch(entry.name, pattern) for pattern in self.exclude_dir_patterns]):
+                                sub_dirs.append(entry.path)
+                        elif entry.is_file():
+                            if entry.path in skip_paths:
+                                continue
+                            if main.dicom_source.Is_Archive(entry.name):
+                                yield from self.Get_Archive_Files(entry.path, skip_paths, check_dicom)
+                            elif self.Is_Included(entry.name) and (check_dicom == False or self.Is_Dicom_File(entry.path)):
+                                yield entry.path
+                #subdirectories are searched in order (depth first) as os.walk
+                dirs_to_scan.extend(reversed(sub_dirs))
+        
+        def Find_DICOMDIR(self, starting_dir):
+            """
+            Parameters
+            ----------
+            starting_dir: str
+            Returns
+            -------
+            dicomdir_path : str or None
+                Path of the DICOMDIR in starting_dir or in one of its 
+                subdirectories (media exports usually put it at the top 
+                level).  None if there isn't one.
+            """
+            dicomdir_path = os.path.join(starting_dir, "DICOMDIR")
+            if os.path.isfile(dicomdir_path):
+                return dicomdir_path
+            with os.scandir(starting_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        dicomdir_path = os.path.join(entry.path, "DICOMDIR")
+                        if os.path.isfile(dicomdir_path):
+                            return dicomdir_path
+            return None
+        
+        def Get_Files_From_DICOMDIR(self, dicomdir_path):
+            """
+            Parameters
+            ----------
+            dicomdir_path: str
+            Returns
+            -------
+            paths : list of str or None
+                Paths of the files in the SNR series (SNR_sequence_names) 
+                listed in the DICOMDIR.  None if the DICOMDIR can't be read or 
+                no SNR series are listed (e.g. the SNR images were copied next 
+                to the DICOMDIR tree): the directory must then be searched 
+                with Get_Files.
+            
+            The series description isn't required in the DICOMDIR series 
+            records (and isn't written by most exports).  For each series 
+            without one the SeriesDescription of one of its images is read 
+            instead.  The other files of the series which aren't SNR series 
+            are never opened.
+            """
+            try:
+                file_set = FileSet(pydicom.read_file(dicomdir_path))
+            except Exception as e:
+                print("Could not read " + dicomdir_path + ": " + str(e))
+                return None
+            #{<SeriesInstanceUID>:[<path>]} and {<SeriesInstanceUID>:<SeriesDescription or None>}
+            series_paths = {}
+            series_descriptions = {}
+            for instance in file_set:
+                series_uid = getattr(instance, "SeriesInstanceUID", None)
+                if series_uid not in series_paths:
+                    series_paths[series_uid] = []
+                    series_descriptions[series_uid] = getattr(instance, "SeriesDescription", None)
+                series_paths[series_uid].append(instance.path)
+            unknown_series = [series_uid for series_uid in series_paths if series_descriptions[series_uid] is None]
+            with ThreadPoolExecutor(max_workers=self.n_read_workers) as pool:
+                headers = pool.map(self.Read_Dicom, [series_paths[series_uid][0] for series_uid in unknown_series], 
+                                   [["SeriesDescription"]]*len(unknown_series))
+                for series_uid, (path, header, error) in zip(unknown_series, headers):
+                    if error is not None:
+                        print("Could not read " + path + ": " + error)
+                    else:
+                        series_descriptions[series_uid] = getattr(header, "SeriesDescription", None)
             paths = []
-             
-            for dirName, subdirList, fileList in os.walk(starting_dir):
-                #individual channel data
-                for filename in fileList:
-                    if filename != "VERSION":
-                        paths.append(os.path.join(dirName,filename))
-                    
+            for series_uid in series_paths:
+                if series_descriptions[series_uid] in self.SNR_sequence_names:
+                    paths += series_paths[series_uid]
+            if paths == []:
+                print("DICOMDIR does not list any SNR series: searching " + os.path.dirname(dicomdir_path))
+                return None
+            print(str(len(paths)) + " SNR images found in " + dicomdir_path)
             return paths
         
-        def Get_Dicom_Dict(self, dicom_paths):
+        def Is_SNR_Dicom(self, dcm):
+            """
+            Parameters
+            ----------
+            dcm : DICOM
+                Only the header of the DICOM is required
+            Returns
+            -------
+            True/ False
+            
+            Checks if dcm belongs to one of the sequences in SNR_sequence_names.
+            """
+            if getattr(dcm, "SeriesDescription", None) in self.SNR_sequence_names:
+                if dcm.DeviceSerialNumber in ["183188","202541","183109"]:
+                    #ensure only Non distortion corrected images are used
+                    if dcm.SeriesDescription[-2:] == "ND":
+                        return True
+                else:
+                    return True
+            return False
+        
+        @staticmethod
+        def Read_Dicom(dicom_path, specific_tags=None, check_dicom=False):
+            """
+            Parameters
+            ----------
+            dicom_path : str
+            specific_tags : list of str
+                If specified only these tags are read, otherwise the full 
+                header is read.  Pixel data is never read.
+            check_dicom : bool
+                Check the file looks like a DICOM (Is_Dicom_File) first
+            Returns
+            -------
+            dicom_path : str
+            dcm : DICOM header or None if the read failed or (check_dicom) 
+                the file isn't a DICOM
+            error : str or None (None if the file isn't a DICOM)
+            
+            Reads a single DICOM header.  Used by the thread pools in 
+            Get_Dicom_Dict so any exception is returned rather than raised.
+            """
+            if check_dicom == True and not main.initialise_analysis.Is_Dicom_File(dicom_path):
+                return dicom_path, None, None
+            try:
+                with main.dicom_source.Open(dicom_path) as f:
+                    dcm = pydicom.read_file(f, stop_before_pixels=True, specific_tags=specific_tags)
+                return dicom_path, dcm, None
+            except Exception as e:
+                return dicom_path, None, type(e).__name__ + ": " + str(e)
+        
+        @staticmethod
+        def Read_Dicom_If_Changed(dicom_path, specific_tags=None, check_dicom=False, catalog_stats={}):
             """
             Parameters
             ----------
-            dicom_paths : list of strings
-                List of all dicom paths
+            dicom_path, specific_tags, check_dicom : as Read_Dicom
+            catalog_stats : dict
+                {<path>:(<size>, <mtime>)} of the files in the catalog 
+                (dicom_catalog.Get_Stats)
+            Returns
+            -------
+            dicom_path : str
+            size, mtime : int, float or None if the file couldn't be stat'ed
+            dcm : DICOM header or None (as Read_Dicom)
+            error : str or None
+            unchanged : bool
+                True if the size and mtime match catalog_stats: the file isn't read
+            
+            Stats the file and reads it (Read_Dicom) unless it is unchanged 
+            since it was added to the catalog.  Used by the thread pool in 
+            Get_Dicom_Dict so the file share is stat'ed n_read_workers files at 
+            once and any exception is returned rather than raised.
+            """
+            try:
+                size, mtime = main.dicom_source.Get_Size_And_Mtime(dicom_path)
+            except Exception as e:
+                return dicom_path, None, None, None, type(e).__name__ + ": " + str(e), False
+            if catalog_stats.get(dicom_path) == (size, mtime):
+                return dicom_path, size, mtime, None, None, True
+            dicom_path, dcm, error = main.initialise_analysis.Read_Dicom(dicom_path, specific_tags, check_dicom)
+            return dicom_path, size, mtime, dcm, error, False
+        
+        def Get_Dicom_Dict(self, dicom_paths, scanned_root=None, check_dicom=False):
+            """
+            Parameters
+            ----------
+            dicom_paths : list or generator of strings
+                All dicom paths
+            scanned_root : str
+                Directory dicom_paths were found in.  Catalog entries inside 
+                this directory which are not in dicom_paths are removed
+            check_dicom : bool
+                dicom_paths may include files which aren't DICOMs (e.g. 
+                Get_Files with check_dicom=False).  Files not in the catalog 
+                are checked with Is_Dicom_File in the read pool and dropped 
+                if they aren't DICOMs
             Returns
             -------
             dcm_dict : dict
-                Dictionary of dicoms of the form {<path>:<dicom>}
+                Dictionary of dicoms of the form {<path>:<dicom_handle>}
+            
+            DICOMs are read in two passes.  The first pass only reads the 
+            header tags in header_tags which are enough to decide if the 
+            DICOM is an SNR image.  Headers of files which are unchanged 
+            since they were added to the catalog (catalog_path) are not 
+            read again.  The full header of the DICOMs which pass is then 
+            read.  Pixel data is not read here: each DICOM is returned as a 
+            dicom_handle which decodes its pixel data on demand through 
+            self.pixel_cache.  A summary of the data skipped is stored in 
+            self.ingest_report.
+            
+            Both passes read n_read_workers files at once.  The results are 
+            returned in the order of dicom_paths so the output is the same as 
+            reading the files one at a time.  Files which can't be read are 
+            listed in self.ingest_errors as (<path>, <error>) and the run 
+            continues.  This includes files which can't be stat'ed e.g. 
+            files removed since the directory was searched.
             """
+            self.pixel_cache = main.pixel_cache(self.pixel_cache_bytes, self.n_decode_workers)
             dcm_dict = {}
-            for dicom_path in dicom_paths:
-                dcm = pydicom.read_file(dicom_path)
-                if dcm.SeriesDescription in self.SNR_sequence_names:
-                    if dcm.DeviceSerialNumber in ["183188","202541","183109"]:
-                        #ensure only Non distortion corrected images are used
-                        if dcm.SeriesDescription[-2:] == "ND":
-                            dcm_dict[dicom_path] = dcm
+            selected_paths = []
+            self.ingest_errors = []
+            n_files = 0
+            bytes_skipped = 0
+            
+            #first pass: header only. Headers of files which haven't changed 
+            #since the last run are taken from the catalog
+            start_time = time.perf_counter()
+            catalog = main.dicom_catalog.Open(self.catalog_path, self.header_tags)
+            if catalog is not None:
+                catalog_stats = catalog.Get_Stats(scanned_root)
+            else:
+                catalog_stats = {}
+            headers = {}
+            file_stats = {}
+            n_from_catalog = 0
+            with ThreadPoolExecutor(max_workers=self.n_read_workers) as pool:
+                #dicom_paths may be a generator: files are stat'ed and read as 
+                #paths arrive so they overlap with the directory walk
+                for dicom_path in dicom_paths:
+                    headers[dicom_path] = pool.submit(self.Read_Dicom_If_Changed, dicom_path, self.header_tags, 
+                                                      check_dicom, catalog_stats)
+                for dicom_path in list(headers):
+                    dicom_path, size, mtime, header, error, unchanged = headers[dicom_path].result()
+                    if unchanged:
+                        found, header, error = catalog.Get_Header(dicom_path, size, mtime)
+                        if found:
+                            n_from_catalog += 1
+                        else:
+                            #replaced in the catalog since Get_Stats (another process)
+                            dicom_path, header, error = self.Read_Dicom(dicom_path, self.header_tags, check_dicom)
+                    if header is None and error is None:
+                        #not a DICOM
+                        del headers[dicom_path]
+                        continue
+                    headers[dicom_path] = (header, error)
+                    file_stats[dicom_path] = (size, mtime)
+                    if catalog is not None and unchanged == False and size is not None:
+                        catalog.Add(dicom_path, size, mtime, header, error)
+            if catalog is not None:
+                if scanned_root is not None:
+                    catalog.Remove_Missing(scanned_root, file_stats.keys())
+                catalog.Close()
+            
+            for dicom_path in file_stats:
+                n_files += 1
+                header, error = headers[dicom_path]
+                if error is not None:
+                    self.ingest_errors.append((dicom_path, error))
+                elif self.Is_SNR_Dicom(header):
+                    selected_paths.append(dicom_path)
+                else:
+                    bytes_skipped += file_stats[dicom_path][0]
+            header_time = time.perf_counter() - start_time
+            
+            #second pass: full header for the SNR images only
+            with ThreadPoolExecutor(max_workers=self.n_read_workers) as pool:
+                for dicom_path, header, error in pool.map(self.Read_Dicom, selected_paths):
+                    if error is not None:
+                        self.ingest_errors.append((dicom_path, error))
                     else:
-                        dcm_dict[dicom_path] = dcm
+                        dcm_dict[dicom_path] = main.dicom_handle(dicom_path, header, self.pixel_cache)
+            #the headers have been read: pixel data reopens the archives it needs
+            main.dicom_source.Close_Archives()
+            
+            self.ingest_report = {"n_files":n_files, "n_selected":len(selected_paths), "n_from_catalog":n_from_catalog,
+                                  "n_errors":len(self.ingest_errors), "bytes_skipped":bytes_skipped, 
+                                  "header_time":header_time}
+            if self.ingest_errors != []:
+                print(str(len(self.ingest_errors)) + " files could not be read:")
+                for dicom_path, error in self.ingest_errors:
+                    print("    " + dicom_path + ": " + error)
             return dcm_dict
         
-        def Get_Coil_Name(self, dcm_dict):
+        def Print_Ingest_Report(self):
+            """
+            Print how many files were skipped by the header prefilter and the 
+            (measured) time taken to read the headers.  Nothing is printed if 
+            no files were skipped.
+            """
+            n_skipped = self.ingest_report["n_files"] - self.ingest_report["n_selected"] - self.ingest_report["n_errors"]
+            if n_skipped == 0:
+                return
+            print("Header prefilter: " + str(n_skipped) + " of " + str(self.ingest_report["n_files"]) + 
+                  " files skipped, " + str(round(self.ingest_report["bytes_skipped"]/1e6,1)) + " MB not read " + 
+                  "(headers read in " + str(round(self.ingest_report["header_time"],1)) + " s)")
+        
+        def Get_Coil_Name(self, dcm_dict, coil_name=None):
             """
             Parameters
             ----------
             dcm_dict : dict
                 Dictionary of dicoms of the form {<path>:<dicom>}
-            
+            coil_name : str
+                If None the user is asked to select the coil
             
             Initialises the scanner ID, the coil name, the number of elements 
             the combined elemet image is produced from and the scanner name. 
@@ -232,6 +1436,11 @@ class main:
             path = list(dcm_dict.keys())[0]
             self.scanner_ID = dcm_dict[path].DeviceSerialNumber
             self.categories = list(self.coil_dict[self.scanner_ID].keys())
+            if coil_name is not None:
+                self.coil_name = coil_name
+                self.n_elements = self.coil_dict[self.scanner_ID][self.coil_name]["n_elements"]
+                self.scanner_name = self.scanner_ID_dict[self.scanner_ID]
+                return
             top = tk.Toplevel()
             top.title("Select Coil Name")
             top.geometry('200x100')
@@ -247,458 +1456,189 @@ class main:
             self.scanner_name = self.scanner_ID_dict[self.scanner_ID]
             top.destroy()
             
-        def Sort_Dicom_Dict_Ambition_X_PHT(self, dcm_dict):
-            sorted_dcm_dict={}
-            n_elements = self.coil_dict[self.scanner_ID][self.coil_name]["n_elements"]
-            n_slices = self.coil_dict[self.scanner_ID][self.coil_name]["n_slices"]
-            for path in dcm_dict:
-                dcm = dcm_dict[path]
-                
-                
-                if dcm.AcquisitionDate not in sorted_dcm_dict.keys():
-                    sorted_dcm_dict[dcm.AcquisitionDate] = {}
-                if dcm.SeriesTime not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                    sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime] = {}   
-                if dcm.AcquisitionTime not in sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime].keys():
-                    sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime] = {}
-                    sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime]["DelRec"] = {}
-                    sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime]["Combined"] = {}
-                    sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime]["Combined"][1] = {}
-                    sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime]["DelRec"]["unsorted"] = {}
-                if dcm.ProtocolName[0:6] =="DelRec":
-                    #individual elements
-                    sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime]["DelRec"]["unsorted"][dcm.InstanceNumber] = {"path":path, "dcm":dcm}
-                    
-            for acq_date in sorted_dcm_dict:
-                for series_time in sorted_dcm_dict[acq_date]:
-                    for acq_time in sorted_dcm_dict[acq_date][series_time]:
-                        #assume 1 slice
-                        n_slices = 1
-                        n_elements = int(len(sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"]["unsorted"])/n_slices)
-                        if self.coil_dict[self.scanner_ID][self.coil_name]["n_elements"] != n_elements:
-                            raise Exception("Incorrect number of elements for " + self.coil_name + str(n_elements) +" calculated")
-                        if self.coil_dict[self.scanner_ID][self.coil_name]["n_slices"] != n_slices:
-                            raise Exception("Incorrect number of slices for " + self.coil_name + str(n_slices) +" calculated")
-                        for  instance_n in sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"]["unsorted"]:
-                            slice_n = 1 
-                            element_n = int(instance_n % n_elements)+1
-                            if slice_n not in sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"].keys():
-                                sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"][slice_n] = {}
-                            dcm = sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"]["unsorted"][instance_n]["dcm"]
-                            
-                            try:
-                                SoS_array = np.add(SoS_array,np.square(dcm.pixel_array.astype(float)))
-                            except UnboundLocalError:
-                                SoS_array = np.square(dcm.pixel_array.astype(float))
-                            
-                            sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"][slice_n][element_n] = sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"]["unsorted"][instance_n]            
-                        del sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"]["unsorted"]
-                        sorted_dcm_dict[acq_date][series_time][acq_time]["Combined"][1]["pixel_array"] = np.sqrt(SoS_array)
-                        del SoS_array
-            
-            
-            
-            return sorted_dcm_dict
-        
-        
-        def Sort_Dicom_Dict_Elition_X_PHT(self, dcm_dict):
-            sorted_dcm_dict={}
-            n_elements = self.coil_dict[self.scanner_ID][self.coil_name]["n_elements"]
-            n_slices = self.coil_dict[self.scanner_ID][self.coil_name]["n_slices"]
-            for path in dcm_dict:
-                dcm = dcm_dict[path]
-                #t1 = Tag(0x7a1103e)
-                t1 = Tag(0x0200013)
-                acquisition_number = dcm[t1].value
-                if dcm.SeriesDate not in sorted_dcm_dict.keys():
-                    sorted_dcm_dict[dcm.SeriesDate] = {}
-                if dcm.SeriesTime not in sorted_dcm_dict[dcm.SeriesDate].keys():
-                    sorted_dcm_dict[dcm.SeriesDate][dcm.SeriesTime] = {}
-                    sorted_dcm_dict[dcm.SeriesDate][dcm.SeriesTime]["unsorted"] = {}
-                   
-                if dcm.ProtocolName[0:6] =="DelRec":
-                    #individual elements
-                    sorted_dcm_dict[dcm.SeriesDate][dcm.SeriesTime]["unsorted"][acquisition_number] = {"path":path, "dcm":dcm}
-                    
-            for acq_date in sorted_dcm_dict:
-                for series_time in sorted_dcm_dict[acq_date]:
-                     #assume 1 slice
-                    n_slices = 1
-                    n_elements = int(len(sorted_dcm_dict[acq_date][series_time]["unsorted"])/(2*n_slices))
-                    if self.coil_dict[self.scanner_ID][self.coil_name]["n_elements"] != n_elements:
-                        raise Exception("Incorrect number of elements for " + self.coil_name + ", " + str(n_elements) +" calculated")
-                    if self.coil_dict[self.scanner_ID][self.coil_name]["n_slices"] != n_slices:
-                        raise Exception("Incorrect number of slices for " + self.coil_name + str(n_slices) +" calculated")
-                    if len(sorted_dcm_dict[acq_date][series_time]["unsorted"]) == 2:
-                        #single element
-                        for image_n in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
-                            sorted_dcm_dict[acq_date][series_time][image_n] = {}
-                            sorted_dcm_dict[acq_date][series_time][image_n]["DelRec"] = {}
-                            sorted_dcm_dict[acq_date][series_time][image_n]["Combined"] = {}
-                            sorted_dcm_dict[acq_date][series_time][image_n]["Combined"][1] = sorted_dcm_dict[dcm.SeriesDate][dcm.SeriesTime]["unsorted"][image_n]
-                            sorted_dcm_dict[acq_date][series_time][image_n]["DelRec"][1] = {}
-                            sorted_dcm_dict[acq_date][series_time][image_n]["DelRec"][1][1] = sorted_dcm_dict[dcm.SeriesDate][dcm.SeriesTime]["unsorted"][image_n]
-                        
-                        del sorted_dcm_dict[acq_date][series_time]["unsorted"]
-                    else:
-                        SoS_arrays = {}
-                        for image_n in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
-                            slice_n = 1 
-                            element_n = int(image_n % n_elements)+1
-                            repeat_n = int((image_n-1)/n_elements)
-                            
-                            if repeat_n not in sorted_dcm_dict[acq_date][series_time].keys():
-                                sorted_dcm_dict[acq_date][series_time][repeat_n] = {}
-                                sorted_dcm_dict[acq_date][series_time][repeat_n]["DelRec"] = {}
-                                sorted_dcm_dict[acq_date][series_time][repeat_n]["Combined"] = {}
-                                sorted_dcm_dict[acq_date][series_time][repeat_n]["DelRec"][1] = {}
-                                sorted_dcm_dict[acq_date][series_time][repeat_n]["Combined"][1] = {}
-                            
-                            sorted_dcm_dict[acq_date][series_time][repeat_n]["DelRec"][1][element_n] = sorted_dcm_dict[acq_date][series_time]["unsorted"][image_n]   
-                            
-                                                            
-                            dcm = sorted_dcm_dict[acq_date][series_time]["unsorted"][image_n]["dcm"]
-                            
-                            try:
-                                SoS_arrays[repeat_n] = np.add(SoS_arrays[repeat_n],np.square(dcm.pixel_array.astype(float)))
-                            except KeyError:
-                                SoS_arrays[repeat_n] = np.square(dcm.pixel_array.astype(float))
-                            
-                            sorted_dcm_dict[acq_date][series_time][repeat_n]["DelRec"][slice_n][element_n] = sorted_dcm_dict[acq_date][series_time]["unsorted"][image_n]            
-                        
-                        for repeat_n in SoS_arrays:
-                            sorted_dcm_dict[acq_date][series_time][repeat_n]["Combined"][1]["pixel_array"] = np.sqrt(SoS_arrays[repeat_n])
-                        del sorted_dcm_dict[acq_date][series_time]["unsorted"]
-                        del SoS_arrays
-            
-            
-            
-            return sorted_dcm_dict
+        def Identify_Coil(self, dcm):
+            """
+            Parameters
+            ----------
+            dcm : DICOM (header only required)
+            Returns
+            -------
+            coil_name : str or None
+                Key of coil_dict for the coil dcm was acquired with.  Found 
+                from the ReceiveCoilName via receive_coil_dict (or directly if 
+                the ReceiveCoilName is a key of coil_dict). None if the coil 
+                can't be identified.
+            """
+            scanner_ID = dcm.DeviceSerialNumber
+            receive_coil_name = getattr(dcm, "ReceiveCoilName", None)
+            if scanner_ID not in self.coil_dict or receive_coil_name is None:
+                return None
+            coil_name = self.receive_coil_dict.get(scanner_ID, {}).get(receive_coil_name, receive_coil_name)
+            if coil_name in self.coil_dict[scanner_ID]:
+                return coil_name
+            return None
         
+        def Get_Expected_Image_Count(self, scanner_ID, coil_name):
+            """
+            Number of SNR images in a complete acquisition of coil_name: 
+            (individual elements + combined images (if the scanner stores 
+            them)) * slices * expected_repeats
+            """
+            coil = self.coil_dict[scanner_ID][coil_name]
+            n_images = coil["n_elements"]
+            if self.scanner_combined_images.get(scanner_ID, True) == True:
+                n_images += 1
+            return n_images*coil["n_slices"]*self.expected_repeats
         
+        def Sort_Dicom_Dict(self, dcm_dict):
+            """Sort dcm_dict with the sort rules for self.scanner_ID (scanner_sort_methods)"""
+            if self.scanner_ID not in self.scanner_sort_methods:
+                raise Exception("No sort method for scanner " + self.scanner_ID)
+            sort_method = self.scanner_sort_methods[self.scanner_ID]
+            if sort_method not in self.sort_rules:
+                raise Exception("No sort rules " + sort_method + " for scanner " + self.scanner_ID)
+            return self.Sort_Dicom_Dict_By_Rules(dcm_dict, self.sort_rules[sort_method])
         
+        def Format_Series_Time(self, series_time, rules):
+            """Series time written as the key of a series (sort_rules "series_time_format")"""
+            if rules["series_time_format"] == "zfill":
+                return str(int(float(series_time))).zfill(6)
+            if rules["series_time_format"] == "int":
+                return str(int(float(series_time)))
+            return series_time
         
-        def Sort_Dicom_Dict_Siemens(self, dcm_dict):
-            #LEGACY SORTING METHOD FOR SIEMENS SCANNERS
-            sorted_dcm_dict={}
-            
-            for path in dcm_dict:
-                dcm = dcm_dict[path]
-                
-                #a=dcm.dir()
-                if dcm.AcquisitionDate not in sorted_dcm_dict.keys():
-                    sorted_dcm_dict[dcm.AcquisitionDate] = {}  
-                """Series times of the Siemens individual elements and combined images are <10ms different. Need to check not already a series with a series time <1 second different """
-                
-                if dcm.SeriesTime not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                    test_time = str(int(dcm.SeriesTime) + 1).zfill(6)
-                    if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                        test_time = str(int(dcm.SeriesTime) - 1).zfill(6)
-                        if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                            series_time = dcm.SeriesTime
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}  
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"] = {}
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["Combined"] = {}
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"]["unsorted"] = {}
-                        else:
-                            series_time = test_time
-                    else:
-                        series_time = test_time
-                else:
-                    series_time = dcm.SeriesTime
-                           
-                
-                #Image Number (InstanceNumber) is slice number
-                if "NORM" in dcm.ImageType._list:
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["Combined"][dcm.InstanceNumber] = {"path":path, "dcm":dcm}
-                else:
-                    #individual elements
-                    if dcm.InstanceNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"]["unsorted"]:
-                        sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"]["unsorted"][dcm.InstanceNumber] = {}
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"]["unsorted"][dcm.InstanceNumber][dcm.ContentTime] = {"path":path, "dcm":dcm}
-     
-                    
-            for acq_date in sorted_dcm_dict:
-                for series_time in sorted_dcm_dict[acq_date]:
-                    n_slices = len(sorted_dcm_dict[acq_date][series_time]["unsorted"]["Combined"])
-                    n_elements = len(sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"]["unsorted"][1])
-                    if self.coil_dict[self.scanner_ID][self.coil_name]["n_elements"] != n_elements:
-                        raise Exception("Incorrect number of elements for " + self.coil_name + str(n_elements) +" calculated")
-                    if self.coil_dict[self.scanner_ID][self.coil_name]["n_slices"] != n_slices:
-                        raise Exception("Incorrect number of slices for " + self.coil_name + str(n_slices) +" calculated")
-                    for  slice_n in sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"]["unsorted"]:
-                        if slice_n not in sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"].keys():
-                            sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"][slice_n] = {}
-                        
-                        acq_times = [*sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"]["unsorted"][slice_n]]
-                        acq_times.sort()
-                        for i in range(len(acq_times)):
-                            acq_time = acq_times[i]
-                            element_n = 1 + i
-                            sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"][slice_n][element_n] = sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"]["unsorted"][slice_n][acq_time]          
-                    del sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"]["unsorted"]
-            
-            for acq_date in sorted_dcm_dict:
-                series_times = list(sorted_dcm_dict[acq_date].keys())
-                series_times.sort()
-                if len(series_times) % 2 != 0:
-                    del series_times[-1]
-                for i in range(len(series_times)):
-                    current_series_time = series_times[i]
-                    if i % 2 == 0:
-                        new_series_time = current_series_time
-                        acq_number = "0"
-                    else:
-                        new_series_time = series_times[i-1]
-                        acq_number = "1"
-                    
-                    sorted_dcm_dict[acq_date][new_series_time][current_series_time] = sorted_dcm_dict[acq_date][current_series_time]["unsorted"]
-                    
-                    if acq_number == "0":
-                        del sorted_dcm_dict[acq_date][current_series_time]["unsorted"]
-                    else:
-                        del sorted_dcm_dict[acq_date][current_series_time]
-            
-            
-            
-            return sorted_dcm_dict
+        def Get_Time_Seconds(self, time):
+            """
+            Seconds since midnight of a DICOM time (HHMMSS.FFFFFF, HHMM or 
+            HH.  Old style HH:MM:SS is accepted)
+            """
+            time = time.strip().replace(":", "")
+            return int(time[0:2])*3600 + int(time[2:4] or 0)*60 + float(time[4:] or 0)
         
-        def Sort_Dicom_Dict_Siemens_Avanto_RBH_PHT(self, dcm_dict):
+        def Cluster_Series_Times(self, series_times, rules):
             """
             Parameters
             ----------
-            dcm_dict : dict
-                Dictionary of dicoms of the form {<path>:<dicom>}
-            
+            series_times : iterable
+                (<date>, <series time>) of the images
+            rules : dict
+                sort_rules of the scanner
             Returns
             -------
-            sorted_dcm_dict : dict
-                Dictionary of dicoms of the form {<Date>:{<Series Time>:
-                {<repeat_number>:{"DelRec":{<Slice number>:{<element number>:
-                                        {"path":<path>, "dcm":<DICOM>}}},
-                                "Combined":{<Slice number>:
-                                        {"path":<path>, "dcm":<DICOM>}}}}}}
+            series_keys : dict
+                {(<date>, <series time>):(<date>, <series key>)} the series 
+                each image belongs to
+            series_order : list
+                (<date>, <series key>) of the series in acquisition order
             
-            Sorts DICOMs exported from RBH Sielems Sola (MR3).  Images are sorted by:
-                -Acquisition Date: all images should be acquired on the same date
-                -Series Time: There should be 2 repeats for each series time.  Each repeat should have corresponding combined and individual element images
-                -Repeat number: should be 2 repeats
-                -Image type: Sorts images into combined("Combined" and individual element images("DelRec")
-                -Slice number:  Legacy from old analysis when multiple slices were acquired per coil.  Now only a single slice is used
-                -Element number:  Only a key for DelRec
-            """
-            #dictionary to be populated
-            sorted_dcm_dict={}
-            for path in dcm_dict:
-                dcm = dcm_dict[path]
-                if dcm.AcquisitionDate not in sorted_dcm_dict.keys():
-                    sorted_dcm_dict[dcm.AcquisitionDate] = {}  
-                """Series times of the Siemens individual elements and combined images are <10ms different. Need to check not already a series with a series time <1 second different """
-                              
-                if dcm.SeriesTime not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                    test_time = str(int(dcm.SeriesTime) + 1).zfill(6)
-                    if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                        test_time = str(int(dcm.SeriesTime) - 1).zfill(6)
-                        if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                            series_time = dcm.SeriesTime
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}  
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
-                        else:
-                            series_time = test_time
-                    else:
-                        series_time = test_time
-                else:
-                    series_time = dcm.SeriesTime
-                
-                
-                
-                if series_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
-                    
-                if dcm.SeriesNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]:
-                    #seperate uncombined and combined by series number
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber] = {}
-                if dcm.InstanceNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber]:
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {}
-                
-                #Initially sort DICOMS by Series Number and Instance number 
-                #these are used to assess if the acquisition is a combined acquisition/ delrec
-                #and what the element number is
-                
-                
-                if dcm.InstanceCreationTime not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber]:
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber][dcm.InstanceCreationTime] = {}
-                
-                sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber][dcm.InstanceCreationTime] = {"path":path, "dcm":dcm}
-                
-     
-            n_elements = self.coil_dict[self.scanner_ID][self.coil_name]["n_elements"]
-            n_slices = self.coil_dict[self.scanner_ID][self.coil_name]["n_slices"]
-            for acq_date in sorted_dcm_dict:
-                for series_time in sorted_dcm_dict[acq_date]:
-                    for series_number in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
-                        repeat_ns=list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number].keys())
-                        if len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_ns[0]]) == n_slices:
-                            #combined_elements_image
-                            image_type = "Combined"
-                            for repeat_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
-                                repeat_number_int = int(repeat_number)
-                                if repeat_number_int not in sorted_dcm_dict[acq_date][series_time]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int] = {}
-                                if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number_int]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type] = {}
-                                    #1 slice
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = {}
-                                instance_times = list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number].keys())
-                                if len(instance_times) != 1:
-                                    print("Sort Failed")
-                                sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number][instance_times[0]]
-                        elif len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_ns[0]]) == n_slices*n_elements:
-                            #number of del rec images is elements*slices*2   
-                            #individual_elements_image
-                            image_type = "DelRec"
-                            
-                            for repeat_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
-                                repeat_number_int = int(repeat_number)
-                                if repeat_number_int not in sorted_dcm_dict[acq_date][series_time]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int] = {}
-                                if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number_int]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type] = {}
-                                    #1 slice
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = {}
-                                
-                                instance_times = sorted(list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number].keys()),key=float)
-                                for instance_time in instance_times:
-                                    element_number = instance_times.index(instance_time)+1
-                                    if element_number not in sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1]:
-                                        sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = {}
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number][instance_time]
-                   
-                    del sorted_dcm_dict[acq_date][series_time]["unsorted"]            
-            return sorted_dcm_dict
+            Individual element and combined images are saved as separate 
+            series a fraction of a second apart.  The times are sorted and 
+            grouped in one sweep: a time more than rules["series_tolerance"] 
+            seconds after the first time of the current series starts a new 
+            series.  The date and (formatted) time of the first image of a 
+            series are used as its key so series which cross midnight are kept 
+            together.
+            
+            Dates and times which can't be parsed (e.g. emptied by 
+            anonymisation) can't be clustered: each distinct (<date>, <series 
+            time>) is kept as a series of its own, keyed by the values as they 
+            are in the DICOM, after the series which could be clustered.
+            """
+            tolerance = rules["series_tolerance"]
+            series_times = set(series_times)
+            #seconds from 0001-01-01 to the start of each date. None = date can't be parsed
+            date_seconds = {}
+            for date in set([date for date, series_time in series_times]):
+                try:
+                    date_seconds[date] = datetime.date(int(date[0:4]), int(date[4:6]), int(date[6:8])).toordinal()*86400
+                except (ValueError, TypeError):
+                    date_seconds[date] = None
+            sorted_times = []
+            unparsed_times = []
+            for date, series_time in series_times:
+                try:
+                    sorted_times.append((date_seconds[date] + self.Get_Time_Seconds(series_time), date, series_time))
+                except (ValueError, TypeError, AttributeError):
+                    unparsed_times.append((date, series_time))
+            sorted_times.sort()
+            series_keys = {}
+            series_order = []
+            series_start = None
+            for seconds, date, series_time in sorted_times:
+                if series_start is None or seconds - series_start > tolerance:
+                    series_start = seconds
+                    series_key = (date, self.Format_Series_Time(series_time, rules))
+                    series_order.append(series_key)
+                series_keys[(date, series_time)] = series_key
+            for date, series_time in sorted(unparsed_times, key=str):
+                print("Date/ series time " + repr(date) + " " + repr(series_time) + " can't be parsed: sorted as a series on its own")
+                series_keys[(date, series_time)] = (date, series_time)
+                series_order.append((date, series_time))
+            return series_keys, series_order
         
-        def Sort_Dicom_Dict_Siemens_Avanto_DCH(self, dcm_dict):
+        def Get_Sort_Tags(self, rules):
+            """Tags read from each header by Sort_Dicom_Dict_By_Rules"""
+            sort_tags = [rules["date"], rules["series_time"]] + rules["group_by"]
+            if rules["select"] is not None:
+                sort_tags.append(rules["select"][0])
+            if rules["image_type"] == "NORM":
+                sort_tags.append("ImageType")
+            if rules["slice"] is not None:
+                sort_tags.append(rules["slice"])
+            if rules["element"] == "rank":
+                sort_tags.append(rules["rank_tag"])
+            if rules["element"] in ["instance_modulo", "instance_cycle"] or "instance_block" in rules["repeat"].values():
+                sort_tags.append("InstanceNumber")
+            for repeat_rule in rules["repeat"].values():
+                if repeat_rule not in ["series", "instance_block"]:
+                    sort_tags.append(repeat_rule)
+            return list(dict.fromkeys(sort_tags))
+        
+        def Get_Image_Type(self, images, rules, n_elements, n_slices):
             """
-            Parameters
-            ----------
-            dcm_dict : dict
-                Dictionary of dicoms of the form {<path>:<dicom>}
-            
-            Returns
-            -------
-            sorted_dcm_dict : dict
-                Dictionary of dicoms of the form {<Date>:{<Series Time>:
-                {<repeat_number>:{"DelRec":{<Slice number>:{<element number>:
-                                        {"path":<path>, "dcm":<DICOM>}}},
-                                "Combined":{<Slice number>:
-                                        {"path":<path>, "dcm":<DICOM>}}}}}}
-            
-            Sorts DICOMs exported from RBH Sielems Sola (MR3).  Images are sorted by:
-                -Acquisition Date: all images should be acquired on the same date
-                -Series Time: There should be 2 repeats for each series time.  Each repeat should have corresponding combined and individual element images
-                -Repeat number: should be 2 repeats
-                -Image type: Sorts images into combined("Combined" and individual element images("DelRec")
-                -Slice number:  Legacy from old analysis when multiple slices were acquired per coil.  Now only a single slice is used
-                -Element number:  Only a key for DelRec
-            """
-            #dictionary to be populated
-            sorted_dcm_dict={}
-            for path in dcm_dict:
-                dcm = dcm_dict[path]
-                if dcm.AcquisitionDate not in sorted_dcm_dict.keys():
-                    sorted_dcm_dict[dcm.AcquisitionDate] = {}  
-                """Series times of the Siemens individual elements and combined images are <10ms different. Need to check not already a series with a series time <1 second different """
-                              
-                if str(int(float(dcm.SeriesTime))).zfill(6) not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                    test_time = str(int(float(dcm.SeriesTime)) + 1).zfill(6)
-                    if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                        test_time = str(int(float(dcm.SeriesTime)) - 1).zfill(6)
-                        if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                            series_time = str(int(float(dcm.SeriesTime))).zfill(6)
-                        else:
-                            series_time = test_time
-                    else:
-                        series_time = test_time
-                else:
-                    series_time = str(int(float(dcm.SeriesTime))).zfill(6)
-                
-                
-                
-                if series_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
-                    
-                if dcm.SeriesNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]:
-                    #seperate uncombined and combined by series number
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber] = {}
-                if dcm.InstanceNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber]:
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {}
-                
-                #Initially sort DICOMS by Series Number and Instance number 
-                #these are used to assess if the acquisition is a combined acquisition/ delrec
-                #and what the element number is
-                
-                
-                if dcm.InstanceCreationTime not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber]:
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber][dcm.InstanceCreationTime] = {}
-                
-                sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber][dcm.InstanceCreationTime] = {"path":path, "dcm":dcm}
-                
-     
-            n_elements = self.coil_dict[self.scanner_ID][self.coil_name]["n_elements"]
-            n_slices = self.coil_dict[self.scanner_ID][self.coil_name]["n_slices"]
-            for acq_date in sorted_dcm_dict:
-                for series_time in sorted_dcm_dict[acq_date]:
-                    for series_number in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
-                        repeat_ns=list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number].keys())
-                        if len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_ns[0]]) == n_slices:
-                            #combined_elements_image
-                            image_type = "Combined"
-                            for repeat_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
-                                repeat_number_int = int(repeat_number)
-                                if repeat_number_int not in sorted_dcm_dict[acq_date][series_time]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int] = {}
-                                if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number_int]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type] = {}
-                                    #1 slice
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = {}
-                                instance_times = list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number].keys())
-                                if len(instance_times) != 1:
-                                    print("Sort Failed")
-                                sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number][instance_times[0]]
-                        elif len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_ns[0]]) == n_slices*n_elements:
-                            #number of del rec images is elements*slices*2   
-                            #individual_elements_image
-                            image_type = "DelRec"
-                            
-                            for repeat_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
-                                repeat_number_int = int(repeat_number)
-                                if repeat_number_int not in sorted_dcm_dict[acq_date][series_time]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int] = {}
-                                if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number_int]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type] = {}
-                                    #1 slice
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = {}
-                                
-                                instance_times = sorted(list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number].keys()),key=float)
-                                for instance_time in instance_times:
-                                    element_number = instance_times.index(instance_time)+1
-                                    if element_number not in sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1]:
-                                        sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = {}
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number][instance_time]
-                   
-                    del sorted_dcm_dict[acq_date][series_time]["unsorted"]            
-            return sorted_dcm_dict
-
+            Returns the image type ("Combined"/ "DelRec") of each of images 
+            (a group of [(<path>, <dicom>, <tags>)] from the same series).  
+            For rules["image_type"] == "count" the whole group has one type, 
+            or None if the number of images doesn't match the coil.
+            """
+            if rules["image_type"] == "DelRec":
+                return ["DelRec"]*len(images)
+            if rules["image_type"] == "NORM":
+                return ["Combined" if "NORM" in tags["ImageType"] else "DelRec" for path, dcm, tags in images]
+            if rules["count_per"] == "repeat":
+                repeat_tag = rules["repeat"]["Combined"]
+                first_repeat = images[0][2][repeat_tag]
+                n_images = sum([1 for path, dcm, tags in images if tags[repeat_tag] == first_repeat])
+            else:
+                n_images = len(images)
+            count_factor = rules["count_factor"]
+            if count_factor == "expected_repeats":
+                count_factor = self.expected_repeats
+            if n_images == n_slices*count_factor:
+                return ["Combined"]*len(images)
+            if n_images == n_slices*n_elements*count_factor:
+                return ["DelRec"]*len(images)
+            return [None]*len(images)
+        
+        def Get_Repeat(self, tags, repeat_rule, series_key, rules, n_elements):
+            """Repeat key of an image with the header values tags (see sort_rules "repeat")"""
+            if repeat_rule == "series":
+                return series_key
+            if repeat_rule == "instance_block":
+                if n_elements == 1:
+                    #single element coils: each image is a repeat
+                    return tags["InstanceNumber"]
+                return int((tags["InstanceNumber"]-1)/n_elements) + rules["repeat_start"]
+            return tags[repeat_rule]
         
-        def Sort_Dicom_Dict_Siemens_Sola_RBH(self, dcm_dict):
+        def Sort_Dicom_Dict_By_Rules(self, dcm_dict, rules):
             """
             Parameters
             ----------
             dcm_dict : dict
                 Dictionary of dicoms of the form {<path>:<dicom>}
+            rules : dict
+                Value of sort_rules for the scanner
             
             Returns
             -------
@@ -708,221 +1648,161 @@ class main:
                                         {"path":<path>, "dcm":<DICOM>}}},
                                 "Combined":{<Slice number>:
                                         {"path":<path>, "dcm":<DICOM>}}}}}}
+                Calculated combined images are {"pixel_array":<array>}
             
-            Sorts DICOMs exported from RBH Sielems Sola (MR3).  Images are sorted by:
-                -Acquisition Date: all images should be acquired on the same date
-                -Series Time: There should be 2 repeats for each series time.  Each repeat should have corresponding combined and individual element images
-                -Repeat number: should be 2 repeats
-                -Image type: Sorts images into combined("Combined" and individual element images("DelRec")
-                -Slice number:  Legacy from old analysis when multiple slices were acquired per coil.  Now only a single slice is used
-                -Element number:  Only a key for DelRec
-            """
-            #dictionary to be populated
-            sorted_dcm_dict={}
-            for path in dcm_dict:
-                dcm = dcm_dict[path]
-                
-                #a=dcm.dir()
-                if dcm.AcquisitionDate not in sorted_dcm_dict.keys():
-                    sorted_dcm_dict[dcm.AcquisitionDate] = {}  
-                """Series times of the Siemens individual elements and combined images are <10ms different. Need to check not already a series with a series time <1 second different """
-                              
-                if dcm.SeriesTime not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                    test_time = str(int(dcm.SeriesTime) + 1).zfill(6)
-                    if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                        test_time = str(int(dcm.SeriesTime) - 1).zfill(6)
-                        if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                            series_time = dcm.SeriesTime
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}  
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"] = {}
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["Combined"] = {}
-                            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"]["unsorted"] = {}
-                        else:
-                            series_time = test_time
-                    else:
-                        series_time = test_time
-                else:
-                    series_time = dcm.SeriesTime
-                
-                
-                
-                if series_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
-                    
-                if dcm.SeriesNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]:
-                    #seperate uncombined and combined by series number
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber] = {}
-                if dcm.InstanceNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber]:
-                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {}
-                
-                #Initially sort DICOMS by Series Number and Instance number 
-                #these are used to assess if the acquisition is a combined acquisition/ delrec
-                #and what the element number is
-                sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {"path":path, "dcm":dcm}
-                
-     
+            Replaces the Sort_Dicom_Dict_* methods.  The tags used for 
+            sorting are read from each header once and the images are grouped 
+            by date, series and rules["group_by"].  The image type, repeat, 
+            slice and element of each image are then found for each group and 
+            the images are added to sorted_dcm_dict.
+            """
             n_elements = self.coil_dict[self.scanner_ID][self.coil_name]["n_elements"]
             n_slices = self.coil_dict[self.scanner_ID][self.coil_name]["n_slices"]
-            for acq_date in sorted_dcm_dict:
-                for series_time in sorted_dcm_dict[acq_date]:
-                    for series_number in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
-                        if len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]) == 2*n_slices:
-                            #combined_elements_image
-                            image_type = "Combined"
-                            for image_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
-                                repeat_number = int(image_number)
-                                if repeat_number not in sorted_dcm_dict[acq_date][series_time]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number] = {}
-                                if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type] = {}
-                                    #1 slice
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = {}
-                                sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][image_number]
-                        elif len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]) == 2*n_slices*n_elements:
-                            #number of del rec images is elements*slices*2   
-                            #individual_elements_image
-                            image_type = "DelRec"
-                            
-                            for image_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
-                                
-                                element_number = image_number % n_elements
-                                if element_number == 0:
-                                    element_number = n_elements
-                                if element_number == image_number:
-                                    repeat_number = 1
-                                else:
-                                    repeat_number = 2
-                                if repeat_number not in sorted_dcm_dict[acq_date][series_time]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number] = {}
-                                if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type] = {}
-                                    #1 slice
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = {}
-                                if element_number not in sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = {}
-                                sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][image_number]
-                   
-                    del sorted_dcm_dict[acq_date][series_time]["unsorted"]            
-            return sorted_dcm_dict
-
-        def Sort_Dicom_Dict_Siemens_Sola_DCH(self, dcm_dict):
-            """
-            Parameters
-            ----------
-            dcm_dict : dict
-                Dictionary of dicoms of the form {<path>:<dicom>}
+            sort_tags = self.Get_Sort_Tags(rules)
             
-            Returns
-            -------
-            sorted_dcm_dict : dict
-                Dictionary of dicoms of the form {<Date>:{<Series Time>:
-                {<repeat_number>:{"DelRec":{<Slice number>:{<element number>:
-                                        {"path":<path>, "dcm":<DICOM>}}},
-                                "Combined":{<Slice number>:
-                                        {"path":<path>, "dcm":<DICOM>}}}}}}
+            #[(<path>, <dicom>, {<tag>:<value>})]
+            images = []
+            for path, dcm in dcm_dict.items():
+                tags = {tag:getattr(dcm, tag) for tag in sort_tags}
+                if rules["select"] is not None:
+                    select_tag, prefix = rules["select"]
+                    if not tags[select_tag].startswith(prefix):
+                        continue
+                images.append((path, dcm, tags))
+            series_keys, series_order = self.Cluster_Series_Times(
+                [(tags[rules["date"]], tags[rules["series_time"]]) for path, dcm, tags in images], rules)
             
-            Sorts DICOMs exported from DCH Sielems Sola (MR2).  Images are sorted by:
-                -Acquisition Date: all images should be acquired on the same date
-                -Series Time: There should be 2 repeats for each series time.  Each repeat should have corresponding combined and individual element images
-                -Repeat number: should be 2 repeats
-                -Image type: Sorts images into combined("Combined" and individual element images("DelRec")
-                -Slice number:  Legacy from old analysis when multiple slices were acquired per coil.  Now only a single slice is used
-                -Element number:  Only a key for DelRec
-            """
-            sorted_dcm_dict={}
+            #group the images: {(<date>, <series key>, <group>):[(<path>, <dicom>, {<tag>:<value>})]}
+            groups = {}
+            for path, dcm, tags in images:
+                date, series_key = series_keys[(tags[rules["date"]], tags[rules["series_time"]])]
+                group_key = (date, series_key, tuple([tags[tag] for tag in rules["group_by"]]))
+                if group_key not in groups:
+                    groups[group_key] = []
+                groups[group_key].append((path, dcm, tags))
             
-            for path in dcm_dict:
-                dcm = dcm_dict[path]
-                
-                
-                if dcm.SeriesDate not in sorted_dcm_dict.keys():
-                    sorted_dcm_dict[dcm.SeriesDate] = {}  
-                """Series times of the Siemens individual elements and combined images are <10ms different. Need to check not already a series with a series time <1 second different """
-                
-                #a=dcm.dir("")
-                #print(dcm)
-                
-                if str(int(float(dcm.SeriesTime))) not in sorted_dcm_dict[dcm.SeriesDate].keys():
-                    test_time = str(int(float(dcm.SeriesTime)) + 1)
-                    if test_time not in sorted_dcm_dict[dcm.SeriesDate].keys():
-                        test_time = str(int(float(dcm.SeriesTime)) - 1)
-                        if test_time not in sorted_dcm_dict[dcm.SeriesDate].keys():
-                            series_time = str(int(float(dcm.SeriesTime)))
-                            sorted_dcm_dict[dcm.SeriesDate][series_time] = {}  
-                            sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"] = {}
-                            sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"]["DelRec"] = {}
-                            sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"]["Combined"] = {}
-                            sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"]["DelRec"]["unsorted"] = {}
-                        else:
-                            series_time = test_time
-                    else:
-                        series_time = test_time
+            #series stored as one series per repeat: {(<date>, <series key>):<key of first series of the pair>}
+            paired_series = {}
+            if rules["pair_series"] == True:
+                series_dates = {}
+                for date, series_key in series_order:
+                    if date not in series_dates:
+                        series_dates[date] = []
+                    series_dates[date].append(series_key)
+                for date, dated_series in series_dates.items():
+                    #an unpaired series can't be used
+                    for i in range(0, len(dated_series)-1, 2):
+                        paired_series[(date, dated_series[i])] = dated_series[i]
+                        paired_series[(date, dated_series[i+1])] = dated_series[i]
+            
+            #[(<date>, <series key>, <repeat>, <image type>, <slice>, <element>, <path>, <dicom>)]
+            rows = []
+            for (date, series_key, group), images in groups.items():
+                if rules["pair_series"] == True:
+                    if (date, series_key) not in paired_series:
+                        print("Series " + date + " " + series_key + " has no repeat: ignored")
+                        continue
+                    sorted_series_key = paired_series[(date, series_key)]
                 else:
-                    series_time = str(int(float(dcm.SeriesTime)))
-                
-                
-                
-                if series_time not in sorted_dcm_dict[dcm.SeriesDate].keys():
-                    sorted_dcm_dict[dcm.SeriesDate][series_time] = {}
-                    sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"] = {}
-                    
-                if dcm.SeriesNumber not in sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"]:
-                    #seperate uncombined and combined by series number
-                    sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"][dcm.SeriesNumber] = {}
-                if dcm.InstanceNumber not in sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"][dcm.SeriesNumber]:
-                    sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {}
-                #Initially sort DICOMS by Series Number and Instance number 
-                #these are used to assess if the acquisition is a combined acquisition/ delrec
-                #and what the element number is
-                sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {"path":path, "dcm":dcm}
-                
-     
-            n_elements = self.coil_dict[self.scanner_ID][self.coil_name]["n_elements"]
-            n_slices = self.coil_dict[self.scanner_ID][self.coil_name]["n_slices"]
-            for acq_date in sorted_dcm_dict:
-                for series_time in sorted_dcm_dict[acq_date]:
-                    for series_number in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
-                        if len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]) == 2*n_slices:
-                            #combined_elements_image
-                            image_type = "Combined"
-                            for image_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
-                                repeat_number = int(image_number)
-                                if repeat_number not in sorted_dcm_dict[acq_date][series_time]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number] = {}
-                                if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type] = {}
-                                    #1 slice
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = {}
-                                sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][image_number]
-                        elif len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]) == 2*n_slices*n_elements:
-                            #number of del rec images is elements*slices*2   
-                            #individual_elements_image
-                            image_type = "DelRec"
-                            
-                            for image_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
-                                
-                                element_number = image_number % n_elements
-                                if element_number == 0:
-                                    element_number = n_elements
-                                if element_number == image_number:
-                                    repeat_number = 1
-                                else:
-                                    repeat_number = 2
-                                if repeat_number not in sorted_dcm_dict[acq_date][series_time]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number] = {}
-                                if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type] = {}
-                                    #1 slice
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = {}
-                                if element_number not in sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1]:
-                                    sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = {}
-                                sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][image_number]
-                   
-                    del sorted_dcm_dict[acq_date][series_time]["unsorted"]            
+                    sorted_series_key = series_key
+                image_types = self.Get_Image_Type(images, rules, n_elements, n_slices)
+                #{(<repeat>, <slice>):[(<rank tag value>, <row>)]}
+                ranked = {}
+                for (path, dcm, tags), image_type in zip(images, image_types):
+                    if image_type is None:
+                        continue
+                    repeat = self.Get_Repeat(tags, rules["repeat"][image_type], series_key, rules, n_elements)
+                    slice_n = 1 if rules["slice"] is None else tags[rules["slice"]]
+                    if image_type == "Combined":
+                        rows.append((date, sorted_series_key, repeat, image_type, slice_n, None, path, dcm))
+                    elif rules["element"] == "instance_modulo":
+                        element_n = int(tags["InstanceNumber"] % n_elements)+1
+                        rows.append((date, sorted_series_key, repeat, image_type, slice_n, element_n, path, dcm))
+                    elif rules["element"] == "instance_cycle":
+                        element_n = int((tags["InstanceNumber"]-1) % n_elements)+1
+                        rows.append((date, sorted_series_key, repeat, image_type, slice_n, element_n, path, dcm))
+                    else:
+                        rank_value = tags[rules["rank_tag"]]
+                        if rules["rank_as_float"] == True:
+                            rank_value = float(rank_value)
+                        if (repeat, slice_n) not in ranked:
+                            ranked[(repeat, slice_n)] = []
+                        ranked[(repeat, slice_n)].append((rank_value, (date, sorted_series_key, repeat, image_type, slice_n, path, dcm)))
+                #element number = order of the rank tag
+                for rank_rows in ranked.values():
+                    rank_rows.sort(key=lambda rank_row: rank_row[0])
+                    for element_n, (rank_value, row) in enumerate(rank_rows, start=1):
+                        rows.append(row[:5] + (element_n,) + row[5:])
+            
+            #combined and individual element images of a repeat are found together (NORM) or 
+            #in separate groups (the image type of the first group found is created first)
+            image_type_order = ["DelRec", "Combined"] if rules["image_type"] == "NORM" else []
+            sorted_dcm_dict = {}
+            if rules["pair_series"] == True:
+                #keep the repeats in acquisition order
+                for (date, series_key), sorted_series_key in paired_series.items():
+                    repeats = sorted_dcm_dict.setdefault(date, {}).setdefault(sorted_series_key, {})
+                    repeats[series_key] = {image_type:{} for image_type in image_type_order}
+            for date, series_key, repeat, image_type, slice_n, element_n, path, dcm in rows:
+                repeats = sorted_dcm_dict.setdefault(date, {}).setdefault(series_key, {})
+                if repeat not in repeats:
+                    repeats[repeat] = {image_type:{} for image_type in image_type_order}
+                if image_type == "Combined":
+                    repeats[repeat].setdefault("Combined", {})[slice_n] = {"path":path, "dcm":dcm}
+                else:
+                    repeats[repeat].setdefault("DelRec", {}).setdefault(slice_n, {})[element_n] = {"path":path, "dcm":dcm}
+            
+            for date in sorted_dcm_dict:
+                for series_key in sorted_dcm_dict[date]:
+                    for repeat in sorted_dcm_dict[date][series_key].values():
+                        if rules["check_counts"] == True:
+                            delrec = repeat.get("DelRec", {})
+                            if len(delrec) != n_slices:
+                                raise Exception("Incorrect number of slices for " + self.coil_name + ", " + str(len(delrec)) +" calculated")
+                            for slice_n in delrec:
+                                if len(delrec[slice_n]) != n_elements:
+                                    raise Exception("Incorrect number of elements for " + self.coil_name + ", " + str(len(delrec[slice_n])) +" calculated")
+                        if rules["combined"] == "sum_of_squares":
+                            repeat["Combined"] = {}
+                            for slice_n, elements in repeat.get("DelRec", {}).items():
+                                if n_elements == 1:
+                                    #single element: the combined image is the element image
+                                    repeat["Combined"][slice_n] = elements[1]
+                                    continue
+                                element_dcms = [element["dcm"] for element in elements.values()]
+                                repeat["Combined"][slice_n] = {"pixel_array":self.Combine_Sum_Of_Squares(element_dcms)}
             return sorted_dcm_dict
-     
+        
+        def Combine_Sum_Of_Squares(self, element_dcms):
+            """
+            Parameters
+            ----------
+            element_dcms : list
+                DICOMs (or dicom_handles) of the individual elements of one 
+                slice of a repeat
+            Returns
+            -------
+            combined_array : np.ndarray
+                Square root of the sum of the squares of the element images 
+                (dtype sum_of_squares_dtype)
+            
+            One accumulator is allocated and each element is squared into a 
+            reused buffer and added in place.  Elements are streamed: a 
+            dicom_handle is released once it has been added so only one 
+            decoded element is held at a time.
+            """
+            combined_array = None
+            for dcm in element_dcms:
+                pixel_array = dcm.pixel_array
+                if combined_array is None:
+                    combined_array = np.zeros(pixel_array.shape, dtype=self.sum_of_squares_dtype)
+                    squared_array = np.empty_like(combined_array)
+                np.square(pixel_array, out=squared_array, dtype=self.sum_of_squares_dtype)
+                np.add(combined_array, squared_array, out=combined_array)
+                if isinstance(dcm, main.dicom_handle):
+                    dcm.Release()
+            np.sqrt(combined_array, out=combined_array)
+            return combined_array
         
         def Initialise_Directory(self, path):
             """
@@ -955,7 +1835,10 @@ class main:
             self.new_path = os.path.join(target_directory, new_name)                                    
             if not os.path.exists(self.new_path):
                 self.Initialise_Directory(target_directory)
-                shutil.copyfile(current_path, self.new_path)
+                #current_path may be a member of a zip/ tar export
+                with main.dicom_source.Open(current_path) as current_file:
+                    with open(self.new_path, "wb") as new_file:
+                        shutil.copyfileobj(current_file, new_file)
         
         def Archive_Images(self, dcm_dict, archive_root):
             """
@@ -1049,12 +1932,12 @@ class main:
                             self.Initialise_Directory(target_directory)         
                             for slice_n in dcm_dict[acq_date][series_time][acq_time][img_type]:
                                 if img_type == "DelRec":
-                                    for element_n in dcm_dict[acq_date][series_time][acq_time][img_type][slice_n]:
-                                        dcm = dcm_dict[acq_date][series_time][acq_time][img_type][slice_n][element_n]["dcm"]
+                                    #rescale all the elements at once
+                                    stack = main.element_stack.From_Dict(dcm_dict[acq_date][series_time][acq_time][img_type][slice_n])
+                                    for element_n, image_2d_scaled in zip(stack.element_ns, stack.To_Uint8()):
                                         #file name of png to be produced
-                                        dcm_array = dcm.pixel_array.astype(float)
                                         new_name = "slice_" + str(slice_n) + "_element_" + str(element_n) + ".png"
-                                        self.Convert_to_PNG(dcm_array, target_directory, new_name)
+                                        cv2.imwrite(os.path.join(target_directory, new_name), image_2d_scaled)
                                          
                                 else:
                                     try:
@@ -1083,6 +1966,104 @@ class main:
             self.excel_export = messagebox.askyesno("Export to Excel?")   
     
             
+    class watershed_cache:
+        """
+        Least recently used cache of the masks produced by 
+        initialise_masks.Watershed_Mask for one image, keyed by the 
+        (lower, upper) thresholds.  While the user reviews a mask the masks 
+        of the neighbouring thresholds are produced in a background thread 
+        (Precompute) so adjusting the thresholds is answered from the cache.
+        """
+        def __init__(self, masks, dcm_filtered, max_int, max_entries=64, n_workers=1):
+            """
+            Parameters
+            ----------
+            masks : initialise_masks
+                Provides Watershed_Mask
+            dcm_filtered : np array
+                Smoothed combined image
+            max_int : number
+                Maximum intensity of the combined image
+            max_entries : int
+                Number of masks kept
+            n_workers : int
+                Number of threads producing masks in the background
+            """
+            self.masks = masks
+            self.dcm_filtered = dcm_filtered
+            self.max_int = max_int
+            self.max_entries = max_entries
+            self.entries = OrderedDict()
+            self.lock = threading.Lock()
+            self.pool = ThreadPoolExecutor(max_workers=n_workers)
+            #{<thresholds>: <future>} of masks queued or being produced in the background
+            self.pending = {}
+            self.hits = 0
+            self.misses = 0
+        
+        def Key(self, lower_threshold, upper_threshold):
+            #thresholds from the sliders aren't exact multiples of the step
+            return (round(lower_threshold, 6), round(upper_threshold, 6))
+        
+        def Add(self, key, img_mask):
+            with self.lock:
+                self.entries[key] = img_mask
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        
+        def Produce(self, key):
+            with self.lock:
+                if key in self.entries:
+                    return self.entries[key]
+            img_mask = self.masks.Watershed_Mask(self.dcm_filtered, self.max_int, *key)
+            self.Add(key, img_mask)
+            return img_mask
+        
+        def Get(self, lower_threshold, upper_threshold):
+            """Mask for the thresholds: from the cache, the background thread or produced now"""
+            key = self.Key(lower_threshold, upper_threshold)
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key]
+                self.misses += 1
+                future = self.pending.get(key)
+            if future is not None and future.cancel() == False:
+                #already being produced
+                return future.result()
+            return self.Produce(key)
+        
+        def Precompute(self, lower_threshold, upper_threshold, step, n_steps=2, maximum=1):
+            """
+            Queue the masks of the thresholds up to n_steps steps from 
+            (lower_threshold, upper_threshold), nearest first.  Masks queued 
+            for previous thresholds which haven't been started are cancelled.
+            """
+            neighbours = []
+            for i in range(-n_steps, n_steps+1):
+                for j in range(-n_steps, n_steps+1):
+                    lower = lower_threshold + i*step
+                    upper = upper_threshold + j*step
+                    if (i, j) != (0, 0) and 0 <= lower <= maximum and 0 <= upper <= maximum:
+                        neighbours.append((abs(i) + abs(j), self.Key(lower, upper)))
+            with self.lock:
+                for key, future in list(self.pending.items()):
+                    if future.done() or future.cancel():
+                        del self.pending[key]
+                for distance, key in sorted(neighbours):
+                    if key not in self.entries and key not in self.pending:
+                        self.pending[key] = self.pool.submit(self.Produce, key)
+        
+        def Close(self):
+            """Cancel the masks queued and stop the background thread"""
+            with self.lock:
+                for future in self.pending.values():
+                    future.cancel()
+                self.pending = {}
+            self.pool.shutdown(wait=False)
+    
     class initialise_masks:
         """
         Assumption made that all images selected are in the same location
@@ -1096,10 +2077,72 @@ class main:
         """
         #low pass filter used to smooth  out noise in image
         low_pass_filter = np.array([[1,2,1],[2,4,2],[1,2,1]])/16
-        def __init__(self, dcm_dict, lower_threshold=0.1, upper_threshold=0.1):
+        #pixels the accepted mask is contracted by to produce the phantom mask
+        phantom_margin = 4
+        #pixels the inverted accepted mask is contracted by to produce the air mask
+        air_margin = 5
+        #shape masks are contracted/ expanded with: "square" (the same as contracting 
+        #1 pixel at a time in all 8 directions), "disk" or a 2D array of 0/1
+        structuring_element = "square"
+        #directory the accepted masks are stored in (one per scanner, coil and 
+        #image matrix) so they can be reused (per user by default, or shared 
+        #e.g. "S:/mask_cache"). None = masks aren't stored
+        mask_cache_directory = os.path.join(os.path.expanduser("~"), ".rf_coil_qc", "mask_cache")
+        #minimum overlap (Dice coefficient) of a re-aligned cached mask and the 
+        #mask produced with its thresholds for the cached mask to be reused
+        mask_overlap_threshold = 0.9
+        #if True the mask is chosen automatically from a grid of thresholds 
+        #around the coil defaults (Auto_Mask) and only shown to the user if 
+        #its score is below auto_accept_confidence
+        auto_accept = True
+        auto_accept_confidence = 0.8
+        #limits of the measures a mask is scored on (Score_Mask) {<measure>:(<fail>, <pass>)}: 
+        #a measure at the pass limit (or better) scores 1, at the fail limit (or worse) 0 
+        #and linearly in between
+        #   "compactness": area/ area of the convex hull (fragmented or leaked masks are lower)
+        #   "holes": area of the holes/ area inside the outline of the mask
+        #   "stability": largest fractional change in area to the masks produced with the 
+        #       adjacent thresholds in the grid
+        #   "size": fractional difference of the area to the expected area (cached mask)
+        #   "border": fraction of the edge of the image in the mask (the phantom should be 
+        #       surrounded by air)
+        mask_score_limits = {"compactness":(0.6, 0.9), "holes":(0.1, 0.01), "stability":(0.3, 0.05), 
+                             "size":(0.4, 0.1), "border":(0.1, 0.01)}
+        #factors the default lower/ upper thresholds are multiplied by to produce the grid of thresholds
+        threshold_grid_factors = [0.5, 0.75, 1, 1.5, 2]
+        #mask review window: longest side of the image (pixels), colour (RGB) 
+        #and opacity of the mask, maximum of the threshold sliders and the 
+        #time the sliders must be still for before the mask is redrawn
+        display_size = 600
+        mask_colour = (255, 0, 255)
+        mask_alpha = 0.35
+        threshold_slider_max = 0.5
+        redraw_delay_ms = 30
+        #step of the threshold sliders.  While the mask is reviewed the masks 
+        #up to precompute_steps steps from the thresholds shown are produced 
+        #in the background (watershed_cache)
+        threshold_step = 0.005
+        precompute_steps = 2
+        def __init__(self, dcm_dict, lower_threshold=0.1, upper_threshold=0.1, interactive=True, 
+                     scanner_ID=None, coil_name=None):
+            """
+            Parameters
+            ----------
+            interactive : bool
+                If False the mask produced with the thresholds given is 
+                accepted without asking the user (headless mode).  If 
+                auto_accept is True a mask scoring below auto_accept_confidence 
+                raises an exception instead (Get_Masks)
+            scanner_ID, coil_name : str
+                Used to find the mask previously accepted for the scanner and 
+                coil (mask_cache_directory).  None = no mask cache
+            """
             self.mask_dict = {}
             self.lower_threshold = lower_threshold
             self.upper_threshold = upper_threshold
+            self.interactive = interactive
+            self.scanner_ID = scanner_ID
+            self.coil_name = coil_name
             
             #combined image required for generating mask: loop through dictionary to find one
             for acq_date in dcm_dict:
@@ -1109,61 +2152,172 @@ class main:
                             if slice_n not in self.mask_dict.keys():
                                 self.mask_dict[slice_n] = {}
                             if self.mask_dict[slice_n]=={}:
-                                try:
-                                    #image to establish mask from
-                                    dcm = dcm_dict[acq_date][series_time][acq_time]["Combined"][slice_n]["dcm"]
-                                    #image mask is the mask visualised, phantom mask and air mask are used for analysis
-                                    dcm_array = dcm.pixel_array
-                                    phantom_mask, air_mask, img_mask = self.Get_Masks(dcm_array)
-                                    self.mask_dict[slice_n]["phantom"] = phantom_mask
-                                    self.mask_dict[slice_n]["air"] = air_mask
-                                except KeyError:
-                                    try:
-                                        dcm_array = dcm_dict[acq_date][series_time][acq_time]["Combined"][slice_n]["pixel_array"]
-                                        phantom_mask, air_mask, img_mask = self.Get_Masks(dcm_array)
-                                        self.mask_dict[slice_n]["phantom"] = phantom_mask
-                                        self.mask_dict[slice_n]["air"] = air_mask
-                                    except KeyError:
-                                        pass
-                                    
-                                
-                                
-                                
+                                #image to establish mask from
+                                combined = dcm_dict[acq_date][series_time][acq_time]["Combined"][slice_n]
+                                if "dcm" in combined:
+                                    dcm_array = combined["dcm"].pixel_array
+                                elif "pixel_array" in combined:
+                                    dcm_array = combined["pixel_array"]
+                                else:
+                                    continue
+                                #image mask is the mask visualised, phantom mask and air mask are used for analysis
+                                phantom_mask, air_mask, img_mask = self.Get_Slice_Masks(dcm_array, slice_n)
+                                self.mask_dict[slice_n]["phantom"] = phantom_mask
+                                self.mask_dict[slice_n]["air"] = air_mask
+                                #indices of the masks used by all the calculations for the slice
+                                self.mask_dict[slice_n]["plan"] = main.mask_plan(phantom_mask, air_mask)
                 
-        def Fig2Img(self, fig):
-            """Convert a Matplotlib figure to a PIL Image and return it"""
-            import io
-            buf = io.BytesIO()
-            fig.savefig(buf)
-            buf.seek(0)
-            img = Image.open(buf)
-            return img
-     
-            
-        def Display_Mask(self, img):
+        def Get_Slice_Masks(self, dcm_array, slice_n):
+            """
+            Masks of slice_n.  The mask accepted previously for the scanner, 
+            coil and image matrix is re-aligned to dcm_array and reused if it 
+            still fits the phantom (Realign_Cached_Mask).  Otherwise the mask 
+            is produced (and reviewed) by Get_Masks and stored for next time.
+            
+            Returns (phantom_mask, air_mask, img_mask) as Get_Masks
+            """
+            cache_path = self.Get_Cache_Path(dcm_array.shape, slice_n)
+            expected_area = None
+            if cache_path is not None and os.path.exists(cache_path):
+                img_mask = self.Realign_Cached_Mask(dcm_array, cache_path)
+                if img_mask is not None:
+                    return self.Get_Analysis_Masks(img_mask)
+                #the phantom should still be the same size as in the cached mask
+                with np.load(cache_path) as cached:
+                    expected_area = np.count_nonzero(cached["mask"])
+            masks = self.Get_Masks(dcm_array, expected_area)
+            #only masks reviewed by the user or accepted automatically with a 
+            #score of at least auto_accept_confidence are stored
+            if cache_path is not None and (self.mask_reviewed == True or self.mask_auto_accepted == True):
+                try:
+                    self.Store_Mask(cache_path, dcm_array, masks[2])
+                except OSError as e:
+                    print("WARNING: mask could not be stored in " + cache_path + ": " + str(e))
+            return masks
+        
+        def Get_Cache_Path(self, shape, slice_n):
+            """Path of the cached mask for the scanner, coil, image matrix and slice. None = no mask cache"""
+            if self.mask_cache_directory is None or self.scanner_ID is None or self.coil_name is None:
+                return None
+            file_name = "_".join([str(self.scanner_ID), str(self.coil_name), "x".join([str(n) for n in shape]), 
+                                  "slice", str(slice_n)]) + ".npz"
+            return os.path.join(self.mask_cache_directory, file_name)
+        
+        def Store_Mask(self, cache_path, dcm_array, img_mask):
+            """Store the accepted img_mask, the image it was produced from and the thresholds used"""
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            #write to a temporary file so other processes never read a partial file
+            part_path = cache_path + ".part"
+            with open(part_path, "wb") as part_file:
+                np.savez_compressed(part_file, image=dcm_array.astype(np.float32), mask=img_mask.astype(np.bool_), 
+                                    thresholds=np.array([self.lower_threshold, self.upper_threshold]))
+            os.replace(part_path, cache_path)
+        
+        def Realign_Cached_Mask(self, dcm_array, cache_path):
+            """
+            Parameters
+            ----------
+            dcm_array : np array
+                Combined image the mask is required for
+            cache_path : str
+                Mask stored by Store_Mask
+
+            Returns
+            -------
+            img_mask : np array of bool or None
+                Cached mask shifted onto the phantom in dcm_array.  None if 
+                the shifted mask doesn't fit the phantom
+            
+            The shift of the phantom since the cached mask was accepted is 
+            found by phase correlation (FFT) of the cached and new images.  
+            The shifted mask is compared to the mask produced from dcm_array 
+            with the cached thresholds: it is only reused if the overlap 
+            (Dice coefficient) is at least mask_overlap_threshold.
+            """
+            with np.load(cache_path) as cached:
+                reference = cached["image"]
+                cached_mask = cached["mask"]
+                lower_threshold, upper_threshold = [float(threshold) for threshold in cached["thresholds"]]
+            image = dcm_array.astype(np.float32)
+            #window reduces the effect of the edges of the images on the correlation
+            window = cv2.createHanningWindow(image.shape[::-1], cv2.CV_32F)
+            (x_shift, y_shift), response = cv2.phaseCorrelate(reference, image, window)
+            shift = np.float32([[1, 0, x_shift], [0, 1, y_shift]])
+            shifted_mask = cv2.warpAffine(cached_mask.astype(np.uint8), shift, image.shape[::-1], flags=cv2.INTER_NEAREST, 
+                                          borderMode=cv2.BORDER_CONSTANT, borderValue=0).astype(np.bool_)
+            
+            dcm_filtered = cv2.filter2D(dcm_array, -1, self.low_pass_filter)
+            new_mask = self.Watershed_Mask(dcm_filtered, np.amax(dcm_array), lower_threshold, upper_threshold)
+            n_pixels = np.count_nonzero(shifted_mask) + np.count_nonzero(new_mask)
+            overlap = 2*np.count_nonzero(shifted_mask & new_mask)/n_pixels if n_pixels > 0 else 0
+            
+            print("Cached mask shifted by ({:.1f}, {:.1f}) pixels: overlap {:.3f} (correlation peak {:.3f})".format(
+                  x_shift, y_shift, overlap, response))
+            if overlap < self.mask_overlap_threshold:
+                print("Cached mask doesn't fit the phantom (overlap < " + str(self.mask_overlap_threshold) + 
+                      "): producing a new mask")
+                return None
+            self.lower_threshold = lower_threshold
+            self.upper_threshold = upper_threshold
+            return shifted_mask
+            
+        def Get_Display_Image(self, dcm_filtered):
+            """
+            dcm_filtered scaled to 0-255 (uint8) and resized (nearest 
+            neighbour) so its longest side is display_size pixels
+            """
+            scale_factor = self.display_size/max(dcm_filtered.shape)
+            size = (int(round(dcm_filtered.shape[1]*scale_factor)), int(round(dcm_filtered.shape[0]*scale_factor)))
+            grey = cv2.normalize(dcm_filtered.astype(np.float32), None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+            return cv2.resize(grey, size, interpolation=cv2.INTER_NEAREST)
+        
+        def Render_Overlay(self, grey, img_mask):
+            """
+            Parameters
+            ----------
+            grey : np array of uint8
+                Image at display resolution (Get_Display_Image)
+            img_mask : np array of bool
+                Mask at the resolution of the image
+
+            Returns
+            -------
+            rgb : np array of uint8 (rows, columns, 3)
+                grey with the mask blended in mask_colour
+            """
+            mask = cv2.resize(img_mask.astype(np.uint8), grey.shape[::-1], interpolation=cv2.INTER_NEAREST)
+            rgb = cv2.cvtColor(grey, cv2.COLOR_GRAY2RGB)
+            #look up table of each grey level blended with mask_colour
+            levels = np.arange(256)[:, None]
+            lut = np.round(levels*(1 - self.mask_alpha) + np.array(self.mask_colour)*self.mask_alpha).astype(np.uint8)
+            tinted = cv2.LUT(rgb, lut.reshape(1, 256, 3))
+            #copy the tinted pixels inside the mask over rgb
+            return cv2.copyTo(tinted, mask, rgb)
+            
+        def Display_Mask(self, dcm_filtered, max_int):
             """
             Parameters
             ----------
-            img : PIL Image array
-                Image to be displayed in tkinter window
-            Return True/ False
+            dcm_filtered : np array
+                Smoothed combined image
+            max_int : number
+                Maximum intensity of the combined image
+            Returns the accepted mask (np array of bool)
             
-            Displays img and asks the user to confirm if mask is acceptable.  
-            If the initial mask isn't acceptable the thresholds should be 
-            adjusted however using different thresholds may indicate acoil failure
+            Displays the mask overlaying the image and asks the user to 
+            confirm if mask is acceptable.  If the initial mask isn't 
+            acceptable the thresholds should be adjusted (the mask is redrawn 
+            as the sliders move) however using different thresholds may 
+            indicate acoil failure
             """    
-            global img_tk
             top = tk.Toplevel()
             top.title("Is the mask acceptable?")
-            top.geometry('800x700')
+            top.geometry('800x800')
             top.wm_attributes('-topmost', 1)
             
-            #adjust size of image so displays in tkinter label
-            scale_factor = 800/img.size[0]
-            size = tuple((np.array(img.size) * scale_factor).astype(int))
-            img_rs = img.resize(size, resample=Image.NEAREST)
-            img_tk = ImageTk.PhotoImage(img_rs)
-            tk.Label(top, image=img_tk).grid(row=0, column=0, columnspan = 2)
+            grey = self.Get_Display_Image(dcm_filtered)
+            image_label = tk.Label(top)
+            image_label.grid(row=0, column=0, columnspan = 2)
             proceed = tk.IntVar()
             
             #initialise thresholds
@@ -1171,44 +2325,103 @@ class main:
             upper_threshold = tk.DoubleVar()
             lower_threshold.set(self.lower_threshold)
             upper_threshold.set(self.upper_threshold)
+            current = {}
+            cache = main.watershed_cache(self, dcm_filtered, max_int, 
+                                         max_entries=2*(2*self.precompute_steps + 1)**2)
+            
+            def Update():
+                current.pop("pending", None)
+                try:
+                    thresholds = (lower_threshold.get(), upper_threshold.get())
+                except tk.TclError:
+                    #partially typed value
+                    return
+                if thresholds == current.get("thresholds"):
+                    return
+                current["thresholds"] = thresholds
+                current["img_mask"] = cache.Get(*thresholds)
+                #produce the masks the user is likely to try next
+                cache.Precompute(*thresholds, self.threshold_step, self.precompute_steps, self.threshold_slider_max)
+                img_tk = ImageTk.PhotoImage(Image.fromarray(self.Render_Overlay(grey, current["img_mask"])))
+                image_label.configure(image=img_tk)
+                #keep a reference: tkinter doesn't
+                image_label.image = img_tk
+            
+            def Schedule_Update(*args):
+                #redraw once the slider has stopped for a moment rather than for every position
+                if "pending" not in current:
+                    current["pending"] = top.after(self.redraw_delay_ms, Update)
             
-            tk.Button(top, text="Yes", command=lambda:  proceed.set(True)).grid(row=1, column=0)
-            tk.Button(top, text="Retry", command=lambda:  proceed.set(False)).grid(row=1, column=1)
-            tk.Label(top, text = "Lower_threshold").grid(row=2, column=0)
-            tk.Entry(top, width = 15, textvariable= lower_threshold).grid(row=2, column=1)
-            tk.Label(top, text = "Upper_threshold").grid(row=3, column=0)
-            tk.Entry(top, width = 15, textvariable= upper_threshold).grid(row=3, column=1)        
+            Update()
+            lower_threshold.trace_add("write", Schedule_Update)
+            upper_threshold.trace_add("write", Schedule_Update)
+            
+            tk.Button(top, text="Yes", command=lambda:  proceed.set(True)).grid(row=1, column=0, columnspan = 2)
+            for row, (name, threshold) in enumerate([("Lower_threshold", lower_threshold), ("Upper_threshold", upper_threshold)]):
+                tk.Label(top, text = name).grid(row=2+2*row, column=0)
+                tk.Entry(top, width = 15, textvariable= threshold).grid(row=2+2*row, column=1)
+                tk.Scale(top, variable=threshold, from_=0, to=self.threshold_slider_max, resolution=self.threshold_step, 
+                         orient=tk.HORIZONTAL, length=600, showvalue=False).grid(row=3+2*row, column=0, columnspan = 2)
             
             #Wait until the user has decided if the mask is acceptable
             top.wait_variable(proceed)
+            if "pending" in current:
+                top.after_cancel(current["pending"])
+            Update()
+            cache.Close()
             top.destroy()
             
             #replace thresholds with those specified by the user
-            self.lower_threshold = lower_threshold.get()
-            self.upper_threshold = upper_threshold.get()
-            return proceed.get()
-        
-        def Expand_and_Contract_Masks(self, original_mask, x_size, y_size, expand=True):
-            """Expand/contract original_mask by 1 pixel in all directions;
-            x_size and y_size are the dimensions of the image.
-            """
-            new_mask = np.full_like(original_mask,False)
-            for x in range(x_size):
-                for y in range(y_size):
-                    if original_mask[x,y] == True:
-                        if np.all(original_mask[x-1:x+2,y-1:y+2]):
-                            new_mask[x,y] = True
-                        else:
-                            if expand == True:
-                                for i in range(3):
-                                    for j in range(3):
-                                        new_mask[x-1+i,y-1+j] = True
-                            else:
-                                new_mask[x,y] = False
-            return new_mask
-            
+            self.lower_threshold, self.upper_threshold = current["thresholds"]
+            return current["img_mask"]
         
-        def Get_Masks(self,dcm_array):
+        def Get_Structuring_Element(self, margin):
+            """Structuring element (uint8 array) for contracting/ expanding a mask by margin pixels"""
+            if isinstance(self.structuring_element, str) == False:
+                return np.asarray(self.structuring_element, dtype=np.uint8)
+            if self.structuring_element == "disk":
+                return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*margin+1, 2*margin+1))
+            return np.ones((2*margin+1, 2*margin+1), dtype=np.uint8)
+        
+        def Contract_Mask(self, mask, margin, outside=None):
+            """
+            Parameters
+            ----------
+            mask : np array
+                Mask to contract (True/ non zero = in the mask)
+            margin : int
+                Pixels to contract the mask by
+            outside : bool or None
+                Pixels outside the image are treated as in (True) or not in 
+                (False) the mask.  None = pixels outside the image are ignored 
+                so the mask isn't contracted from the edges of the image
+            Returns
+            -------
+            contracted_mask : np array of bool
+                Pixels whose structuring element neighbourhood is entirely 
+                in mask (morphological erosion)
+            """
+            mask = np.asarray(mask != 0, dtype=np.uint8)
+            if margin == 0:
+                return mask.astype(np.bool_)
+            kernel = self.Get_Structuring_Element(margin)
+            if outside is None:
+                contracted_mask = cv2.erode(mask, kernel)
+            else:
+                contracted_mask = cv2.erode(mask, kernel, borderType=cv2.BORDER_CONSTANT, borderValue=int(outside))
+            return contracted_mask.astype(np.bool_)
+        
+        def Expand_Mask(self, mask, margin):
+            """
+            Expand mask by margin pixels (morphological dilation).  Pixels 
+            outside the image are ignored.
+            """
+            mask = np.asarray(mask != 0, dtype=np.uint8)
+            if margin == 0:
+                return mask.astype(np.bool_)
+            return cv2.dilate(mask, self.Get_Structuring_Element(margin)).astype(np.bool_)
+        
+        def Get_Masks(self,dcm_array, expected_area=None):
             """
             
 
@@ -1216,6 +2429,9 @@ class main:
             ----------
             dcm : DICOM
                 Combined array DICOM to create mask from
+            expected_area : int
+                Expected number of pixels in the mask (used by Auto_Mask). 
+                None = the size of the mask isn't scored
 
             Returns
             -------
@@ -1231,67 +2447,175 @@ class main:
             adjust the thresholds until the mask is acceptable.  It should be 
             noted if theresholds need adjusting this may indicate a coil failure.
             
+            If auto_accept is True the best mask from the threshold grid 
+            (Auto_Mask) is accepted without asking the user unless its score 
+            is below auto_accept_confidence.  The review then starts from 
+            the thresholds of the best mask.  In headless mode (interactive 
+            is False) a mask below auto_accept_confidence raises an exception 
+            so the group isn't analysed with it.
+            
             The accepted mask is contracted by 4 pixels to produce a mask of 
             the phantom ignoring edge effects.  The accepted mask is also inverted and 
             econtracted by 5 pixels to produce a mask of the air.
             """
-            x_size = dcm_array.shape[0]
-            y_size = dcm_array.shape[1]
             max_int = np.amax(dcm_array)
-            mask_acceptable = False
             #smooth out noise in the image
             dcm_filtered = cv2.filter2D(dcm_array,-1,self.low_pass_filter)
+            self.mask_reviewed = False
+            self.mask_auto_accepted = False
             
-            #Loop until User accepts the mask
-            while mask_acceptable ==False:
-                markers = np.zeros(dcm_filtered.shape)
-                #probably air
-                markers[dcm_filtered<max_int*self.lower_threshold]=1
-                #probably phantom
-                markers[dcm_filtered>max_int*self.upper_threshold]=2
-                
-                #perform watershed algorithm based on the thresholded image 
-                #and the intensities of the voxels in the smoothed DICOM
-                labels = seg.watershed(dcm_filtered, markers)
-                img_mask = np.full_like(dcm_filtered, False)
-                img_mask[labels==2]=True
-                
-                test = np.ma.masked_where(img_mask==False, img_mask)
-                fig, ax = plt.subplots()
-                #create figure of mask overlaying the DICOM PixelArray
-                ax.imshow(dcm_filtered, cmap='gray', interpolation='none', alpha=0.4)
-                ax.imshow(test, 'spring', interpolation='none', alpha=0.2)
-                PIL_img = self.Fig2Img(fig)
-                #close plot: will be displayed in tkinter window
-                plt.close(fig)
-                #Display figure in tkinter window and ask user if the mask is OK 
-                if self.Display_Mask(PIL_img) == True:
-                    mask_acceptable = True
+            if self.auto_accept == True:
+                img_mask, scores = self.Auto_Mask(dcm_filtered, max_int, expected_area)
+                description = ("(thresholds {:.3g}, {:.3g}; score {:.3f}: compactness {:.3f}, holes {:.3f}, " + 
+                               "stability {:.3f}, size {:.3f}, border {:.3f})").format(self.lower_threshold, self.upper_threshold, 
+                               scores["score"], scores["compactness"], scores["holes"], scores["stability"], scores["size"], 
+                               scores["border"])
+                if scores["score"] >= self.auto_accept_confidence:
+                    print("Mask accepted automatically " + description)
+                    self.mask_auto_accepted = True
+                    return self.Get_Analysis_Masks(img_mask)
+                if self.interactive == False:
+                    #nobody can review it: the group is skipped and reported (watch_folder.Collect_Results)
+                    raise Exception("Mask score below " + str(self.auto_accept_confidence) + 
+                                    ", not analysed: review the mask in the GUI " + description)
+                print("Mask score below " + str(self.auto_accept_confidence) + ": asking the user " + description)
             
-            #contract accepted mask by 4 pixels to produce phantom_mask
-            phantom_mask = img_mask
-            for contract_px in range(4):
-                contracted_mask = self.Expand_and_Contract_Masks(phantom_mask, x_size, y_size, expand=False)
-                phantom_mask = contracted_mask
+            if self.interactive == False:
+                img_mask = self.Watershed_Mask(dcm_filtered, max_int, self.lower_threshold, self.upper_threshold)
+                print("Mask accepted without review (thresholds " + str(self.lower_threshold) + 
+                      ", " + str(self.upper_threshold) + ")")
+            else:
+                #Display the mask in tkinter window until the user accepts it
+                img_mask = self.Display_Mask(dcm_filtered, max_int)
+                self.mask_reviewed = True
+            
+            return self.Get_Analysis_Masks(img_mask)
+        
+        def Auto_Mask(self, dcm_filtered, max_int, expected_area=None):
+            """
+            Parameters
+            ----------
+            dcm_filtered : np array
+                Smoothed combined image
+            max_int : number
+                Maximum intensity of the combined image
+            expected_area : int
+                Expected number of pixels in the mask. None = the size of the 
+                mask isn't scored
+
+            Returns
+            -------
+            img_mask : np array of bool
+                Mask with the highest score
+            scores : dict
+                Scores of img_mask (Score_Mask)
             
+            Produces a mask for each combination of threshold_grid_factors 
+            applied to the lower and upper thresholds and returns the best 
+            (highest score, then highest mean of the individual scores).  Of 
+            equally good masks the one with the thresholds closest to the 
+            defaults is returned.  self.lower_threshold and 
+            self.upper_threshold are set to the thresholds of the best mask.
+            """
+            factors = self.threshold_grid_factors
+            masks = {}
+            areas = np.zeros((len(factors), len(factors)))
+            for i, lower_factor in enumerate(factors):
+                for j, upper_factor in enumerate(factors):
+                    masks[i, j] = self.Watershed_Mask(dcm_filtered, max_int, self.lower_threshold*lower_factor, 
+                                                      self.upper_threshold*upper_factor)
+                    areas[i, j] = np.count_nonzero(masks[i, j])
             
-            #Invert accepted mask and contract by 5 pixels to produce air_mask
-            air_mask = np.full_like(dcm_filtered, True)
-            air_mask[img_mask ==True]=False
-            for contract_px in range(5):
-                contracted_mask = self.Expand_and_Contract_Masks(air_mask, x_size, y_size, expand=False)
-                air_mask = contracted_mask
-            
-            phantom_mask_npbool = phantom_mask.astype(np.bool_)
-            air_mask_npbool = air_mask.astype(np.bool_)
+            best = None
+            for i, j in sorted(masks, key=lambda ij: abs(np.log(factors[ij[0]])) + abs(np.log(factors[ij[1]]))):
+                #areas of the masks produced with the adjacent thresholds in the grid
+                neighbour_areas = [areas[k, l] for k, l in [(i-1, j), (i+1, j), (i, j-1), (i, j+1)] 
+                                   if 0 <= k < len(factors) and 0 <= l < len(factors)]
+                scores = self.Score_Mask(masks[i, j], neighbour_areas, expected_area)
+                rank = (scores["score"], np.mean([scores[measure] for measure in self.mask_score_limits]))
+                if best is None or rank > best[3]:
+                    best = ((i, j), masks[i, j], scores, rank)
+            (i, j), img_mask, scores, rank = best
+            self.lower_threshold = self.lower_threshold*factors[i]
+            self.upper_threshold = self.upper_threshold*factors[j]
+            return img_mask, scores
+        
+        def Score_Mask(self, mask, neighbour_areas, expected_area=None):
+            """
+            Scores (0-1, 1 = best) of a candidate phantom mask for each of the 
+            measures in mask_score_limits ("size" is 1 if expected_area is 
+            None) and "score": the lowest of them.  The lowest rather than 
+            the product is used so the score only falls below 
+            auto_accept_confidence if a measure is close to its fail limit, 
+            not because several measures are slightly below their pass limits.
+            """
+            area = np.count_nonzero(mask)
+            if area == 0:
+                scores = {measure:0 for measure in self.mask_score_limits}
+                scores["score"] = 0
+                return scores
+            contours, hierarchy = cv2.findContours(mask.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+            #contours with a parent are holes
+            outer_contours = [contour for contour, parent in zip(contours, hierarchy[0][:, 3]) if parent == -1]
+            filled = np.zeros(mask.shape, dtype=np.uint8)
+            cv2.drawContours(filled, outer_contours, -1, 1, thickness=-1)
+            filled_area = max(np.count_nonzero(filled), area)
+            hull = np.zeros(mask.shape, dtype=np.uint8)
+            cv2.fillConvexPoly(hull, cv2.convexHull(np.vstack(outer_contours)), 1)
+            hull_area = max(np.count_nonzero(hull), area)
+            measures = {"compactness":area/hull_area, 
+                        "holes":(filled_area - area)/filled_area, 
+                        "stability":max([abs(area - neighbour_area) for neighbour_area in neighbour_areas], default=0)/area, 
+                        "size":0 if expected_area is None else abs(area - expected_area)/expected_area, 
+                        "border":np.mean(np.concatenate([mask[0, :], mask[-1, :], mask[:, 0], mask[:, -1]]))}
+            scores = {}
+            for measure, (fail_limit, pass_limit) in self.mask_score_limits.items():
+                scores[measure] = float(np.clip((measures[measure] - fail_limit)/(pass_limit - fail_limit), 0, 1))
+            scores["score"] = min(scores.values())
+            return scores
+        
+        def Watershed_Mask(self, dcm_filtered, max_int, lower_threshold, upper_threshold):
+            """
+            Mask (np array of bool) of the phantom in dcm_filtered (smoothed 
+            combined image).  Pixels below max_int*lower_threshold are 
+            probably air, those above max_int*upper_threshold probably 
+            phantom and the rest are assigned by the watershed algorithm.
+            """
+            markers = np.zeros(dcm_filtered.shape, dtype=np.int32)
+            #probably air
+            markers[dcm_filtered<max_int*lower_threshold]=1
+            #probably phantom
+            markers[dcm_filtered>max_int*upper_threshold]=2
+            
+            #perform watershed algorithm based on the thresholded image 
+            #and the intensities of the voxels in the smoothed DICOM
+            labels = seg.watershed(dcm_filtered, markers)
+            return labels==2
+        
+        def Get_Analysis_Masks(self, img_mask):
+            """
+            Returns
+            -------
+            phantom_mask_npbool : NP Array of Booleans
+                img_mask contracted by phantom_margin pixels
+            air_mask_npbool : NP Array of Booleans
+                img_mask inverted and contracted by air_margin pixels
+            img_mask_npbool : NP Array of Booleans
+                img_mask (accepted mask covering entirity of phantom)
+            """
             img_mask_npbool = img_mask.astype(np.bool_)
+            #contract accepted mask by 4 pixels to produce phantom_mask
+            phantom_mask_npbool = self.Contract_Mask(img_mask_npbool, self.phantom_margin)
+            #Invert accepted mask and contract by 5 pixels to produce air_mask
+            air_mask_npbool = self.Contract_Mask(~img_mask_npbool, self.air_margin)
             
             
             return phantom_mask_npbool, air_mask_npbool, img_mask_npbool
         
     class calculate_results:
         """Calculate SNR via 3 methods for individual element and combined images:
-            -NEMA: SNR calculated via subtraction method; requires 2 images
+            -NEMA: SNR calculated via subtraction method; requires 2 or more 
+            repeated images (every pair or the variance across all of them)
             -noise_std: SNR calculated using the assumption that the noise in 
             the image is proportional to the S.D. of the signal in air.
             -noise_av (preferred mathod): SNR calculated using the assumption 
@@ -1324,6 +2648,12 @@ class main:
                                32:{"SD":0.7057,"Mean":7.9688},
                                64:{"SD":0.7064,"Mean":11.2916}
                                }
+        #use the numba compiled statistics kernel (if numba is installed)
+        use_compiled_kernel = True
+        #confidence level of the interval of the per repeat SNRs
+        confidence_level = 0.95
+        #size of the block of float64 repeat differences reduced at once (Pair_Difference_Variances)
+        repeat_block_bytes = 2**22
         def __init__(self, dcm_dict, mask_dict, n_elements):
             #create dictionary to store data in
             self.Initialise_SNR_Dict(dcm_dict)
@@ -1431,7 +2761,7 @@ class main:
         
         
         
-        def SNR_Moriel(self,img_arr,phantom_mask,air_mask,n_elements):
+        def SNR_Moriel(self,img_arr,phantom_mask,air_mask,n_elements,plan=None):
             """
             Parameters
             ----------
@@ -1444,6 +2774,8 @@ class main:
             n_elements : int
                 Number of elements used to generate img_arr: SNR scale factors 
                 depending on number of elements
+            plan : mask_plan
+                Plan of phantom_mask and air_mask.  None = produced from the masks
 
             Returns
             -------
@@ -1459,161 +2791,487 @@ class main:
                 that the noise in the image is proportional to the mean of the 
                 signal in air.
             """
-            #mask img_arr: only phantom
-            signal_arr = img_arr[phantom_mask]
-            #mask img_arr: only air
-            noise_arr = img_arr[air_mask]
+            if plan is None:
+                plan = main.mask_plan(phantom_mask, air_mask)
             #get scale factors for SNR calculations based on the number of elements
             scale_factors = self.element_scale_factors[n_elements]
+            if self.Moments_Loop is not None and self.use_compiled_kernel == True:
+                moments = self.Image_Moments(plan, img_arr)
+                signal_av = moments["signal_av"][0, 0]
+                noise_std = np.sqrt(moments["air_var"][0, 0])/scale_factors["SD"]
+                noise_av = moments["air_av"][0, 0]/scale_factors["Mean"]
+            else:
+                signal_av = np.mean(plan.Take(img_arr, "phantom"))
+                air_voxels = plan.Take(img_arr, "air")
+                noise_std = np.std(air_voxels)/scale_factors["SD"]
+                noise_av = np.mean(air_voxels)/scale_factors["Mean"]
+            return round(self.bandwidth_scalar*signal_av/noise_std, 2), round(self.bandwidth_scalar*signal_av/noise_av, 2)
             
-            signal_av = np.mean(signal_arr)
-            
-            #scaled noise
-            noise_std = np.std(noise_arr)/scale_factors["SD"]
-            noise_av = np.mean(noise_arr)/scale_factors["Mean"]
-            #calculate SNR
-            SNR_MORIEL_std = round(self.bandwidth_scalar*signal_av/noise_std,2)
-            SNR_MORIEL_av = round(self.bandwidth_scalar*signal_av/noise_av,2)
-            return SNR_MORIEL_std, SNR_MORIEL_av
-            
-        def SNR_NEMA(self,img_arr_1,img_arr_2,phantom_mask):
+        def SNR_NEMA(self,img_arr_1,img_arr_2,phantom_mask,plan=None):
             """
             Calculates SNR via NEMA "subtraction" method: requires two 
             identically acquired images (img_arr_1 and img_arr_2) and a 
-            mask of the phantom
+            mask of the phantom (or its mask_plan).  Only the phantom voxels 
+            are read from the images and the voxels of img_arr_1 are used for 
+            both the signal and the difference (NEMA_Difference)
 
             """
-            signal_arr= img_arr_1[phantom_mask]
-            noise_arr = np.int16(np.subtract(np.int32(img_arr_1), np.int32(img_arr_2)))[phantom_mask]
-            signal_av = np.mean(signal_arr)
-            noise_std = np.std(noise_arr)
-            SNR_NEMA = round(self.bandwidth_scalar*(2**0.5)*signal_av/noise_std,2)
-            return SNR_NEMA
-            
-        def single_img_SNR(self,signal_array,phantom_mask,air_mask,n_elements):
-            """Calulates SNR via two methods using a simgle image and put 
-            results in self.SNR_results"""
-            SNR_std, SNR_av = self.SNR_Moriel(signal_array,phantom_mask,air_mask,n_elements)
-            self.SNR_results["noise_std"].append(SNR_std)
-            self.SNR_results["noise_av"].append(SNR_av)
+            if plan is None:
+                plan = main.mask_plan(phantom_mask)
+            if self.Moments_Loop is not None and self.use_compiled_kernel == True:
+                moments = self.Image_Moments(plan, img_arr_1, img_arr_2)
+                signal_av = moments["signal_av"][0, 0]
+                noise_std = np.sqrt(moments["difference_var"][0])
+            else:
+                signal_voxels = plan.Take(img_arr_1, "phantom")
+                signal_av = np.mean(signal_voxels)
+                noise_std = np.std(self.NEMA_Difference(signal_voxels, plan.Take(img_arr_2, "phantom")))
+            return round(self.bandwidth_scalar*(2**0.5)*signal_av/noise_std, 2)
+        
+        def Moments_Loop(flat_1, flat_2, phantom_indices, air_indices, paired):
+            """
+            Fused statistics kernel (compiled by numba: see Image_Moments).  
+            One pass over the phantom and air voxels of each image of flat_1 
+            (images x pixels) and, if paired, flat_2 accumulating the count, 
+            sum and sum of squares (about the first voxel, so the variance 
+            doesn't lose precision) of each region and of the NEMA difference 
+            image (as NEMA_Difference).
+            
+            Returns (images x 9) array: phantom mean, phantom variance, air 
+            mean, air variance of flat_1 then flat_2, difference variance
+            """
+            moments = np.full((flat_1.shape[0], 9), np.nan)
+            n_images = 2 if paired else 1
+            for i in range(flat_1.shape[0]):
+                for region, indices in enumerate([phantom_indices, air_indices]):
+                    if len(indices) == 0:
+                        continue
+                    for image_n in range(n_images):
+                        flat = flat_1 if image_n == 0 else flat_2
+                        shift = float(flat[i, indices[0]])
+                        total = 0.0
+                        shifted_total = 0.0
+                        shifted_squares = 0.0
+                        for j in indices:
+                            value = float(flat[i, j])
+                            total += value
+                            shifted_total += value - shift
+                            shifted_squares += (value - shift)*(value - shift)
+                        moments[i, 4*image_n + 2*region] = total/len(indices)
+                        moments[i, 4*image_n + 2*region + 1] = max((shifted_squares - shifted_total*shifted_total/len(indices))/len(indices), 0.0)
+                    if paired and region == 0:
+                        difference_total = 0.0
+                        difference_squares = 0.0
+                        for j in indices:
+                            difference = np.trunc(float(flat_1[i, j])) - np.trunc(float(flat_2[i, j]))
+                            difference_total += difference
+                            difference_squares += difference*difference
+                        moments[i, 8] = max((difference_squares - difference_total*difference_total/len(indices))/len(indices), 0.0)
+            return moments
+        
+        if numba is not None:
+            Moments_Loop = staticmethod(numba.njit(nogil=True, error_model="numpy")(Moments_Loop))
+        else:
+            Moments_Loop = None
+        
+        def Image_Moments(self, plan, *pixel_arrays):
+            """
+            Parameters
+            ----------
+            plan : mask_plan
+                Plan of the phantom and air masks
+            *pixel_arrays : np arrays
+                An image or a stack of images (images x rows x columns) for
+                each repeat (the same images in the same order)
+
+            Returns
+            -------
+            moments : dict of np arrays
+                "signal_av", "signal_var", "air_av", "air_var":
+                    (images x repeats) mean and variance of the phantom and air voxels
+                "pair_difference_var": (images x pairs) variance of the NEMA
+                    difference of the phantom voxels of every pair of repeats
+                    (Pair_Difference_Variances)
+                "difference_var": (images) mean of pair_difference_var: the
+                    variance of the difference of 2 repeats estimated from the
+                    whole repeat stack (NaN if single repeat)
+
+            Uses the fused single pass kernel (Moments_Loop) for 1 or 2 repeats
+            if numba is installed and use_compiled_kernel is True otherwise
+            numpy reductions of the voxels gathered by the plan.
+            """
+            #(images x pixels) views of the images
+            flat_arrays = [np.asarray(array).reshape(-1, array.shape[-2]*array.shape[-1]) for array in pixel_arrays]
+            n_repeats = len(flat_arrays)
+            #the kernel is compiled for both repeats having the same dtype
+            if (self.Moments_Loop is not None and self.use_compiled_kernel == True and n_repeats <= 2 and
+                flat_arrays[0].dtype == flat_arrays[-1].dtype):
+                loop_moments = self.Moments_Loop(flat_arrays[0], flat_arrays[-1], plan.Indices("phantom"),
+                                                 plan.Indices("air"), n_repeats == 2)
+                return {"signal_av":loop_moments[:, 0:4*n_repeats:4], "signal_var":loop_moments[:, 1:4*n_repeats:4],
+                        "air_av":loop_moments[:, 2:4*n_repeats:4], "air_var":loop_moments[:, 3:4*n_repeats:4],
+                        "pair_difference_var":loop_moments[:, 8:9*(n_repeats - 1)], "difference_var":loop_moments[:, 8]}
+
+            moments = {key:np.full((flat_arrays[0].shape[0], n_repeats), np.nan) for key in ["signal_av", "signal_var", "air_av", "air_var"]}
+            phantom_voxels = []
+            for repeat, flat in enumerate(flat_arrays):
+                phantom_voxels.append(np.take(flat, plan.Indices("phantom"), axis=1))
+                moments["signal_av"][:, repeat] = np.mean(phantom_voxels[repeat], axis=1)
+                moments["signal_var"][:, repeat] = np.var(phantom_voxels[repeat], axis=1)
+                #no air region e.g. plan of the phantom only (SNR_NEMA)
+                if len(plan.Indices("air")) > 0:
+                    air_voxels = np.take(flat, plan.Indices("air"), axis=1)
+                    moments["air_av"][:, repeat] = np.mean(air_voxels, axis=1)
+                    moments["air_var"][:, repeat] = np.var(air_voxels, axis=1)
+            moments["pair_difference_var"] = self.Pair_Difference_Variances(phantom_voxels)
+            if n_repeats > 1:
+                moments["difference_var"] = np.mean(moments["pair_difference_var"], axis=1)
+            else:
+                moments["difference_var"] = np.full(flat_arrays[0].shape[0], np.nan)
+            return moments
+
+        def Pair_Difference_Variances(self, phantom_voxels):
+            """
+            Parameters
+            ----------
+            phantom_voxels : list of np arrays
+                (images x voxels) phantom voxels of each repeat
+
+            Returns
+            -------
+            pair_variances : np array
+                (images x pairs) variance of the NEMA difference of every pair
+                of repeats, pairs in the order of np.triu_indices(n_repeats, 1)
+
+            2 repeats are subtracted (NEMA_Difference).  More repeats are 
+            reduced at once: with the differences d_k = r_k - r_0 of each 
+            repeat from the first (NEMA_Difference, so they are exact and 
+            small) the covariance C of d (over the voxels) gives the variance 
+            of every pair, var(r_i - r_j) = C_ii + C_jj - 2C_ij (d_0 = 0), 
+            from one matrix product per block of images.  The mean over the 
+            pairs is 2/(n_repeats-1) times the variance across the whole 
+            repeat stack.
+            """
+            n_repeats = len(phantom_voxels)
+            n_images, n_voxels = phantom_voxels[0].shape
+            if n_repeats == 2:
+                return np.var(self.NEMA_Difference(phantom_voxels[0], phantom_voxels[1]), axis=1)[:, np.newaxis]
+            first, second = np.triu_indices(n_repeats, 1)
+            pair_variances = np.empty((n_images, len(first)))
+            if len(first) == 0:
+                return pair_variances
+            covariance = np.zeros((min(n_images, 1 + self.repeat_block_bytes//(8*n_repeats*max(n_voxels, 1))), n_repeats, n_repeats))
+            for start in range(0, n_images, covariance.shape[0]):
+                end = min(start + covariance.shape[0], n_images)
+                #(images x repeats-1 x voxels) differences from the first repeat
+                differences = np.empty((end - start, n_repeats - 1, n_voxels))
+                for repeat in range(1, n_repeats):
+                    differences[:, repeat - 1] = self.NEMA_Difference(phantom_voxels[repeat][start:end], phantom_voxels[0][start:end])
+                means = np.mean(differences, axis=2)
+                covariance[:end - start, 1:, 1:] = (np.matmul(differences, differences.transpose(0, 2, 1))/n_voxels - 
+                                                    means[:, :, np.newaxis]*means[:, np.newaxis, :])
+                variances = np.diagonal(covariance[:end - start], axis1=1, axis2=2)
+                pair_variances[start:end] = np.maximum(variances[:, first] + variances[:, second] - 
+                                                       2*covariance[:end - start, first, second], 0)
+            return pair_variances
+        
+        def NEMA_Difference(self, phantom_voxels_1, phantom_voxels_2):
+            """
+            Difference of the phantom voxels of two repeats for the NEMA 
+            method.  Calculated in float64, which is exact for the whole 
+            number pixel values, so high signal 16 bit images can't wrap 
+            round (as an int16 difference does above 32767).  Calculated 
+            (non integer) combined images are truncated to whole numbers first.
+            """
+            if np.issubdtype(phantom_voxels_1.dtype, np.integer) and np.issubdtype(phantom_voxels_2.dtype, np.integer):
+                return np.subtract(phantom_voxels_1, phantom_voxels_2, dtype=np.float64)
+            return np.subtract(np.trunc(phantom_voxels_1), np.trunc(phantom_voxels_2), dtype=np.float64)
+        
+        def SNRs_From_Moments(self, moments, n_elements, bandwidth_scalar, repeat_statistics=False):
+            """
+            SNRs (rounded as SNR_Moriel and SNR_NEMA) of each image from the 
+            output of Image_Moments.  bandwidth_scalar is a number or an 
+            array (one per image).  Returns a dict of arrays with the fields 
+            of Batch_Dtype (except element_n and bandwidth_scalar): the NEMA 
+            SNR of each pair and the confidence intervals only if 
+            repeat_statistics is True
+            """
+            #get scale factors for SNR calculations based on the number of elements
+            scale_factors = self.element_scale_factors[n_elements]
+            bandwidth_scalar = np.reshape(bandwidth_scalar, (-1, 1))
+            #scaled noise
+            SNRs = {"signal_av":moments["signal_av"], 
+                    "noise_std":np.sqrt(moments["air_var"])/scale_factors["SD"], 
+                    "noise_av":moments["air_av"]/scale_factors["Mean"], 
+                    "difference_std":np.sqrt(moments["difference_var"])}
+            SNRs["SNR_noise_std"] = np.round(bandwidth_scalar*SNRs["signal_av"]/SNRs["noise_std"], 2)
+            SNRs["SNR_noise_av"] = np.round(bandwidth_scalar*SNRs["signal_av"]/SNRs["noise_av"], 2)
+            SNRs["SNR_NEMA"] = np.round(bandwidth_scalar[:, 0]*(2**0.5)*SNRs["signal_av"][:, 0]/SNRs["difference_std"], 2)
+            if not repeat_statistics:
+                return SNRs
+            #NEMA SNR of each pair of repeats (signal of the first repeat of the pair)
+            first = np.triu_indices(SNRs["signal_av"].shape[1], 1)[0]
+            SNRs["SNR_NEMA_pairs"] = np.round(bandwidth_scalar*(2**0.5)*SNRs["signal_av"][:, first]/
+                                              np.sqrt(moments["pair_difference_var"]), 2)
+            SNRs["SNR_noise_std_CI"] = self.Confidence_Interval(SNRs["SNR_noise_std"])
+            SNRs["SNR_noise_av_CI"] = self.Confidence_Interval(SNRs["SNR_noise_av"])
+            return SNRs
+        
+        def Confidence_Interval(self, SNRs):
+            """
+            Lower and upper bounds (images x 2, rounded as the SNRs) of the 
+            confidence_level interval of the mean of the per repeat SNRs 
+            (images x repeats) via the t distribution.  NaN for a single repeat
+            """
+            n_repeats = SNRs.shape[1]
+            if n_repeats < 2:
+                return np.full((SNRs.shape[0], 2), np.nan)
+            mean = np.mean(SNRs, axis=1)
+            half_width = stats.t.ppf((1 + self.confidence_level)/2, n_repeats - 1)*np.std(SNRs, axis=1, ddof=1)/n_repeats**0.5
+            return np.round(np.stack([mean - half_width, mean + half_width], axis=1), 2)
          
-        def SNR_Calculate_dcm(self, dcm1, phantom_mask, air_mask, dcm2=None, n_elements=1):
+        def SNR_Calculate_dcm(self, dcm1, phantom_mask, air_mask, dcm2=None, n_elements=1, plan=None):
             """Calulates SNR via three methods using dcm1 and dmc2.  One 
             result is produced via the NEMA method which requires 2 images and 
             two results are produced via the the noise_std and noise_av: one for
             each DICOM."""
-            self.SNR_results = {}
-            self.SNR_results["noise_std"] = []
-            self.SNR_results["noise_av"] = []
-            #Images should all be acquired at a bandwidth of 222 Hz/Px.  The 
-            #scalar allows images which are acqhuired at a different bandwidth to still be used
+            signal_array_2 = None if dcm2 is None else dcm2.pixel_array
+            return self.SNR_Calculate_array(dcm1.pixel_array, phantom_mask, air_mask, signal_array_2, n_elements, plan, 
+                                            self.Get_Bandwidth_Scalar(dcm1))
+        
+        def Get_Bandwidth_Scalar(self, dcm):
+            """
+            Images should all be acquired at a bandwidth of 222 Hz/Px.  The 
+            scalar allows images which are acqhuired at a different bandwidth to still be used
+            """
             try:
-                self.bandwidth_scalar =  ((dcm1.PixelBandwidth/130)**0.5)
+                return ((dcm.PixelBandwidth/130)**0.5)
             except AttributeError:
                 #Some Dicom headers don't possess the atribute PixelBandwidth 
                 #(the bandwidth is still in the header but pydicom cant access 
                 #via DICOM.PixelBandwidth).  The BW is assumed to be 222 Hz/px
-                self.bandwidth_scalar =  ((222/130)**0.5)
+                return ((222/130)**0.5)
+        
+        def Batch_Dtype(self, n_repeats):
+            """dtype of the structured array returned by SNR_Batch"""
+            return np.dtype([("element_n", np.int64), ("bandwidth_scalar", np.float64), 
+                             ("signal_av", np.float64, (n_repeats,)), ("noise_std", np.float64, (n_repeats,)), 
+                             ("noise_av", np.float64, (n_repeats,)), ("difference_std", np.float64), 
+                             ("SNR_NEMA", np.float64), ("SNR_noise_std", np.float64, (n_repeats,)), 
+                             ("SNR_noise_av", np.float64, (n_repeats,)), 
+                             ("SNR_NEMA_pairs", np.float64, (n_repeats*(n_repeats - 1)//2,)), 
+                             ("SNR_noise_std_CI", np.float64, (2,)), ("SNR_noise_av_CI", np.float64, (2,))])
+        
+        def SNR_Batch(self, stacks, phantom_mask, air_mask, n_elements=1, plan=None):
+            """
+            Parameters
+            ----------
+            stacks : list of element_stack
+                The individual element images of one slice for each repeat 
+                (the same elements in the same order)
+            phantom_mask : np Boolean array
+                mask of phantom ignoring edge effects
+            air_mask : np Boolean array
+                mask of air ignoring edge effects
+            n_elements : int
+                Number of elements used to generate each image
+            plan : mask_plan
+                Plan of phantom_mask and air_mask.  None = produced from the masks
+
+            Returns
+            -------
+            results : np structured array (Batch_Dtype), one row per element
+                "signal_av", "noise_std" and "noise_av" (scaled noise) and 
+                the SNRs via the noise_std and noise_av methods for each 
+                repeat with their confidence interval ("SNR_noise_std_CI", 
+                "SNR_noise_av_CI"), the standard deviation of the difference 
+                of 2 repeats estimated from all the repeats ("difference_std") 
+                and the SNR via the NEMA method for all the repeats and for 
+                each pair ("SNR_NEMA_pairs")
             
-            signal_array_1 = dcm1.pixel_array
-            self.single_img_SNR(signal_array_1, phantom_mask, air_mask, n_elements)
-            try:
-                signal_array_2 = dcm2.pixel_array
-                self.single_img_SNR(signal_array_2, phantom_mask, air_mask, n_elements)
-                self.SNR_results["NEMA"] = self.SNR_NEMA(signal_array_1,signal_array_2,phantom_mask)
-            except  IndexError:
-                #CHECK CORRECT error
-                pass
-            return self.SNR_results    
-        
-        def SNR_Calculate_array(self, signal_array_1, phantom_mask, air_mask, signal_array_2=None, n_elements=1):
+            Calculates the SNR of all the elements at once (Image_Moments of 
+            the stacks).  The results are the same as SNR_Calculate_dcm (for 
+            each element) but without a python call per element.
+            """
+            if plan is None:
+                plan = main.mask_plan(phantom_mask, air_mask)
+            results = np.zeros(len(stacks[0].element_ns), dtype=self.Batch_Dtype(len(stacks)))
+            results["element_n"] = stacks[0].element_ns
+            results["bandwidth_scalar"] = [self.Get_Bandwidth_Scalar(dcm) for dcm in stacks[0].dcms]
+            moments = self.Image_Moments(plan, *[stack.Load() for stack in stacks])
+            for field, values in self.SNRs_From_Moments(moments, n_elements, results["bandwidth_scalar"], True).items():
+                results[field] = values
+            return results
+        
+        def SNR_Calculate_array(self, signal_array_1, phantom_mask, air_mask, signal_array_2=None, n_elements=1, plan=None, 
+                                bandwidth_scalar=None):
             """Calulates SNR via three methods using dcm1 and dmc2.  One 
             result is produced via the NEMA method which requires 2 images and 
             two results are produced via the the noise_std and noise_av: one for
-            each DICOM."""
-            self.SNR_results = {}
-            self.SNR_results["noise_std"] = []
-            self.SNR_results["noise_av"] = []
-            self.bandwidth_scalar =  ((222/130)**0.5)
-            
+            each DICOM.  Both images are reduced in one pass (Image_Moments).
+            bandwidth_scalar: None = images acquired at 222 Hz/Px"""
+            signal_arrays = [signal_array_1] if signal_array_2 is None else [signal_array_1, signal_array_2]
+            return self.SNR_Calculate_repeats(signal_arrays, phantom_mask, air_mask, n_elements, plan, bandwidth_scalar, False)
+        
+        def SNR_Calculate_repeats(self, signal_arrays, phantom_mask, air_mask, n_elements=1, plan=None, bandwidth_scalar=None, 
+                                  repeat_statistics=True):
+            """
+            Calulates SNR via three methods using any number of identically 
+            acquired images (signal_arrays, one per repeat).  noise_std and 
+            noise_av: one result for each repeat and their confidence interval 
+            ("noise_std_CI", "noise_av_CI": [lower, upper]).  NEMA (2 or more 
+            repeats): one result from the variance across all the repeats and 
+            one for each pair of repeats ("NEMA_pairs").  All the repeats are 
+            reduced at once (Image_Moments).
+            bandwidth_scalar: None = images acquired at 222 Hz/Px
+            repeat_statistics: False = only the SNRs (no confidence intervals or NEMA_pairs)
+            """
+            self.bandwidth_scalar = ((222/130)**0.5) if bandwidth_scalar is None else bandwidth_scalar
+            if plan is None:
+                plan = main.mask_plan(phantom_mask, air_mask)
             
-            self.single_img_SNR(signal_array_1, phantom_mask, air_mask, n_elements)
-            try:
-                self.single_img_SNR(signal_array_2, phantom_mask, air_mask, n_elements)
-                self.SNR_results["NEMA"] = self.SNR_NEMA(signal_array_1,signal_array_2,phantom_mask)
-            except  IndexError:
-                #CHECK CORRECT error
-                pass
+            SNRs = self.SNRs_From_Moments(self.Image_Moments(plan, *signal_arrays), n_elements, self.bandwidth_scalar, 
+                                          repeat_statistics)
+            self.SNR_results = {}
+            self.SNR_results["noise_std"] = list(SNRs["SNR_noise_std"][0])
+            self.SNR_results["noise_av"] = list(SNRs["SNR_noise_av"][0])
+            if repeat_statistics:
+                self.SNR_results["noise_std_CI"] = list(SNRs["SNR_noise_std_CI"][0])
+                self.SNR_results["noise_av_CI"] = list(SNRs["SNR_noise_av_CI"][0])
+            if len(signal_arrays) > 1:
+                self.SNR_results["NEMA"] = SNRs["SNR_NEMA"][0]
+                if repeat_statistics:
+                    self.SNR_results["NEMA_pairs"] = list(SNRs["SNR_NEMA_pairs"][0])
             return self.SNR_results
         
-        def Uniformity_Calculate(self, dcm_array, phantom_mask):
+        def Uniformity_Calculate(self, dcm_array, phantom_mask, plan=None):
             """Calculate the uniformity of dcm via 
             the method outlined in IPEM Report 112 and is refereed to as the 
             integral uniformity method. A low pass filter is applied to the image 
             and the "phantom signal mask" (used for SNR calculation) is applied 
             to the image so only voxels only within the phantom are considered. 
+            Only the bounding box of the phantom (plus the filter margin) is filtered.
             """
-            dcm_filtered = cv2.filter2D(dcm_array,-1,self.low_pass_filter)
-            ROI_voxels = dcm_filtered[phantom_mask]
+            if plan is None:
+                plan = main.mask_plan(phantom_mask)
+            dcm_filtered = cv2.filter2D(np.ascontiguousarray(plan.Crop(dcm_array, "phantom")),-1,self.low_pass_filter)
+            ROI_voxels = plan.Take_Cropped(dcm_filtered, "phantom")
             max_int = np.max(ROI_voxels)
             min_int = np.min(ROI_voxels)
             uniformity = 1-((max_int-min_int)/(max_int+min_int))
             return uniformity
         
+        def Get_Dicom_Handles(self, series_dict):
+            """Return a list of all the dicom_handles inside series_dict (part of a sorted dcm_dict)"""
+            handles = []
+            for value in series_dict.values():
+                if isinstance(value, main.dicom_handle):
+                    handles.append(value)
+                elif isinstance(value, dict):
+                    handles.extend(self.Get_Dicom_Handles(value))
+            return handles
+        
+        def Get_Mask_Plan(self, mask_dict, slice_n):
+            """mask_plan of slice_n: produced (and kept in mask_dict) if initialise_masks didn't"""
+            if "plan" not in mask_dict[slice_n]:
+                mask_dict[slice_n]["plan"] = main.mask_plan(mask_dict[slice_n]["phantom"], mask_dict[slice_n]["air"])
+            return mask_dict[slice_n]["plan"]
+        
+        def Confidence_Interval_Results(self, heading, CI):
+            """{<heading>_CI_lower:<lower>, <heading>_CI_upper:<upper>} of CI (Confidence_Interval): None (an empty cell) if single repeat"""
+            return {heading + "_CI_" + bound:None if np.isnan(value) else value for bound, value in zip(["lower", "upper"], CI)}
+        
+        def Check_Repeat_Elements(self, elements, date, series_time, slice_n):
+            """Raise an exception if the repeats of a slice (elements: {<element_n>:<image>} of each repeat) don't have the same elements"""
+            all_elements = set().union(*elements)
+            for repeat_n, repeat_elements in enumerate(elements):
+                missing = sorted(all_elements - set(repeat_elements))
+                if missing != []:
+                    raise Exception("Repeat " + str(repeat_n + 1) + " of series " + str(date) + " " + str(series_time) + 
+                                    ", slice " + str(slice_n) + " missing elements " + ", ".join(str(element_n) for element_n in missing))
+        
         def Loop_Dicoms(self, dcm_dict, mask_dict, n_elements):
             """
             Loop through dcm_dict calculating the SNR for all images via 3 methods 
             (NEMA,noise_std and noise_av) and the uniformity of the combined element images
             
+            Any number of repeats of each series: the noise_std and noise_av 
+            SNRs of each repeat are stored with the confidence interval of 
+            the series and the NEMA SNR (2 or more repeats) of all the 
+            repeats with the first repeat
+            
             Also calculates group averages for this analysis run
             
             Sorts results ready for export to excel
             """
             for date in dcm_dict:
                 for series_time in dcm_dict[date]:
+                    #decode the pixel data of the series before it is analysed 
+                    #(only if the pixel cache has a process pool)
+                    handles = self.Get_Dicom_Handles(dcm_dict[date][series_time])
+                    if handles != []:
+                        handles[0].cache.Prefetch(handles)
                     acq_times = list(dcm_dict[date][series_time].keys())
-                    acq_ID_1 = str(series_time) + str(acq_times[0])
-                    acq_ID_2 = str(series_time) + str(acq_times[1])
-                       
-                    del self.SNR_Dict["NEMA"][date][str(series_time) + str(acq_times[1])]
-                    for img_type in dcm_dict[date][series_time][acq_times[0]]:
-                        for slice_n in dcm_dict[date][series_time][acq_times[0]][img_type]:
+                    acq_IDs = [str(series_time) + str(acq_time) for acq_time in acq_times]
+                    repeats = [dcm_dict[date][series_time][acq_time] for acq_time in acq_times]
+                    #the NEMA SNR of all the repeats is stored with the first 
+                    #(it requires 2 or more repeats)
+                    for acq_ID in acq_IDs[1:] if len(acq_IDs) > 1 else acq_IDs:
+                        del self.SNR_Dict["NEMA"][date][acq_ID]
+                    for img_type in repeats[0]:
+                        for slice_n in repeats[0][img_type]:
+                            plan = self.Get_Mask_Plan(mask_dict, slice_n)
                             if img_type == "Combined":
                                 try:
-                                    dcm_1 = dcm_dict[date][series_time][acq_times[0]][img_type][slice_n]["dcm"]
-                                    dcm_2 = dcm_dict[date][series_time][acq_times[1]][img_type][slice_n]["dcm"]
-                                    SNRs = self.SNR_Calculate_dcm(dcm_1, mask_dict[slice_n]["phantom"], mask_dict[slice_n]["air"], dcm_2, n_elements)
-                                    dcm_array_1 = dcm_1.pixel_array
-                                    dcm_array_2 = dcm_2.pixel_array
+                                    dcms = [repeat[img_type][slice_n]["dcm"] for repeat in repeats]
+                                    dcm_arrays = [dcm.pixel_array for dcm in dcms]
+                                    bandwidth_scalar = self.Get_Bandwidth_Scalar(dcms[0])
                                 except KeyError:
-                                    dcm_array_1 = dcm_dict[date][series_time][acq_times[0]][img_type][slice_n]["pixel_array"]
-                                    dcm_array_2 = dcm_dict[date][series_time][acq_times[1]][img_type][slice_n]["pixel_array"]
-                                    SNRs = self.SNR_Calculate_array(dcm_array_1, mask_dict[slice_n]["phantom"], mask_dict[slice_n]["air"], dcm_array_2, n_elements)
-                                uniformity_1 = round(self.Uniformity_Calculate(dcm_array_1, mask_dict[slice_n]["phantom"]),2)
-                                uniformity_2 = round(self.Uniformity_Calculate(dcm_array_2, mask_dict[slice_n]["phantom"]),2)
-                                self.SNR_Dict["NEMA"][date][acq_ID_1]["Combined"][slice_n] = {"SNR_slice_{}".format(slice_n):SNRs["NEMA"],"Uniformity_slice_{}".format(slice_n):uniformity_1}
-                                self.SNR_Dict["noise_std"][date][acq_ID_1]["Combined"][slice_n] = {"SNR_slice_{}".format(slice_n):SNRs["noise_std"][0],"Uniformity_slice_{}".format(slice_n):uniformity_1}
-                                self.SNR_Dict["noise_std"][date][acq_ID_2]["Combined"][slice_n] = {"SNR_slice_{}".format(slice_n):SNRs["noise_std"][1],"Uniformity_slice_{}".format(slice_n):uniformity_2}
-                                self.SNR_Dict["noise_av"][date][acq_ID_1]["Combined"][slice_n] = {"SNR_slice_{}".format(slice_n):SNRs["noise_av"][0],"Uniformity_slice_{}".format(slice_n):uniformity_1}
-                                self.SNR_Dict["noise_av"][date][acq_ID_2]["Combined"][slice_n] = {"SNR_slice_{}".format(slice_n):SNRs["noise_av"][1],"Uniformity_slice_{}".format(slice_n):uniformity_2}
+                                    dcm_arrays = [repeat[img_type][slice_n]["pixel_array"] for repeat in repeats]
+                                    bandwidth_scalar = None
+                                SNRs = self.SNR_Calculate_repeats(dcm_arrays, mask_dict[slice_n]["phantom"], mask_dict[slice_n]["air"], 
+                                                                  n_elements, plan, bandwidth_scalar)
+                                uniformities = [round(self.Uniformity_Calculate(dcm_array, mask_dict[slice_n]["phantom"], plan),2) 
+                                                for dcm_array in dcm_arrays]
+                                if len(acq_IDs) > 1:
+                                    self.SNR_Dict["NEMA"][date][acq_IDs[0]]["Combined"][slice_n] = {"SNR_slice_{}".format(slice_n):SNRs["NEMA"],"Uniformity_slice_{}".format(slice_n):uniformities[0]}
+                                for repeat_n, acq_ID in enumerate(acq_IDs):
+                                    for SNR_type in ["noise_std", "noise_av"]:
+                                        self.SNR_Dict[SNR_type][date][acq_ID]["Combined"][slice_n] = {"SNR_slice_{}".format(slice_n):SNRs[SNR_type][repeat_n],"Uniformity_slice_{}".format(slice_n):uniformities[repeat_n]}
+                                        self.SNR_Dict[SNR_type][date][acq_ID]["Combined"][slice_n].update(
+                                            self.Confidence_Interval_Results("SNR_slice_{}".format(slice_n), SNRs[SNR_type + "_CI"]))
                             else:
-                                #delrec image
-                                for element_n in dcm_dict[date][series_time][acq_times[0]][img_type][slice_n]:
-                                    dcm_1 = dcm_dict[date][series_time][acq_times[0]][img_type][slice_n][element_n]["dcm"]
-                                    dcm_2 = dcm_dict[date][series_time][acq_times[1]][img_type][slice_n][element_n]["dcm"]
-                                    SNRs = self.SNR_Calculate_dcm(dcm_1, mask_dict[slice_n]["phantom"], mask_dict[slice_n]["air"], dcm_2, 1)
-                                    self.SNR_Dict["NEMA"][date][acq_ID_1]["DelRec"][slice_n][element_n] = {"SNR_element_{}".format(element_n):SNRs["NEMA"]}
-                                    self.SNR_Dict["noise_std"][date][acq_ID_1]["DelRec"][slice_n][element_n] = {"SNR_element_{}".format(element_n):SNRs["noise_std"][0]}
-                                    self.SNR_Dict["noise_std"][date][acq_ID_2]["DelRec"][slice_n][element_n] = {"SNR_element_{}".format(element_n):SNRs["noise_std"][1]}
-                                    self.SNR_Dict["noise_av"][date][acq_ID_1]["DelRec"][slice_n][element_n] = {"SNR_element_{}".format(element_n):SNRs["noise_av"][0]}
-                                    self.SNR_Dict["noise_av"][date][acq_ID_2]["DelRec"][slice_n][element_n] = {"SNR_element_{}".format(element_n):SNRs["noise_av"][1]}
+                                #delrec image: all elements of all the repeats at once
+                                elements = [repeat[img_type][slice_n] for repeat in repeats]
+                                self.Check_Repeat_Elements(elements, date, series_time, slice_n)
+                                stacks = [main.element_stack.From_Dict({element_n:repeat_elements[element_n] for element_n in elements[0]}) 
+                                          for repeat_elements in elements]
+                                results = self.SNR_Batch(stacks, mask_dict[slice_n]["phantom"], mask_dict[slice_n]["air"], 1, plan)
+                                for element_n, SNRs in zip(stacks[0].element_ns, results):
+                                    if len(acq_IDs) > 1:
+                                        self.SNR_Dict["NEMA"][date][acq_IDs[0]]["DelRec"][slice_n][element_n] = {"SNR_element_{}".format(element_n):SNRs["SNR_NEMA"]}
+                                    for repeat_n, acq_ID in enumerate(acq_IDs):
+                                        for SNR_type in ["noise_std", "noise_av"]:
+                                            self.SNR_Dict[SNR_type][date][acq_ID]["DelRec"][slice_n][element_n] = {"SNR_element_{}".format(element_n):SNRs["SNR_" + SNR_type][repeat_n]}
+                                            self.SNR_Dict[SNR_type][date][acq_ID]["DelRec"][slice_n][element_n].update(
+                                                self.Confidence_Interval_Results("SNR_element_{}".format(element_n), SNRs["SNR_" + SNR_type + "_CI"]))
+                                for stack in stacks:
+                                    stack.Release()
+                    #series analysed: release the decoded pixel data
+                    for handle in handles:
+                        handle.Release()
             
             
                       
+            #all the pixel data has been read
+            main.dicom_source.Close_Archives()
             #calculate the group averages for this analysis run
             for SNR_type in self.SNR_Dict:
                 for date in self.SNR_Dict[SNR_type]:
                         acq_IDs = list(self.SNR_Dict[SNR_type][date].keys())
+                        #no NEMA results: single repeats only
+                        if acq_IDs == []:
+                            continue
                         if "DelRec" in self.SNR_Dict[SNR_type][date][acq_IDs[0]]:
                             slices = list(self.SNR_Dict[SNR_type][date][acq_IDs[0]]["DelRec"].keys())
                             elements = list(self.SNR_Dict[SNR_type][date][acq_IDs[0]]["DelRec"][slices[0]].keys())
@@ -2270,6 +3928,353 @@ class main:
             
             
             
+    class watch_folder:
+        """
+        Headless mode: watches incoming_directory for new SNR DICOMs and 
+        analyses each acquisition automatically once it is complete.
+        
+        The directory is rescanned every poll_interval seconds.  A new file 
+        is only read once its size hasn't changed between two scans (the 
+        scanner may still be writing it).  SNR DICOMs are grouped by 
+        scanner, coil (initialise_analysis.Identify_Coil), date and study 
+        (StudyInstanceUID) so QC sessions on the same day are kept apart.  
+        Copies of an image already in the group (same SOPInstanceUID e.g. 
+        the same export as a folder and an archive) are ignored.  A group 
+        is analysed once it contains the expected number of images 
+        (initialise_analysis.Get_Expected_Image_Count) and no new images have 
+        arrived for debounce seconds.  Groups with more images than expected 
+        are reported and not analysed.
+        
+        Complete groups are queued to a pool of n_workers processes which 
+        sort the images, produce the mask (accepted without review) and 
+        calculate the SNR.  The results are exported in this process, one 
+        group at a time, as the excel files are shared between coils.
+        """
+        #seconds between scans of incoming_directory
+        poll_interval = 10
+        #seconds without new images before a complete group is analysed
+        debounce = 30
+        
+        def __init__(self, incoming_directory, n_workers=2, archive_directory=None, figures=False, excel_export=True):
+            """
+            Parameters
+            ----------
+            incoming_directory : str
+                Directory the scanner exports SNR images to
+            n_workers : int
+                Number of groups analysed at the same time
+            archive_directory : str
+                Directory to archive DICOMs to. None = no archive
+            figures : bool
+                Produce PNGs
+            excel_export : bool
+                Export results to excel
+            """
+            self.incoming_directory = incoming_directory
+            self.n_workers = n_workers
+            self.archive_directory = archive_directory
+            self.figures = figures
+            self.excel_export = excel_export
+            #instance used for its file and header methods only (__init__ would open dialogues)
+            self.analysis = main.initialise_analysis.__new__(main.initialise_analysis)
+            #sizes of files found on the previous scan which haven't been read yet
+            self.file_sizes = {}
+            #files which have been read (or can't be read)
+            self.seen_paths = set()
+            #images waiting for the rest of their acquisition 
+            #{(<scanner ID>, <coil name>, <date>, <StudyInstanceUID>):{"paths":[<path>], 
+            #"instance_uids":<set of SOPInstanceUID>, "last_update":<time>}}
+            self.groups = {}
+            #groups being analysed {<future>:<key>}
+            self.running = {}
+        
+        def Run(self):
+            """Watch incoming_directory until interrupted (Ctrl+C)"""
+            print("Watching " + self.incoming_directory + " for SNR images")
+            with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+                try:
+                    while True:
+                        self.Scan()
+                        self.Submit_Complete_Groups(pool)
+                        self.Collect_Results()
+                        time.sleep(self.poll_interval)
+                except KeyboardInterrupt:
+                    print("Stopping: waiting for " + str(len(self.running)) + " analyses to finish")
+                    for future in list(self.running.keys()):
+                        future.result()
+                    self.Collect_Results()
+        
+        def Scan(self):
+            """Read the headers of new files which have finished being written and group the SNR images"""
+            stable_paths = []
+            file_sizes = {}
+            #files are checked for DICOM in the read pool, once they are stable
+            for path in self.analysis.Get_Files(self.incoming_directory, skip_paths=self.seen_paths, check_dicom=False):
+                try:
+                    size = main.dicom_source.Get_Size_And_Mtime(path)[0]
+                except OSError:
+                    continue
+                if self.file_sizes.get(path) == size:
+                    stable_paths.append(path)
+                else:
+                    file_sizes[path] = size
+            self.file_sizes = file_sizes
+            if stable_paths == []:
+                return
+            
+            now = time.time()
+            with ThreadPoolExecutor(max_workers=self.analysis.n_read_workers) as pool:
+                headers = pool.map(self.analysis.Read_Dicom, stable_paths, 
+                                   [self.analysis.header_tags]*len(stable_paths), [True]*len(stable_paths))
+                for path, header, error in headers:
+                    self.seen_paths.add(path)
+                    if header is None and error is None:
+                        #not a DICOM
+                        continue
+                    elif error is not None:
+                        print("Could not read " + path + ": " + error)
+                    elif self.analysis.Is_SNR_Dicom(header):
+                        self.Add_To_Group(path, header, now)
+            main.dicom_source.Close_Archives()
+        
+        def Add_To_Group(self, path, header, now):
+            """Add an SNR image to the group for its scanner, coil, date and study"""
+            coil_name = self.analysis.Identify_Coil(header)
+            if coil_name is None:
+                print("Coil could not be identified for " + path + ": add " + 
+                      str(getattr(header, "ReceiveCoilName", None)) + " to receive_coil_dict")
+                return
+            date = getattr(header, "SeriesDate", None) or getattr(header, "AcquisitionDate", None)
+            key = (header.DeviceSerialNumber, coil_name, date, str(getattr(header, "StudyInstanceUID", "")))
+            if key not in self.groups:
+                self.groups[key] = {"paths":[], "instance_uids":set(), "last_update":now}
+            instance_uid = str(getattr(header, "SOPInstanceUID", ""))
+            if instance_uid != "":
+                if instance_uid in self.groups[key]["instance_uids"]:
+                    print("Copy of an image already found (SOPInstanceUID " + instance_uid + "): " + path + " ignored")
+                    return
+                self.groups[key]["instance_uids"].add(instance_uid)
+            self.groups[key]["paths"].append(path)
+            self.groups[key]["last_update"] = now
+        
+        def Describe_Group(self, key):
+            """<scanner ID> <coil name> <date> (study <StudyInstanceUID>)"""
+            scanner_ID, coil_name, date, study_uid = key
+            description = scanner_ID + " " + coil_name + " " + str(date)
+            if study_uid != "":
+                description += " (study " + study_uid + ")"
+            return description
+        
+        def Submit_Complete_Groups(self, pool):
+            """
+            Queue the groups which are complete and haven't changed for 
+            debounce seconds.  Groups with more images than expected (e.g. an 
+            acquisition repeated in the same study) are reported and removed
+            """
+            now = time.time()
+            for key in list(self.groups.keys()):
+                scanner_ID, coil_name, date, study_uid = key
+                group = self.groups[key]
+                n_images = len(group["paths"])
+                n_expected = self.analysis.Get_Expected_Image_Count(scanner_ID, coil_name)
+                if n_images < n_expected or now - group["last_update"] < self.debounce:
+                    continue
+                del self.groups[key]
+                if n_images > n_expected:
+                    print("Not analysed: " + self.Describe_Group(key) + " has " + str(n_images) + " images, " + 
+                          str(n_expected) + " expected")
+                    continue
+                print("Analysing " + self.Describe_Group(key) + " (" + str(n_images) + " images)")
+                future = pool.submit(main.watch_folder.Analyse_Group, self.incoming_directory, 
+                                     sorted(group["paths"]), coil_name, self.archive_directory, self.figures)
+                self.running[future] = key
+        
+        @staticmethod
+        def Analyse_Group(images_root_dir, dcm_paths, coil_name, archive_directory, figures):
+            """
+            Runs in a worker process: sort, mask and calculate the SNR of 
+            dcm_paths.  Returns (<calculate_results>, <scanner ID>, <scanner name>, <coil name>)
+            """
+            try:
+                initialised = main.initialise_analysis(images_root_dir, dcm_paths=dcm_paths, coil_name=coil_name, 
+                                                       archive_directory=archive_directory, figures=figures)
+                masks = main.initialise_masks(initialised.sorted_dcm_dict, initialised.lower_threshold, 
+                                              initialised.upper_threshold, interactive=False, 
+                                              scanner_ID=initialised.scanner_ID, coil_name=initialised.coil_name).mask_dict
+                SNRs = main.calculate_results(initialised.sorted_dcm_dict, masks, initialised.n_elements)
+            finally:
+                #the worker process is reused for the next group
+                main.dicom_source.Close_Archives()
+            return SNRs, initialised.scanner_ID, initialised.scanner_name, initialised.coil_name
+        
+        def Collect_Results(self):
+            """Export the results of the groups which have been analysed"""
+            for future in [future for future in self.running if future.done()]:
+                key = self.running.pop(future)
+                try:
+                    SNRs, scanner_ID, scanner_name, coil_name = future.result()
+                except Exception as e:
+                    print("Analysis of " + self.Describe_Group(key) + " failed: " + type(e).__name__ + ": " + str(e))
+                    continue
+                if self.excel_export == True:
+                    main.export_to_excel(SNRs, scanner_ID, coil_name)
+                if self.figures == True:
+                    main.produce_figures(SNRs.sorted_SNR_results["noise_av"], scanner_name, coil_name)
+                print("Analysis of " + self.Describe_Group(key) + " complete")
+    
+    class batch_run(watch_folder):
+        """
+        Headless mode: analyse every SNR acquisition under images_root_dir 
+        in one run e.g. a quarter's export from all the scanners.
+        
+        The headers are read once (using the catalog) and the SNR images are 
+        partitioned by scanner (DeviceSerialNumber), coil 
+        (initialise_analysis.Identify_Coil), date and study as in watch_folder.  
+        Each partition is sorted with the sort rules of its scanner 
+        (scanner_sort_methods) and analysed with its coil_dict entry in a 
+        pool of n_workers processes.  Partitions with fewer or more images 
+        than expected are reported and not analysed.
+        """
+        #all the images are present: complete partitions are analysed straight away
+        debounce = 0
+        
+        def __init__(self, images_root_dir, n_workers=4, archive_directory=None, figures=False, excel_export=True):
+            """
+            Parameters
+            ----------
+            images_root_dir : str
+                Directory (or zip/ tar export) containing the images of all the scanners
+            
+            Other parameters as watch_folder
+            """
+            super().__init__(images_root_dir, n_workers, archive_directory, figures, excel_export)
+        
+        def Partition(self):
+            """Read the headers of the SNR images and partition them by scanner, coil, date and study"""
+            dcm_dict = self.analysis.Get_Dicom_Dict(self.analysis.Get_Files(self.incoming_directory, check_dicom=False), 
+                                                    self.incoming_directory, check_dicom=True)
+            now = time.time()
+            for path, dcm in dcm_dict.items():
+                self.Add_To_Group(path, dcm, now)
+            for key in self.groups:
+                scanner_ID, coil_name, date, study_uid = key
+                n_images = len(self.groups[key]["paths"])
+                n_expected = self.analysis.Get_Expected_Image_Count(scanner_ID, coil_name)
+                print(self.Describe_Group(key) + ": " + str(n_images) + " of " + str(n_expected) + " images")
+        
+        def Run(self):
+            """Analyse all the complete partitions"""
+            self.Partition()
+            with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+                self.Submit_Complete_Groups(pool)
+                for key in self.groups:
+                    print("Incomplete: " + self.Describe_Group(key) + " not analysed")
+                while self.running != {}:
+                    wait(list(self.running.keys()), return_when=FIRST_COMPLETED)
+                    self.Collect_Results()
+    
+    class storage_scp(watch_folder):
+        """
+        Headless mode: DICOM Storage SCP the scanner (or any SCU) pushes 
+        SNR images to.  Requires pynetdicom.
+        
+        Received instances which aren't SNR images (initialise_analysis.Is_SNR_Dicom) 
+        are acknowledged but not kept.  SNR images are written to 
+        <spool_directory>/<SeriesInstanceUID>/<SOPInstanceUID>.dcm, indexed 
+        in the catalog and grouped as in watch_folder, so a group is analysed 
+        as soon as it is complete while other images are still being received.
+        """
+        #seconds between checks for received images
+        poll_interval = 1
+        #seconds without new images before a complete group is analysed
+        debounce = 5
+        
+        def __init__(self, spool_directory, port=11112, ae_title="SASS_QC", n_workers=2, 
+                     archive_directory=None, figures=False, excel_export=True):
+            """
+            Parameters
+            ----------
+            spool_directory : str
+                Directory received images are written to
+            port : int
+                Port to listen on
+            ae_title : str
+                AE title of the SCP
+            
+            Other parameters as watch_folder
+            """
+            if AE is None:
+                raise Exception("pynetdicom is required to receive images over the network")
+            super().__init__(spool_directory, n_workers, archive_directory, figures, excel_export)
+            self.port = port
+            self.ae_title = ae_title
+            #paths and headers of the images received by the association threads
+            self.received = queue.Queue()
+        
+        def Handle_Store(self, event):
+            """C-STORE handler: runs in the association thread"""
+            dcm = event.dataset
+            dcm.file_meta = event.file_meta
+            if not self.analysis.Is_SNR_Dicom(dcm):
+                return 0x0000
+            series_dir = os.path.join(self.incoming_directory, dcm.SeriesInstanceUID)
+            os.makedirs(series_dir, exist_ok=True)
+            path = os.path.join(series_dir, dcm.SOPInstanceUID + ".dcm")
+            #write to a temporary name so a partially written file is never read
+            dcm.save_as(path + ".part", write_like_original=False)
+            os.replace(path + ".part", path)
+            self.received.put((path, dcm))
+            return 0x0000
+        
+        def Receive(self, catalog):
+            """Index and group the images received since the last call"""
+            now = time.time()
+            n_received = 0
+            while not self.received.empty():
+                path, dcm = self.received.get()
+                if catalog is not None:
+                    size, mtime = main.dicom_source.Get_Size_And_Mtime(path)
+                    catalog.Add(path, size, mtime, dcm)
+                self.seen_paths.add(path)
+                self.Add_To_Group(path, dcm, now)
+                n_received += 1
+            if catalog is not None and n_received > 0:
+                catalog.Commit()
+        
+        def Run(self):
+            """Receive images until interrupted (Ctrl+C)"""
+            os.makedirs(self.incoming_directory, exist_ok=True)
+            #images received before a restart are picked up from the spool
+            for path in glob.glob(os.path.join(self.incoming_directory, "*", "*.part")):
+                os.remove(path)
+            self.Scan()
+            self.Scan()
+            
+            ae = AE(ae_title=self.ae_title)
+            ae.supported_contexts = StoragePresentationContexts + VerificationPresentationContexts
+            server = ae.start_server(("", self.port), block=False, 
+                                     evt_handlers=[(evt.EVT_C_STORE, self.Handle_Store)])
+            print("Listening on port " + str(self.port) + " as " + self.ae_title + ", spooling to " + self.incoming_directory)
+            catalog = main.dicom_catalog.Open(self.analysis.catalog_path, self.analysis.header_tags)
+            with ProcessPoolExecutor(max_workers=self.n_workers) as pool:
+                try:
+                    while True:
+                        self.Receive(catalog)
+                        self.Submit_Complete_Groups(pool)
+                        self.Collect_Results()
+                        time.sleep(self.poll_interval)
+                except KeyboardInterrupt:
+                    server.shutdown()
+                    self.Receive(catalog)
+                    self.Submit_Complete_Groups(pool)
+                    print("Stopping: waiting for " + str(len(self.running)) + " analyses to finish")
+                    for future in list(self.running.keys()):
+                        future.result()
+                    self.Collect_Results()
+                finally:
+                    if catalog is not None:
+                        catalog.Close()
+    
     def __init__(self, master):
         """
         Parameters
@@ -2278,7 +4283,8 @@ class main:
         """
         master.withdraw()
         initialised = self.initialise_analysis(self.Quarterly_path)
-        masks = self.initialise_masks(initialised.sorted_dcm_dict, initialised.lower_threshold, initialised.upper_threshold).mask_dict
+        masks = self.initialise_masks(initialised.sorted_dcm_dict, initialised.lower_threshold, initialised.upper_threshold, 
+                                      scanner_ID=initialised.scanner_ID, coil_name=initialised.coil_name).mask_dict
         SNRs = self.calculate_results(initialised.sorted_dcm_dict, masks, initialised.n_elements)
         if initialised.excel_export == True:
             self.export_to_excel(SNRs, initialised.scanner_ID, initialised.coil_name)
@@ -2289,7 +4295,34 @@ class main:
         master.destroy()
         
         
-main(root)
-
-root.mainloop()
+if __name__ == "__main__":
+    #guard required so worker processes don't start the GUI
+    parser = argparse.ArgumentParser(description="SNR and uniformity QC of multi element coils")
+    parser.add_argument("--watch", metavar="DIRECTORY", 
+                        help="headless mode: analyse SNR images as they arrive in DIRECTORY")
+    parser.add_argument("--batch", metavar="DIRECTORY", 
+                        help="headless mode: analyse all the SNR images in DIRECTORY (all scanners and coils)")
+    parser.add_argument("--listen", type=int, metavar="PORT", 
+                        help="headless mode: receive images over the network (DICOM C-STORE) on PORT")
+    parser.add_argument("--spool", metavar="DIRECTORY", default="dicom_spool", 
+                        help="directory images received with --listen are written to")
+    parser.add_argument("--ae-title", default="SASS_QC", help="AE title used with --listen")
+    parser.add_argument("--workers", type=int, default=2, help="number of acquisitions analysed at once")
+    parser.add_argument("--archive", metavar="DIRECTORY", help="archive DICOMs to DIRECTORY")
+    parser.add_argument("--figures", action="store_true", help="produce PNGs")
+    parser.add_argument("--no-excel", action="store_true", help="don't export results to excel")
+    args = parser.parse_args()
+    if args.batch is not None:
+        main.batch_run(args.batch, args.workers, args.archive, args.figures, not args.no_excel).Run()
+    elif args.listen is not None:
+        main.storage_scp(args.spool, args.listen, args.ae_title, args.workers, 
+                         args.archive, args.figures, not args.no_excel).Run()
+    elif args.watch is not None:
+        main.watch_folder(args.watch, args.workers, args.archive, args.figures, not args.no_excel).Run()
+    else:
+        root = tk.Tk()
+        root.title("Moriel QC")
+        root.geometry("800x800")
+        main(root)
+        root.mainloop()
 
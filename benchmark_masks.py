@@ -0,0 +1,133 @@
+"""
+Benchmark of initialise_masks.Contract_Mask (cv2 erosion) against the legacy
+Expand_and_Contract_Masks loop (kept in this script) used to produce the 
+phantom and air masks.
+
+A synthetic phantom (a disc, centred or cut off by the edge of the image) is
+masked at several matrix sizes.  The phantom
+mask (contracted by phantom_margin) and air mask (inverted and contracted by
+air_margin) are produced by both methods, compared and timed.  The legacy loop
+never contracts the first row/ column of the image so differences are only
+expected within air_margin pixels of those edges.
+
+The mask preview drawn for each threshold change in the review window is also
+timed: the legacy matplotlib figure (saved to PNG, decoded by PIL and resized)
+against Render_Overlay.
+
+usage: python benchmark_masks.py [matrix size ...]
+"""
+import io
+import sys
+import time
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+from PIL import Image
+from RF_Coil_QC_0_1 import main
+
+
+def Expand_and_Contract_Masks(original_mask, x_size, y_size, expand=True):
+    """Expand/contract original_mask by 1 pixel in all directions;
+    x_size and y_size are the dimensions of the image.
+    
+    Legacy initialise_masks method, replaced by Contract_Mask/ Expand_Mask.  
+    Pixels in the first row/ column are never contracted and expanding 
+    wraps around the image.
+    """
+    new_mask = np.full_like(original_mask,False)
+    for x in range(x_size):
+        for y in range(y_size):
+            if original_mask[x,y] == True:
+                if np.all(original_mask[x-1:x+2,y-1:y+2]):
+                    new_mask[x,y] = True
+                else:
+                    if expand == True:
+                        for i in range(3):
+                            for j in range(3):
+                                new_mask[x-1+i,y-1+j] = True
+                    else:
+                        new_mask[x,y] = False
+    return new_mask
+
+
+def Legacy_Masks(masks, img_mask):
+    size = img_mask.shape
+    phantom_mask = img_mask.astype(float)
+    for contract_px in range(masks.phantom_margin):
+        phantom_mask = Expand_and_Contract_Masks(phantom_mask, size[0], size[1], expand=False)
+    air_mask = (img_mask == False).astype(float)
+    for contract_px in range(masks.air_margin):
+        air_mask = Expand_and_Contract_Masks(air_mask, size[0], size[1], expand=False)
+    return phantom_mask.astype(np.bool_), air_mask.astype(np.bool_)
+
+
+def New_Masks(masks, img_mask):
+    return masks.Contract_Mask(img_mask, masks.phantom_margin), masks.Contract_Mask(~img_mask, masks.air_margin)
+
+
+def Run(sizes=(256, 512, 1024)):
+    masks = main.initialise_masks.__new__(main.initialise_masks)
+    for size in sizes:
+        yy, xx = np.mgrid[:size, :size]
+        #phantom filling most of the image and phantom cut off by the first row/ column
+        for position, centre in [("centred", 0.5), ("at edge", 0.3)]:
+            img_mask = (yy - size*centre)**2 + (xx - size*centre)**2 < (size*0.4)**2
+            Compare(masks, img_mask, size, position)
+
+
+def Legacy_Preview(dcm_filtered, img_mask):
+    test = np.ma.masked_where(img_mask==False, img_mask)
+    fig, ax = plt.subplots()
+    ax.imshow(dcm_filtered, cmap='gray', interpolation='none', alpha=0.4)
+    ax.imshow(test, 'spring', interpolation='none', alpha=0.2)
+    buf = io.BytesIO()
+    fig.savefig(buf)
+    buf.seek(0)
+    img = Image.open(buf)
+    plt.close(fig)
+    scale_factor = 800/img.size[0]
+    size = tuple((np.array(img.size) * scale_factor).astype(int))
+    return np.asarray(img.resize(size, resample=Image.NEAREST))
+
+
+def Run_Preview(sizes=(256, 512, 1024), n_repeats=5):
+    masks = main.initialise_masks.__new__(main.initialise_masks)
+    for size in sizes:
+        yy, xx = np.mgrid[:size, :size]
+        dcm_filtered = np.where((yy - size/2)**2 + (xx - size/2)**2 < (size*0.4)**2, 1000., 0.) + np.random.rand(size, size)*50
+        img_mask = dcm_filtered > 500
+        
+        start = time.perf_counter()
+        for repeat in range(n_repeats):
+            Legacy_Preview(dcm_filtered, img_mask)
+        legacy_time = (time.perf_counter() - start)/n_repeats
+        grey = masks.Get_Display_Image(dcm_filtered)
+        start = time.perf_counter()
+        for repeat in range(n_repeats):
+            rgb = masks.Render_Overlay(grey, img_mask)
+        new_time = (time.perf_counter() - start)/n_repeats
+        print("{:>5} x {:<5} preview   matplotlib {:8.4f} s  overlay {:8.5f} s  x{:8.0f}  {}x{} RGB".format(
+            size, size, legacy_time, new_time, legacy_time/new_time, rgb.shape[1], rgb.shape[0]))
+
+
+def Compare(masks, img_mask, size, position):
+    start = time.perf_counter()
+    legacy = Legacy_Masks(masks, img_mask)
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    new = New_Masks(masks, img_mask)
+    new_time = time.perf_counter() - start
+
+    edge = masks.air_margin
+    n_different = sum([np.count_nonzero(legacy_mask != new_mask) for legacy_mask, new_mask in zip(legacy, new)])
+    n_different_inside = sum([np.count_nonzero(legacy_mask[edge:, edge:] != new_mask[edge:, edge:]) 
+                              for legacy_mask, new_mask in zip(legacy, new)])
+    print("{:>5} x {:<5} {:<8} legacy {:8.3f} s  cv2 {:8.5f} s  x{:8.0f}  {} pixels differ ({} away from the first row/ column)".format(
+        size, size, position, legacy_time, new_time, legacy_time/new_time, n_different, n_different_inside))
+
+
+if __name__ == "__main__":
+    sizes = [[int(arg) for arg in sys.argv[1:]]] if len(sys.argv) > 1 else []
+    Run(*sizes)
+    Run_Preview(*sizes)
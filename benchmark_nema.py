@@ -0,0 +1,82 @@
+"""
+Benchmark of calculate_results.SNR_NEMA against the previous full frame
+subtraction np.int16(np.subtract(np.int32(a), np.int32(b)))[phantom_mask].
+
+Synthetic 16 bit repeats are generated with the phantom close to saturation
+and a few saturated/ dropped out voxels, so differences between the repeats
+exceed the int16 range.  The NEMA SNR of each is compared with the exact
+difference (float64 of the full frame), the peak memory allocated during a
+call (tracemalloc) and the time per call are printed.
+
+The results are only reported: SNR_NEMA is checked against the exact result by
+tests/test_nema_difference.py.
+
+usage: python benchmark_nema.py [matrix size ...]
+"""
+import sys
+import time
+import tracemalloc
+import numpy as np
+import RF_Coil_QC_0_1
+from RF_Coil_QC_0_1 import main
+
+
+def Legacy_NEMA(results, img_arr_1, img_arr_2, phantom_mask):
+    signal_arr = img_arr_1[phantom_mask]
+    noise_arr = np.int16(np.subtract(np.int32(img_arr_1), np.int32(img_arr_2)))[phantom_mask]
+    return round(results.bandwidth_scalar*(2**0.5)*np.mean(signal_arr)/np.std(noise_arr), 2)
+
+
+def Exact_NEMA(results, img_arr_1, img_arr_2, phantom_mask):
+    difference = np.trunc(img_arr_1.astype(np.float64)) - np.trunc(img_arr_2.astype(np.float64))
+    return round(results.bandwidth_scalar*(2**0.5)*np.mean(img_arr_1[phantom_mask])/np.std(difference[phantom_mask]), 2)
+
+
+def Make_Repeats(size, saturated_fraction=0.001):
+    yy, xx = np.mgrid[:size, :size]
+    radius = (yy - size/2)**2 + (xx - size/2)**2
+    phantom_mask = radius < (size*0.3)**2
+    repeats = []
+    for repeat in range(2):
+        image = np.where(radius < (size*0.35)**2, 60000., 0.) + np.random.normal(0, 300, (size, size))
+        #saturated and dropped out voxels: the difference between the repeats exceeds 32767
+        outliers = np.random.rand(size, size) < saturated_fraction
+        image[outliers] = 65535 if repeat == 0 else 0
+        repeats.append(np.uint16(np.clip(image, 0, 65535)))
+    return repeats[0], repeats[1], phantom_mask
+
+
+def Measure(function, n_repeats=10):
+    """Returns the result, peak bytes allocated during one call and mean time per call"""
+    tracemalloc.start()
+    result = function()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for repeat in range(n_repeats):
+        function()
+    return result, peak_bytes, (time.perf_counter() - start)/n_repeats
+
+
+def Run(sizes=(256, 512, 1024)):
+    results = main.calculate_results.__new__(main.calculate_results)
+    results.bandwidth_scalar = (222/130)**0.5
+    kernels = ["numpy", "numba"] if RF_Coil_QC_0_1.numba is not None else ["numpy"]
+    for size in sizes:
+        img_arr_1, img_arr_2, phantom_mask = Make_Repeats(size)
+        plan = main.mask_plan(phantom_mask)
+        exact = Exact_NEMA(results, img_arr_1, img_arr_2, phantom_mask)
+        SNR, peak_bytes, call_time = Measure(lambda: Legacy_NEMA(results, img_arr_1, img_arr_2, phantom_mask))
+        print("{:>5} x {:<5} exact SNR {:8.2f}   legacy         SNR {:8.2f} {:<9} peak {:8.2f} MB  {:8.5f} s".format(
+            size, size, exact, SNR, "(WRAPPED)" if SNR != exact else "", peak_bytes/1024**2, call_time))
+        for kernel in kernels:
+            results.use_compiled_kernel = kernel == "numba"
+            #compile
+            results.SNR_NEMA(img_arr_1, img_arr_2, phantom_mask, plan)
+            SNR, peak_bytes, call_time = Measure(lambda: results.SNR_NEMA(img_arr_1, img_arr_2, phantom_mask, plan))
+            print("{:>5} x {:<5} exact SNR {:8.2f}   SNR_NEMA {:<6}SNR {:8.2f} {:<9} peak {:8.2f} MB  {:8.5f} s".format(
+                size, size, exact, kernel, SNR, "same" if SNR == exact else "DIFFERENT", peak_bytes/1024**2, call_time))
+
+
+if __name__ == "__main__":
+    Run(*[[int(arg) for arg in sys.argv[1:]]] if len(sys.argv) > 1 else [])
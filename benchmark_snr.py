@@ -0,0 +1,177 @@
+"""
+Benchmark of calculate_results.SNR_Batch (all elements of a slice at once)
+against the per element SNR_Calculate_dcm calls previously made by
+Loop_Dicoms.
+
+Synthetic individual element images (a phantom with Rician-like noise and a
+different signal for each element) are generated for 2 repeats.  The SNRs of
+every element are calculated by both, checked to be the same and the time
+taken by each is printed.
+
+With numba installed the batch is timed with the compiled statistics kernel
+as well as the numpy reductions.
+
+The variance of the NEMA difference of every pair of 2 to 8 repeats 
+(Pair_Difference_Variances) is timed and checked against a python loop over 
+the pairs.
+
+The single image calculations (SNR_Moriel, SNR_NEMA and Uniformity_Calculate)
+are also timed with a mask_plan against the previous full frame boolean mask
+reductions.
+
+usage: python benchmark_snr.py [n_elements] [matrix size ...]
+"""
+import gc
+import sys
+import time
+import cv2
+import numpy as np
+from pydicom.dataset import Dataset
+import RF_Coil_QC_0_1
+from RF_Coil_QC_0_1 import main
+
+
+def Make_Stacks(n_elements, size, cache, n_repeats=2):
+    """Returns [<element_stack>] of the repeats and the phantom and air masks"""
+    yy, xx = np.mgrid[:size, :size]
+    radius = (yy - size/2)**2 + (xx - size/2)**2
+    phantom = radius < (size*0.35)**2
+    stacks = []
+    for repeat in range(n_repeats):
+        elements = {}
+        for element_n in range(1, n_elements+1):
+            signal = phantom*(500 + 40*element_n)
+            noise = np.hypot(np.random.normal(0, 12, (size, size)), np.random.normal(0, 12, (size, size)))
+            path = "repeat_" + str(repeat) + "_element_" + str(element_n)
+            cache.Add(path, np.uint16(signal + noise))
+            elements[element_n] = {"path":path, "dcm":main.dicom_handle(path, Dataset(), cache)}
+        stacks.append(main.element_stack.From_Dict(elements))
+    return stacks, radius < (size*0.3)**2, radius > (size*0.45)**2
+
+
+def Loop(results, stacks, phantom_mask, air_mask):
+    """The per element calculation previously made by Loop_Dicoms (full frame boolean masks)"""
+    SNRs = {}
+    for dcm_1, dcm_2, element_n in zip(stacks[0].dcms, stacks[1].dcms, stacks[0].element_ns):
+        results.bandwidth_scalar = results.Get_Bandwidth_Scalar(dcm_1)
+        img_arr_1, img_arr_2 = dcm_1.pixel_array, dcm_2.pixel_array
+        SNR_std_1, SNR_av_1, SNR_NEMA = Legacy_Single_Image(results, img_arr_1, img_arr_2, phantom_mask, air_mask)[:3]
+        SNR_std_2, SNR_av_2 = Legacy_Single_Image(results, img_arr_2, img_arr_1, phantom_mask, air_mask)[:2]
+        SNRs[element_n] = {"NEMA":SNR_NEMA, "noise_std":[SNR_std_1, SNR_std_2], "noise_av":[SNR_av_1, SNR_av_2]}
+    return SNRs
+
+
+def Legacy_Single_Image(results, img_arr_1, img_arr_2, phantom_mask, air_mask):
+    """SNR_Moriel, SNR_NEMA and Uniformity_Calculate with full frame boolean masks"""
+    scale_factors = results.element_scale_factors[1]
+    signal_av = np.mean(img_arr_1, where=phantom_mask)
+    noise_std = np.std(img_arr_1, where=air_mask)/scale_factors["SD"]
+    noise_av = np.mean(img_arr_1, where=air_mask)/scale_factors["Mean"]
+    noise_arr = np.int16(np.subtract(np.int32(img_arr_1), np.int32(img_arr_2)))[phantom_mask]
+    SNR_NEMA = round(results.bandwidth_scalar*(2**0.5)*np.mean(img_arr_1[phantom_mask])/np.std(noise_arr), 2)
+    ROI_voxels = cv2.filter2D(img_arr_1, -1, results.low_pass_filter)[phantom_mask]
+    uniformity = 1-((np.max(ROI_voxels)-np.min(ROI_voxels))/(np.max(ROI_voxels)+np.min(ROI_voxels)))
+    return (round(results.bandwidth_scalar*signal_av/noise_std, 2), round(results.bandwidth_scalar*signal_av/noise_av, 2), 
+            SNR_NEMA, uniformity)
+
+
+def Plan_Single_Image(results, img_arr_1, img_arr_2, plan):
+    return (results.SNR_Moriel(img_arr_1, None, None, 1, plan) + 
+            (results.SNR_NEMA(img_arr_1, img_arr_2, None, plan), results.Uniformity_Calculate(img_arr_1, None, plan)))
+
+
+def Run_Plan(sizes=(256, 512), n_repeats=20):
+    results = main.calculate_results.__new__(main.calculate_results)
+    results.bandwidth_scalar = (222/130)**0.5
+    for size in sizes:
+        cache = main.pixel_cache(2*size*size*2)
+        stacks, phantom_mask, air_mask = Make_Stacks(1, size, cache)
+        img_arr_1, img_arr_2 = [stack.Load()[0] for stack in stacks]
+        start = time.perf_counter()
+        plan = main.mask_plan(phantom_mask, air_mask)
+        plan_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for repeat in range(n_repeats):
+            legacy = Legacy_Single_Image(results, img_arr_1, img_arr_2, phantom_mask, air_mask)
+        legacy_time = (time.perf_counter() - start)/n_repeats
+        start = time.perf_counter()
+        for repeat in range(n_repeats):
+            new = Plan_Single_Image(results, img_arr_1, img_arr_2, plan)
+        new_time = (time.perf_counter() - start)/n_repeats
+        print("single image {:>5} x {:<5} boolean masks {:7.4f} s  mask_plan {:7.4f} s  x{:5.1f}  (plan built once in {:.4f} s)  {}".format(
+            size, size, legacy_time, new_time, legacy_time/new_time, plan_time, "same" if legacy == new else "DIFFERENT"))
+
+
+def Pair_Loop(results, phantom_voxels):
+    """Variance of the NEMA difference of each pair of repeats: a call per pair (vectorised over the elements)"""
+    return np.stack([np.var(results.NEMA_Difference(phantom_voxels[first], phantom_voxels[second]), axis=1)
+                     for first, second in zip(*np.triu_indices(len(phantom_voxels), 1))], axis=1)
+
+
+def Run_Repeats(n_elements=64, sizes=(256,), repeat_counts=(2, 4, 8), n_timings=5):
+    results = main.calculate_results.__new__(main.calculate_results)
+    results.use_compiled_kernel = False
+    for size in sizes:
+        for n_repeats in repeat_counts:
+            cache = main.pixel_cache(2*n_repeats*n_elements*size*size*2)
+            stacks, phantom_mask, air_mask = Make_Stacks(n_elements, size, cache, n_repeats)
+            plan = main.mask_plan(phantom_mask, air_mask)
+            phantom_voxels = [plan.Take(stack.Load(), "phantom") for stack in stacks]
+            timings = {"loop":[], "batch":[], "SNR_Batch":[]}
+            for timing in range(n_timings):
+                start = time.perf_counter()
+                loop = Pair_Loop(results, phantom_voxels)
+                timings["loop"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                batch = results.Pair_Difference_Variances(phantom_voxels)
+                timings["batch"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                results.SNR_Batch(stacks, phantom_mask, air_mask, 1, plan)
+                timings["SNR_Batch"].append(time.perf_counter() - start)
+            loop_time, batch_time, total_time = [min(timings[key]) for key in ["loop", "batch", "SNR_Batch"]]
+            print("{:>3} elements {:>5} x {:<5} {} repeats ({:>2} pairs) pair loop {:7.4f} s  Pair_Difference_Variances {:7.4f} s  x{:5.1f}  {}  (SNR_Batch {:7.4f} s)".format(
+                n_elements, size, size, n_repeats, loop.shape[1], loop_time, batch_time, loop_time/batch_time,
+                "same" if np.allclose(loop, batch, rtol=1e-10) else "DIFFERENT", total_time))
+
+
+def Run(n_elements=64, sizes=(256, 512)):
+    results = main.calculate_results.__new__(main.calculate_results)
+    for size in sizes:
+        cache = main.pixel_cache(4*n_elements*size*size*2)
+        stacks, phantom_mask, air_mask = Make_Stacks(n_elements, size, cache)
+
+        gc.collect()
+        start = time.perf_counter()
+        legacy = Loop(results, stacks, phantom_mask, air_mask)
+        legacy_time = time.perf_counter() - start
+        #copy the decoded arrays into the stacks (as Loop_Dicoms) so only the calculation is timed
+        for stack in stacks:
+            stack.Load()
+        batch_times = {}
+        for kernel in ["numpy", "numba"] if RF_Coil_QC_0_1.numba is not None else ["numpy"]:
+            results.use_compiled_kernel = kernel == "numba"
+            if kernel == "numba":
+                #compile
+                results.SNR_Batch(stacks, phantom_mask, air_mask, 1)
+            gc.collect()
+            start = time.perf_counter()
+            batch = results.SNR_Batch(stacks, phantom_mask, air_mask, 1)
+            batch_times[kernel] = time.perf_counter() - start
+
+            n_different = 0
+            for element_n, row in zip(stacks[0].element_ns, batch):
+                SNRs = legacy[element_n]
+                n_different += (SNRs["NEMA"] != row["SNR_NEMA"]) + sum([SNRs[SNR_type][repeat] != row["SNR_" + SNR_type][repeat]
+                                                                        for SNR_type in ["noise_std", "noise_av"] for repeat in range(2)])
+            print("{:>3} elements {:>5} x {:<5} per element {:7.3f} s  batch ({}) {:7.3f} s  x{:5.1f}  {}".format(
+                n_elements, size, size, legacy_time, kernel, batch_times[kernel], legacy_time/batch_times[kernel],
+                "same" if n_different == 0 else str(n_different) + " SNRs DIFFERENT"))
+
+
+if __name__ == "__main__":
+    arguments = [int(arg) for arg in sys.argv[1:]]
+    sizes = [arguments[1:]] if len(arguments) > 1 else []
+    Run(*arguments[:1], *sizes)
+    Run_Repeats(*arguments[:1], *sizes)
+    Run_Plan(*sizes)
@@ -0,0 +1,865 @@
+"""
+Benchmark of Sort_Dicom_Dict_By_Rules (sort_rules) against the legacy
+Sort_Dicom_Dict_* methods (kept in this script).
+
+Synthetic headers are generated for each type of scanner (many series of a
+single coil) and sorted by both.  The sorted dictionaries are checked to be
+the same and the time taken by each is printed.
+
+The series time clustering (Cluster_Series_Times) is also checked on a
+shuffled multi-session archive with fractional series times and sessions
+which cross midnight.
+
+usage: python benchmark_sorting.py [n_series] [n_elements] [n_sessions]
+"""
+import gc
+import sys
+import time
+import random
+import datetime
+import numpy as np
+from pydicom.dataset import Dataset
+from pydicom.tag import Tag
+from RF_Coil_QC_0_1 import main
+
+#Legacy sort methods of initialise_analysis, replaced by sort_rules and 
+#Sort_Dicom_Dict_By_Rules and kept here as the baseline.  Each takes the 
+#initialise_analysis instance (coil_dict, scanner_ID and coil_name) in place of self
+def Sort_Dicom_Dict_Ambition_X_PHT(analysis, dcm_dict):
+    sorted_dcm_dict={}
+    n_elements = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_elements"]
+    n_slices = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_slices"]
+    for path in dcm_dict:
+        dcm = dcm_dict[path]
+
+
+        if dcm.AcquisitionDate not in sorted_dcm_dict.keys():
+            sorted_dcm_dict[dcm.AcquisitionDate] = {}
+        if dcm.SeriesTime not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+            sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime] = {}
+        if dcm.AcquisitionTime not in sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime].keys():
+            sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime] = {}
+            sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime]["DelRec"] = {}
+            sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime]["Combined"] = {}
+            sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime]["Combined"][1] = {}
+            sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime]["DelRec"]["unsorted"] = {}
+        if dcm.ProtocolName[0:6] =="DelRec":
+            #individual elements
+            sorted_dcm_dict[dcm.AcquisitionDate][dcm.SeriesTime][dcm.AcquisitionTime]["DelRec"]["unsorted"][dcm.InstanceNumber] = {"path":path, "dcm":dcm}
+
+    for acq_date in sorted_dcm_dict:
+        for series_time in sorted_dcm_dict[acq_date]:
+            for acq_time in sorted_dcm_dict[acq_date][series_time]:
+                #assume 1 slice
+                n_slices = 1
+                n_elements = int(len(sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"]["unsorted"])/n_slices)
+                if analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_elements"] != n_elements:
+                    raise Exception("Incorrect number of elements for " + analysis.coil_name + str(n_elements) +" calculated")
+                if analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_slices"] != n_slices:
+                    raise Exception("Incorrect number of slices for " + analysis.coil_name + str(n_slices) +" calculated")
+                for  instance_n in sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"]["unsorted"]:
+                    slice_n = 1
+                    element_n = int(instance_n % n_elements)+1
+                    if slice_n not in sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"].keys():
+                        sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"][slice_n] = {}
+                    dcm = sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"]["unsorted"][instance_n]["dcm"]
+
+                    try:
+                        SoS_array = np.add(SoS_array,np.square(dcm.pixel_array.astype(float)))
+                    except UnboundLocalError:
+                        SoS_array = np.square(dcm.pixel_array.astype(float))
+
+                    sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"][slice_n][element_n] = sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"]["unsorted"][instance_n]
+                del sorted_dcm_dict[acq_date][series_time][acq_time]["DelRec"]["unsorted"]
+                sorted_dcm_dict[acq_date][series_time][acq_time]["Combined"][1]["pixel_array"] = np.sqrt(SoS_array)
+                del SoS_array
+
+
+
+    return sorted_dcm_dict
+
+
+def Sort_Dicom_Dict_Elition_X_PHT(analysis, dcm_dict):
+    sorted_dcm_dict={}
+    n_elements = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_elements"]
+    n_slices = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_slices"]
+    for path in dcm_dict:
+        dcm = dcm_dict[path]
+        #t1 = Tag(0x7a1103e)
+        t1 = Tag(0x0200013)
+        acquisition_number = dcm[t1].value
+        if dcm.SeriesDate not in sorted_dcm_dict.keys():
+            sorted_dcm_dict[dcm.SeriesDate] = {}
+        if dcm.SeriesTime not in sorted_dcm_dict[dcm.SeriesDate].keys():
+            sorted_dcm_dict[dcm.SeriesDate][dcm.SeriesTime] = {}
+            sorted_dcm_dict[dcm.SeriesDate][dcm.SeriesTime]["unsorted"] = {}
+
+        if dcm.ProtocolName[0:6] =="DelRec":
+            #individual elements
+            sorted_dcm_dict[dcm.SeriesDate][dcm.SeriesTime]["unsorted"][acquisition_number] = {"path":path, "dcm":dcm}
+
+    for acq_date in sorted_dcm_dict:
+        for series_time in sorted_dcm_dict[acq_date]:
+             #assume 1 slice
+            n_slices = 1
+            n_elements = int(len(sorted_dcm_dict[acq_date][series_time]["unsorted"])/(2*n_slices))
+            if analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_elements"] != n_elements:
+                raise Exception("Incorrect number of elements for " + analysis.coil_name + ", " + str(n_elements) +" calculated")
+            if analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_slices"] != n_slices:
+                raise Exception("Incorrect number of slices for " + analysis.coil_name + str(n_slices) +" calculated")
+            if len(sorted_dcm_dict[acq_date][series_time]["unsorted"]) == 2:
+                #single element
+                for image_n in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
+                    sorted_dcm_dict[acq_date][series_time][image_n] = {}
+                    sorted_dcm_dict[acq_date][series_time][image_n]["DelRec"] = {}
+                    sorted_dcm_dict[acq_date][series_time][image_n]["Combined"] = {}
+                    sorted_dcm_dict[acq_date][series_time][image_n]["Combined"][1] = sorted_dcm_dict[dcm.SeriesDate][dcm.SeriesTime]["unsorted"][image_n]
+                    sorted_dcm_dict[acq_date][series_time][image_n]["DelRec"][1] = {}
+                    sorted_dcm_dict[acq_date][series_time][image_n]["DelRec"][1][1] = sorted_dcm_dict[dcm.SeriesDate][dcm.SeriesTime]["unsorted"][image_n]
+
+                del sorted_dcm_dict[acq_date][series_time]["unsorted"]
+            else:
+                SoS_arrays = {}
+                for image_n in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
+                    slice_n = 1
+                    element_n = int(image_n % n_elements)+1
+                    repeat_n = int((image_n-1)/n_elements)
+
+                    if repeat_n not in sorted_dcm_dict[acq_date][series_time].keys():
+                        sorted_dcm_dict[acq_date][series_time][repeat_n] = {}
+                        sorted_dcm_dict[acq_date][series_time][repeat_n]["DelRec"] = {}
+                        sorted_dcm_dict[acq_date][series_time][repeat_n]["Combined"] = {}
+                        sorted_dcm_dict[acq_date][series_time][repeat_n]["DelRec"][1] = {}
+                        sorted_dcm_dict[acq_date][series_time][repeat_n]["Combined"][1] = {}
+
+                    sorted_dcm_dict[acq_date][series_time][repeat_n]["DelRec"][1][element_n] = sorted_dcm_dict[acq_date][series_time]["unsorted"][image_n]
+
+
+                    dcm = sorted_dcm_dict[acq_date][series_time]["unsorted"][image_n]["dcm"]
+
+                    try:
+                        SoS_arrays[repeat_n] = np.add(SoS_arrays[repeat_n],np.square(dcm.pixel_array.astype(float)))
+                    except KeyError:
+                        SoS_arrays[repeat_n] = np.square(dcm.pixel_array.astype(float))
+
+                    sorted_dcm_dict[acq_date][series_time][repeat_n]["DelRec"][slice_n][element_n] = sorted_dcm_dict[acq_date][series_time]["unsorted"][image_n]
+
+                for repeat_n in SoS_arrays:
+                    sorted_dcm_dict[acq_date][series_time][repeat_n]["Combined"][1]["pixel_array"] = np.sqrt(SoS_arrays[repeat_n])
+                del sorted_dcm_dict[acq_date][series_time]["unsorted"]
+                del SoS_arrays
+
+
+
+    return sorted_dcm_dict
+
+
+def Sort_Dicom_Dict_Siemens(analysis, dcm_dict):
+    #LEGACY SORTING METHOD FOR SIEMENS SCANNERS
+    sorted_dcm_dict={}
+
+    for path in dcm_dict:
+        dcm = dcm_dict[path]
+
+        #a=dcm.dir()
+        if dcm.AcquisitionDate not in sorted_dcm_dict.keys():
+            sorted_dcm_dict[dcm.AcquisitionDate] = {}
+        """Series times of the Siemens individual elements and combined images are <10ms different. Need to check not already a series with a series time <1 second different """
+
+        if dcm.SeriesTime not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+            test_time = str(int(dcm.SeriesTime) + 1).zfill(6)
+            if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+                test_time = str(int(dcm.SeriesTime) - 1).zfill(6)
+                if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+                    series_time = dcm.SeriesTime
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"] = {}
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["Combined"] = {}
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"]["unsorted"] = {}
+                else:
+                    series_time = test_time
+            else:
+                series_time = test_time
+        else:
+            series_time = dcm.SeriesTime
+
+
+        #Image Number (InstanceNumber) is slice number
+        if "NORM" in dcm.ImageType._list:
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["Combined"][dcm.InstanceNumber] = {"path":path, "dcm":dcm}
+        else:
+            #individual elements
+            if dcm.InstanceNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"]["unsorted"]:
+                sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"]["unsorted"][dcm.InstanceNumber] = {}
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"]["unsorted"][dcm.InstanceNumber][dcm.ContentTime] = {"path":path, "dcm":dcm}
+
+
+    for acq_date in sorted_dcm_dict:
+        for series_time in sorted_dcm_dict[acq_date]:
+            n_slices = len(sorted_dcm_dict[acq_date][series_time]["unsorted"]["Combined"])
+            n_elements = len(sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"]["unsorted"][1])
+            if analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_elements"] != n_elements:
+                raise Exception("Incorrect number of elements for " + analysis.coil_name + str(n_elements) +" calculated")
+            if analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_slices"] != n_slices:
+                raise Exception("Incorrect number of slices for " + analysis.coil_name + str(n_slices) +" calculated")
+            for  slice_n in sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"]["unsorted"]:
+                if slice_n not in sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"].keys():
+                    sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"][slice_n] = {}
+
+                acq_times = [*sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"]["unsorted"][slice_n]]
+                acq_times.sort()
+                for i in range(len(acq_times)):
+                    acq_time = acq_times[i]
+                    element_n = 1 + i
+                    sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"][slice_n][element_n] = sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"]["unsorted"][slice_n][acq_time]
+            del sorted_dcm_dict[acq_date][series_time]["unsorted"]["DelRec"]["unsorted"]
+
+    for acq_date in sorted_dcm_dict:
+        series_times = list(sorted_dcm_dict[acq_date].keys())
+        series_times.sort()
+        if len(series_times) % 2 != 0:
+            del series_times[-1]
+        for i in range(len(series_times)):
+            current_series_time = series_times[i]
+            if i % 2 == 0:
+                new_series_time = current_series_time
+                acq_number = "0"
+            else:
+                new_series_time = series_times[i-1]
+                acq_number = "1"
+
+            sorted_dcm_dict[acq_date][new_series_time][current_series_time] = sorted_dcm_dict[acq_date][current_series_time]["unsorted"]
+
+            if acq_number == "0":
+                del sorted_dcm_dict[acq_date][current_series_time]["unsorted"]
+            else:
+                del sorted_dcm_dict[acq_date][current_series_time]
+
+
+
+    return sorted_dcm_dict
+
+
+def Sort_Dicom_Dict_Siemens_Avanto_RBH_PHT(analysis, dcm_dict):
+    """
+    Parameters
+    ----------
+    dcm_dict : dict
+        Dictionary of dicoms of the form {<path>:<dicom>}
+
+    Returns
+    -------
+    sorted_dcm_dict : dict
+        Dictionary of dicoms of the form {<Date>:{<Series Time>:
+        {<repeat_number>:{"DelRec":{<Slice number>:{<element number>:
+                                {"path":<path>, "dcm":<DICOM>}}},
+                        "Combined":{<Slice number>:
+                                {"path":<path>, "dcm":<DICOM>}}}}}}
+
+    Sorts DICOMs exported from RBH Sielems Sola (MR3).  Images are sorted by:
+        -Acquisition Date: all images should be acquired on the same date
+        -Series Time: There should be 2 repeats for each series time.  Each repeat should have corresponding combined and individual element images
+        -Repeat number: should be 2 repeats
+        -Image type: Sorts images into combined("Combined" and individual element images("DelRec")
+        -Slice number:  Legacy from old analysis when multiple slices were acquired per coil.  Now only a single slice is used
+        -Element number:  Only a key for DelRec
+    """
+    #dictionary to be populated
+    sorted_dcm_dict={}
+    for path in dcm_dict:
+        dcm = dcm_dict[path]
+        if dcm.AcquisitionDate not in sorted_dcm_dict.keys():
+            sorted_dcm_dict[dcm.AcquisitionDate] = {}
+        """Series times of the Siemens individual elements and combined images are <10ms different. Need to check not already a series with a series time <1 second different """
+
+        if dcm.SeriesTime not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+            test_time = str(int(dcm.SeriesTime) + 1).zfill(6)
+            if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+                test_time = str(int(dcm.SeriesTime) - 1).zfill(6)
+                if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+                    series_time = dcm.SeriesTime
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
+                else:
+                    series_time = test_time
+            else:
+                series_time = test_time
+        else:
+            series_time = dcm.SeriesTime
+
+
+
+        if series_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
+
+        if dcm.SeriesNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]:
+            #seperate uncombined and combined by series number
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber] = {}
+        if dcm.InstanceNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber]:
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {}
+
+        #Initially sort DICOMS by Series Number and Instance number
+        #these are used to assess if the acquisition is a combined acquisition/ delrec
+        #and what the element number is
+
+
+        if dcm.InstanceCreationTime not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber]:
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber][dcm.InstanceCreationTime] = {}
+
+        sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber][dcm.InstanceCreationTime] = {"path":path, "dcm":dcm}
+
+
+    n_elements = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_elements"]
+    n_slices = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_slices"]
+    for acq_date in sorted_dcm_dict:
+        for series_time in sorted_dcm_dict[acq_date]:
+            for series_number in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
+                repeat_ns=list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number].keys())
+                if len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_ns[0]]) == n_slices:
+                    #combined_elements_image
+                    image_type = "Combined"
+                    for repeat_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
+                        repeat_number_int = int(repeat_number)
+                        if repeat_number_int not in sorted_dcm_dict[acq_date][series_time]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int] = {}
+                        if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number_int]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type] = {}
+                            #1 slice
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = {}
+                        instance_times = list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number].keys())
+                        if len(instance_times) != 1:
+                            print("Sort Failed")
+                        sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number][instance_times[0]]
+                elif len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_ns[0]]) == n_slices*n_elements:
+                    #number of del rec images is elements*slices*2
+                    #individual_elements_image
+                    image_type = "DelRec"
+
+                    for repeat_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
+                        repeat_number_int = int(repeat_number)
+                        if repeat_number_int not in sorted_dcm_dict[acq_date][series_time]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int] = {}
+                        if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number_int]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type] = {}
+                            #1 slice
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = {}
+
+                        instance_times = sorted(list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number].keys()),key=float)
+                        for instance_time in instance_times:
+                            element_number = instance_times.index(instance_time)+1
+                            if element_number not in sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1]:
+                                sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = {}
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number][instance_time]
+
+            del sorted_dcm_dict[acq_date][series_time]["unsorted"]
+    return sorted_dcm_dict
+
+
+def Sort_Dicom_Dict_Siemens_Avanto_DCH(analysis, dcm_dict):
+    """
+    Parameters
+    ----------
+    dcm_dict : dict
+        Dictionary of dicoms of the form {<path>:<dicom>}
+
+    Returns
+    -------
+    sorted_dcm_dict : dict
+        Dictionary of dicoms of the form {<Date>:{<Series Time>:
+        {<repeat_number>:{"DelRec":{<Slice number>:{<element number>:
+                                {"path":<path>, "dcm":<DICOM>}}},
+                        "Combined":{<Slice number>:
+                                {"path":<path>, "dcm":<DICOM>}}}}}}
+
+    Sorts DICOMs exported from RBH Sielems Sola (MR3).  Images are sorted by:
+        -Acquisition Date: all images should be acquired on the same date
+        -Series Time: There should be 2 repeats for each series time.  Each repeat should have corresponding combined and individual element images
+        -Repeat number: should be 2 repeats
+        -Image type: Sorts images into combined("Combined" and individual element images("DelRec")
+        -Slice number:  Legacy from old analysis when multiple slices were acquired per coil.  Now only a single slice is used
+        -Element number:  Only a key for DelRec
+    """
+    #dictionary to be populated
+    sorted_dcm_dict={}
+    for path in dcm_dict:
+        dcm = dcm_dict[path]
+        if dcm.AcquisitionDate not in sorted_dcm_dict.keys():
+            sorted_dcm_dict[dcm.AcquisitionDate] = {}
+        """Series times of the Siemens individual elements and combined images are <10ms different. Need to check not already a series with a series time <1 second different """
+
+        if str(int(float(dcm.SeriesTime))).zfill(6) not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+            test_time = str(int(float(dcm.SeriesTime)) + 1).zfill(6)
+            if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+                test_time = str(int(float(dcm.SeriesTime)) - 1).zfill(6)
+                if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+                    series_time = str(int(float(dcm.SeriesTime))).zfill(6)
+                else:
+                    series_time = test_time
+            else:
+                series_time = test_time
+        else:
+            series_time = str(int(float(dcm.SeriesTime))).zfill(6)
+
+
+
+        if series_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
+
+        if dcm.SeriesNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]:
+            #seperate uncombined and combined by series number
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber] = {}
+        if dcm.InstanceNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber]:
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {}
+
+        #Initially sort DICOMS by Series Number and Instance number
+        #these are used to assess if the acquisition is a combined acquisition/ delrec
+        #and what the element number is
+
+
+        if dcm.InstanceCreationTime not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber]:
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber][dcm.InstanceCreationTime] = {}
+
+        sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber][dcm.InstanceCreationTime] = {"path":path, "dcm":dcm}
+
+
+    n_elements = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_elements"]
+    n_slices = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_slices"]
+    for acq_date in sorted_dcm_dict:
+        for series_time in sorted_dcm_dict[acq_date]:
+            for series_number in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
+                repeat_ns=list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number].keys())
+                if len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_ns[0]]) == n_slices:
+                    #combined_elements_image
+                    image_type = "Combined"
+                    for repeat_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
+                        repeat_number_int = int(repeat_number)
+                        if repeat_number_int not in sorted_dcm_dict[acq_date][series_time]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int] = {}
+                        if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number_int]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type] = {}
+                            #1 slice
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = {}
+                        instance_times = list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number].keys())
+                        if len(instance_times) != 1:
+                            print("Sort Failed")
+                        sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number][instance_times[0]]
+                elif len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_ns[0]]) == n_slices*n_elements:
+                    #number of del rec images is elements*slices*2
+                    #individual_elements_image
+                    image_type = "DelRec"
+
+                    for repeat_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
+                        repeat_number_int = int(repeat_number)
+                        if repeat_number_int not in sorted_dcm_dict[acq_date][series_time]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int] = {}
+                        if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number_int]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type] = {}
+                            #1 slice
+                            sorted_dcm_dict[acq_date][series_time][repeat_number_int][image_type][1] = {}
+
+                        instance_times = sorted(list(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number].keys()),key=float)
+                        for instance_time in instance_times:
+                            element_number = instance_times.index(instance_time)+1
+                            if element_number not in sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1]:
+                                sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = {}
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][repeat_number][instance_time]
+
+            del sorted_dcm_dict[acq_date][series_time]["unsorted"]
+    return sorted_dcm_dict
+
+
+def Sort_Dicom_Dict_Siemens_Sola_RBH(analysis, dcm_dict):
+    """
+    Parameters
+    ----------
+    dcm_dict : dict
+        Dictionary of dicoms of the form {<path>:<dicom>}
+
+    Returns
+    -------
+    sorted_dcm_dict : dict
+        Dictionary of dicoms of the form {<Date>:{<Series Time>:
+        {<repeat_number>:{"DelRec":{<Slice number>:{<element number>:
+                                {"path":<path>, "dcm":<DICOM>}}},
+                        "Combined":{<Slice number>:
+                                {"path":<path>, "dcm":<DICOM>}}}}}}
+
+    Sorts DICOMs exported from RBH Sielems Sola (MR3).  Images are sorted by:
+        -Acquisition Date: all images should be acquired on the same date
+        -Series Time: There should be 2 repeats for each series time.  Each repeat should have corresponding combined and individual element images
+        -Repeat number: should be 2 repeats
+        -Image type: Sorts images into combined("Combined" and individual element images("DelRec")
+        -Slice number:  Legacy from old analysis when multiple slices were acquired per coil.  Now only a single slice is used
+        -Element number:  Only a key for DelRec
+    """
+    #dictionary to be populated
+    sorted_dcm_dict={}
+    for path in dcm_dict:
+        dcm = dcm_dict[path]
+
+        #a=dcm.dir()
+        if dcm.AcquisitionDate not in sorted_dcm_dict.keys():
+            sorted_dcm_dict[dcm.AcquisitionDate] = {}
+        """Series times of the Siemens individual elements and combined images are <10ms different. Need to check not already a series with a series time <1 second different """
+
+        if dcm.SeriesTime not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+            test_time = str(int(dcm.SeriesTime) + 1).zfill(6)
+            if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+                test_time = str(int(dcm.SeriesTime) - 1).zfill(6)
+                if test_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+                    series_time = dcm.SeriesTime
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"] = {}
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["Combined"] = {}
+                    sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]["DelRec"]["unsorted"] = {}
+                else:
+                    series_time = test_time
+            else:
+                series_time = test_time
+        else:
+            series_time = dcm.SeriesTime
+
+
+
+        if series_time not in sorted_dcm_dict[dcm.AcquisitionDate].keys():
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time] = {}
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"] = {}
+
+        if dcm.SeriesNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"]:
+            #seperate uncombined and combined by series number
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber] = {}
+        if dcm.InstanceNumber not in sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber]:
+            sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {}
+
+        #Initially sort DICOMS by Series Number and Instance number
+        #these are used to assess if the acquisition is a combined acquisition/ delrec
+        #and what the element number is
+        sorted_dcm_dict[dcm.AcquisitionDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {"path":path, "dcm":dcm}
+
+
+    n_elements = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_elements"]
+    n_slices = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_slices"]
+    for acq_date in sorted_dcm_dict:
+        for series_time in sorted_dcm_dict[acq_date]:
+            for series_number in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
+                if len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]) == 2*n_slices:
+                    #combined_elements_image
+                    image_type = "Combined"
+                    for image_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
+                        repeat_number = int(image_number)
+                        if repeat_number not in sorted_dcm_dict[acq_date][series_time]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number] = {}
+                        if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type] = {}
+                            #1 slice
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = {}
+                        sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][image_number]
+                elif len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]) == 2*n_slices*n_elements:
+                    #number of del rec images is elements*slices*2
+                    #individual_elements_image
+                    image_type = "DelRec"
+
+                    for image_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
+
+                        element_number = image_number % n_elements
+                        if element_number == 0:
+                            element_number = n_elements
+                        if element_number == image_number:
+                            repeat_number = 1
+                        else:
+                            repeat_number = 2
+                        if repeat_number not in sorted_dcm_dict[acq_date][series_time]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number] = {}
+                        if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type] = {}
+                            #1 slice
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = {}
+                        if element_number not in sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = {}
+                        sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][image_number]
+
+            del sorted_dcm_dict[acq_date][series_time]["unsorted"]
+    return sorted_dcm_dict
+
+
+def Sort_Dicom_Dict_Siemens_Sola_DCH(analysis, dcm_dict):
+    """
+    Parameters
+    ----------
+    dcm_dict : dict
+        Dictionary of dicoms of the form {<path>:<dicom>}
+
+    Returns
+    -------
+    sorted_dcm_dict : dict
+        Dictionary of dicoms of the form {<Date>:{<Series Time>:
+        {<repeat_number>:{"DelRec":{<Slice number>:{<element number>:
+                                {"path":<path>, "dcm":<DICOM>}}},
+                        "Combined":{<Slice number>:
+                                {"path":<path>, "dcm":<DICOM>}}}}}}
+
+    Sorts DICOMs exported from DCH Sielems Sola (MR2).  Images are sorted by:
+        -Acquisition Date: all images should be acquired on the same date
+        -Series Time: There should be 2 repeats for each series time.  Each repeat should have corresponding combined and individual element images
+        -Repeat number: should be 2 repeats
+        -Image type: Sorts images into combined("Combined" and individual element images("DelRec")
+        -Slice number:  Legacy from old analysis when multiple slices were acquired per coil.  Now only a single slice is used
+        -Element number:  Only a key for DelRec
+    """
+    sorted_dcm_dict={}
+
+    for path in dcm_dict:
+        dcm = dcm_dict[path]
+
+
+        if dcm.SeriesDate not in sorted_dcm_dict.keys():
+            sorted_dcm_dict[dcm.SeriesDate] = {}
+        """Series times of the Siemens individual elements and combined images are <10ms different. Need to check not already a series with a series time <1 second different """
+
+        #a=dcm.dir("")
+        #print(dcm)
+
+        if str(int(float(dcm.SeriesTime))) not in sorted_dcm_dict[dcm.SeriesDate].keys():
+            test_time = str(int(float(dcm.SeriesTime)) + 1)
+            if test_time not in sorted_dcm_dict[dcm.SeriesDate].keys():
+                test_time = str(int(float(dcm.SeriesTime)) - 1)
+                if test_time not in sorted_dcm_dict[dcm.SeriesDate].keys():
+                    series_time = str(int(float(dcm.SeriesTime)))
+                    sorted_dcm_dict[dcm.SeriesDate][series_time] = {}
+                    sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"] = {}
+                    sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"]["DelRec"] = {}
+                    sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"]["Combined"] = {}
+                    sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"]["DelRec"]["unsorted"] = {}
+                else:
+                    series_time = test_time
+            else:
+                series_time = test_time
+        else:
+            series_time = str(int(float(dcm.SeriesTime)))
+
+
+
+        if series_time not in sorted_dcm_dict[dcm.SeriesDate].keys():
+            sorted_dcm_dict[dcm.SeriesDate][series_time] = {}
+            sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"] = {}
+
+        if dcm.SeriesNumber not in sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"]:
+            #seperate uncombined and combined by series number
+            sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"][dcm.SeriesNumber] = {}
+        if dcm.InstanceNumber not in sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"][dcm.SeriesNumber]:
+            sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {}
+        #Initially sort DICOMS by Series Number and Instance number
+        #these are used to assess if the acquisition is a combined acquisition/ delrec
+        #and what the element number is
+        sorted_dcm_dict[dcm.SeriesDate][series_time]["unsorted"][dcm.SeriesNumber][dcm.InstanceNumber] = {"path":path, "dcm":dcm}
+
+
+    n_elements = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_elements"]
+    n_slices = analysis.coil_dict[analysis.scanner_ID][analysis.coil_name]["n_slices"]
+    for acq_date in sorted_dcm_dict:
+        for series_time in sorted_dcm_dict[acq_date]:
+            for series_number in sorted_dcm_dict[acq_date][series_time]["unsorted"]:
+                if len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]) == 2*n_slices:
+                    #combined_elements_image
+                    image_type = "Combined"
+                    for image_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
+                        repeat_number = int(image_number)
+                        if repeat_number not in sorted_dcm_dict[acq_date][series_time]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number] = {}
+                        if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type] = {}
+                            #1 slice
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = {}
+                        sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][image_number]
+                elif len(sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]) == 2*n_slices*n_elements:
+                    #number of del rec images is elements*slices*2
+                    #individual_elements_image
+                    image_type = "DelRec"
+
+                    for image_number in sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number]:
+
+                        element_number = image_number % n_elements
+                        if element_number == 0:
+                            element_number = n_elements
+                        if element_number == image_number:
+                            repeat_number = 1
+                        else:
+                            repeat_number = 2
+                        if repeat_number not in sorted_dcm_dict[acq_date][series_time]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number] = {}
+                        if image_type not in sorted_dcm_dict[acq_date][series_time][repeat_number]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type] = {}
+                            #1 slice
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1] = {}
+                        if element_number not in sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1]:
+                            sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = {}
+                        sorted_dcm_dict[acq_date][series_time][repeat_number][image_type][1][element_number] = sorted_dcm_dict[acq_date][series_time]["unsorted"][series_number][image_number]
+
+            del sorted_dcm_dict[acq_date][series_time]["unsorted"]
+    return sorted_dcm_dict
+
+
+#{<sort_rules key>: <legacy sort function>}
+legacy_methods = {"Ambition_X_PHT":"Sort_Dicom_Dict_Ambition_X_PHT",
+                  "Elition_X_PHT":"Sort_Dicom_Dict_Elition_X_PHT",
+                  "Siemens":"Sort_Dicom_Dict_Siemens",
+                  "Siemens_Avanto_RBH_PHT":"Sort_Dicom_Dict_Siemens_Avanto_RBH_PHT",
+                  "Siemens_Avanto_DCH":"Sort_Dicom_Dict_Siemens_Avanto_DCH",
+                  "Siemens_Sola_RBH":"Sort_Dicom_Dict_Siemens_Sola_RBH",
+                  "Siemens_Sola_DCH":"Sort_Dicom_Dict_Siemens_Sola_DCH"}
+
+
+def Series_Time(series_n, offset=0, fraction=""):
+    """HHMMSS series time of series_n (series are 20 s apart)"""
+    seconds = 7*3600 + series_n*20 + offset
+    return "{:02d}{:02d}{:02d}".format(seconds//3600, (seconds//60) % 60, seconds % 60) + fraction
+
+
+def Make_Header(**tags):
+    header = Dataset()
+    header.AcquisitionDate = "20240101"
+    header.SeriesDate = "20240101"
+    for tag_name, value in tags.items():
+        setattr(header, tag_name, value)
+    return header
+
+
+def Make_Headers(scanner, n_series, n_elements):
+    """Returns [<header>] of n_series acquisitions (2 repeats) for scanner"""
+    headers = []
+    fraction = ".123456" if scanner in ["Siemens_Avanto_DCH", "Siemens_Sola_DCH"] else ""
+    for series_n in range(n_series):
+        if scanner == "Ambition_X_PHT":
+            for repeat_n in range(2):
+                for instance_n in range(1, n_elements+1):
+                    headers.append(Make_Header(SeriesTime=Series_Time(series_n), ProtocolName="DelRec_SNR",
+                                               AcquisitionTime=Series_Time(series_n, 5+repeat_n*5),
+                                               InstanceNumber=instance_n))
+        elif scanner == "Elition_X_PHT":
+            for instance_n in range(1, 2*n_elements+1):
+                headers.append(Make_Header(SeriesTime=Series_Time(series_n), ProtocolName="DelRec_SNR",
+                                           InstanceNumber=instance_n))
+        elif scanner == "Siemens":
+            for repeat_n in range(2):
+                series_time = 2*series_n + repeat_n
+                headers.append(Make_Header(SeriesTime=Series_Time(series_time), InstanceNumber=1,
+                                           ImageType=["ORIGINAL", "PRIMARY", "M", "NORM", "DIS2D"],
+                                           ContentTime=Series_Time(series_time, 2)))
+                for element_n in range(n_elements):
+                    headers.append(Make_Header(SeriesTime=Series_Time(series_time, 1), InstanceNumber=1,
+                                               ImageType=["ORIGINAL", "PRIMARY", "M", "ND"],
+                                               ContentTime=Series_Time(series_time, 2, "." + str(element_n).zfill(3))))
+        elif scanner in ["Siemens_Avanto_RBH_PHT", "Siemens_Avanto_DCH"]:
+            for repeat_n in range(1, 3):
+                headers.append(Make_Header(SeriesTime=Series_Time(series_n, 0, fraction), SeriesNumber=2*series_n+1,
+                                           InstanceNumber=repeat_n, InstanceCreationTime=Series_Time(series_n, 3*repeat_n)))
+                for element_n in range(n_elements):
+                    headers.append(Make_Header(SeriesTime=Series_Time(series_n, 1, fraction), SeriesNumber=2*series_n+2,
+                                               InstanceNumber=repeat_n,
+                                               InstanceCreationTime=Series_Time(series_n, 3*repeat_n, "." + str(element_n).zfill(3))))
+        else:
+            for instance_n in range(1, 3):
+                headers.append(Make_Header(SeriesTime=Series_Time(series_n, 0, fraction), SeriesNumber=2*series_n+1,
+                                           InstanceNumber=instance_n))
+            for instance_n in range(1, 2*n_elements+1):
+                headers.append(Make_Header(SeriesTime=Series_Time(series_n, 1, fraction), SeriesNumber=2*series_n+2,
+                                           InstanceNumber=instance_n))
+    return headers
+
+
+def Make_Dicom_Dict(headers, cache):
+    """{<path>:<dicom_handle>} with small random pixel arrays held in cache"""
+    dcm_dict = {}
+    for i, header in enumerate(headers):
+        path = "image_" + str(i)
+        cache.Add(path, np.random.randint(0, 4096, (8, 8)).astype(np.uint16))
+        dcm_dict[path] = main.dicom_handle(path, header, cache)
+    return dcm_dict
+
+
+def Compare(legacy, new, location="sorted_dcm_dict"):
+    """Returns a description of the first difference between 2 sorted dictionaries (None = same)"""
+    if isinstance(legacy, np.ndarray):
+        return None if np.allclose(legacy, new) else location + ": pixel arrays differ"
+    if not isinstance(legacy, dict):
+        return None if legacy is new or legacy == new else location + ": " + str(legacy) + " != " + str(new)
+    if list(legacy.keys()) != list(new.keys()):
+        return location + ": keys " + str(list(legacy.keys())) + " != " + str(list(new.keys()))
+    for key in legacy:
+        difference = Compare(legacy[key], new[key], location + "[" + repr(key) + "]")
+        if difference is not None:
+            return difference
+    return None
+
+
+def Run_Clustering(n_sessions=2000, n_series=20, tolerance=1):
+    """
+    Each session has n_series acquisitions 30 s apart, each saved as a
+    combined and an individual element series up to 0.9 s apart.  Every
+    10th session starts just before midnight so its series cross to the
+    next day.
+    """
+    analysis = main.initialise_analysis.__new__(main.initialise_analysis)
+    rules = dict(analysis.sort_rules["Siemens_Sola_DCH"], series_tolerance=tolerance)
+    series_times = []
+    expected = {}
+    start_date = datetime.datetime(2020, 1, 1)
+    for session_n in range(n_sessions):
+        if session_n % 10 == 0:
+            session_start = start_date + datetime.timedelta(days=session_n, hours=23, minutes=59, seconds=59)
+        else:
+            session_start = start_date + datetime.timedelta(days=session_n, hours=8)
+        for series_n in range(n_series):
+            acquisition = session_start + datetime.timedelta(seconds=30*series_n, microseconds=random.randint(0, 99)*10000)
+            key = (acquisition.strftime("%Y%m%d"), acquisition.strftime("%H%M%S.%f"))
+            for image_offset in [0, random.randint(1, 90)*10000]:
+                image_time = acquisition + datetime.timedelta(microseconds=image_offset)
+                series_time = (image_time.strftime("%Y%m%d"), image_time.strftime("%H%M%S.%f"))
+                series_times.append(series_time)
+                expected[series_time] = key
+    random.shuffle(series_times)
+
+    gc.collect()
+    start = time.perf_counter()
+    series_keys, series_order = analysis.Cluster_Series_Times(series_times, rules)
+    cluster_time = time.perf_counter() - start
+    n_wrong = len([1 for series_time in expected 
+                   if series_keys[series_time] != (expected[series_time][0], str(int(float(expected[series_time][1]))))])
+    print("{:<24}{:>7} times   {:>6} series  {:7.3f} s  {}".format(
+        "Cluster_Series_Times", len(series_times), len(series_order), cluster_time,
+        "correct" if n_wrong == 0 and len(series_order) == n_sessions*n_series else str(n_wrong) + " WRONG"))
+
+
+def Run(n_series=500, n_elements=16):
+    analysis = main.initialise_analysis.__new__(main.initialise_analysis)
+    analysis.scanner_ID = "0000"
+    analysis.coil_name = "benchmark"
+    main.initialise_analysis.coil_dict["0000"]["benchmark"] = {"n_slices":1, "n_elements":n_elements}
+    for scanner in legacy_methods:
+        headers = Make_Headers(scanner, n_series, n_elements)
+        cache = main.pixel_cache(len(headers)*8*8*2)
+        dcm_dict = Make_Dicom_Dict(headers, cache)
+
+        gc.collect()
+        start = time.perf_counter()
+        legacy = globals()[legacy_methods[scanner]](analysis, dcm_dict)
+        legacy_time = time.perf_counter() - start
+        gc.collect()
+        start = time.perf_counter()
+        new = analysis.Sort_Dicom_Dict_By_Rules(dcm_dict, analysis.sort_rules[scanner])
+        new_time = time.perf_counter() - start
+
+        difference = Compare(legacy, new)
+        print("{:<24}{:>7} images  legacy {:7.3f} s  rules {:7.3f} s  x{:5.2f}  {}".format(
+            scanner, len(headers), legacy_time, new_time, legacy_time/new_time,
+            "same" if difference is None else "DIFFERENT: " + difference))
+
+
+if __name__ == "__main__":
+    arguments = [int(arg) for arg in sys.argv[1:]]
+    Run(*arguments[:2])
+    Run_Clustering(*arguments[2:3])
@@ -0,0 +1,5 @@
+import os
+import sys
+
+#RF_Coil_QC_0_1.py is a script in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
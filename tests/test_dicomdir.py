@@ -0,0 +1,84 @@
+"""DICOMDIR driven ingest (initialise_analysis.Get_Files_From_DICOMDIR)"""
+import os
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.fileset import FileSet
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+from RF_Coil_QC_0_1 import main
+
+
+def Make_Dicom(series_description, series_uid, series_number, instance_number):
+    dcm = Dataset()
+    dcm.file_meta = FileMetaDataset()
+    dcm.file_meta.MediaStorageSOPClassUID = MRImageStorage
+    dcm.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcm.is_little_endian = True
+    dcm.is_implicit_VR = False
+    dcm.SOPClassUID = MRImageStorage
+    dcm.SOPInstanceUID = dcm.file_meta.MediaStorageSOPInstanceUID
+    dcm.PatientID = "QC"
+    dcm.PatientName = "QC"
+    dcm.StudyInstanceUID = "1.2.3.4"
+    dcm.StudyDate = "20240101"
+    dcm.StudyTime = "120000"
+    dcm.StudyID = "1"
+    dcm.AccessionNumber = ""
+    dcm.Modality = "MR"
+    dcm.SeriesInstanceUID = series_uid
+    dcm.SeriesNumber = series_number
+    dcm.SeriesDescription = series_description
+    dcm.DeviceSerialNumber = "0000"
+    dcm.InstanceNumber = instance_number
+    dcm.Rows = 4
+    dcm.Columns = 4
+    dcm.BitsAllocated = 16
+    dcm.BitsStored = 16
+    dcm.HighBit = 15
+    dcm.PixelRepresentation = 0
+    dcm.SamplesPerPixel = 1
+    dcm.PhotometricInterpretation = "MONOCHROME2"
+    dcm.PixelData = np.zeros((4, 4), dtype=np.uint16).tobytes()
+    return dcm
+
+
+def Write_File_Set(directory, series):
+    """series: [(<SeriesDescription>, <number of images>)].  Returns the DICOMDIR path"""
+    file_set = FileSet()
+    for series_number, (series_description, n_images) in enumerate(series, 1):
+        series_uid = generate_uid()
+        for instance_number in range(1, n_images + 1):
+            file_set.add(Make_Dicom(series_description, series_uid, series_number, instance_number))
+    file_set.write(str(directory))
+    return os.path.join(str(directory), "DICOMDIR")
+
+
+def Analysis():
+    analysis = main.initialise_analysis.__new__(main.initialise_analysis)
+    analysis.catalog_path = None
+    return analysis
+
+
+def test_file_set_series_records_have_no_description(tmp_path):
+    dicomdir_path = Write_File_Set(tmp_path, [("SE_SNR_ND", 2)])
+    for instance in FileSet(pydicom.read_file(dicomdir_path)):
+        assert getattr(instance, "SeriesDescription", None) is None
+
+
+def test_snr_series_found_from_file_set_dicomdir(tmp_path):
+    dicomdir_path = Write_File_Set(tmp_path, [("Localiser", 3), ("SE_SNR_ND", 4), ("T2", 2)])
+    analysis = Analysis()
+    paths = analysis.Get_Files_From_DICOMDIR(dicomdir_path)
+    assert paths is not None and len(paths) == 4
+    for path in paths:
+        assert pydicom.read_file(path, stop_before_pixels=True).SeriesDescription == "SE_SNR_ND"
+    dcm_dict = analysis.Get_Dicom_Dict(paths)
+    assert sorted(dcm_dict.keys()) == sorted(paths)
+
+
+def test_no_snr_series_falls_back_to_directory_search(tmp_path):
+    dicomdir_path = Write_File_Set(tmp_path, [("Localiser", 3), ("T2", 2)])
+    assert Analysis().Get_Files_From_DICOMDIR(dicomdir_path) is None
@@ -0,0 +1,81 @@
+"""Automatic mask acceptance and the mask cache (initialise_masks)"""
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from RF_Coil_QC_0_1 import main
+
+
+def Phantom_Image(noise_sigma, centre=(128, 120), radius=60, signal=1000, seed=0):
+    """256 x 256 image of a uniform disc phantom with Gaussian noise"""
+    rng = np.random.default_rng(seed)
+    image = np.zeros((256, 256), dtype=np.float32)
+    cv2.circle(image, centre, radius, signal, -1)
+    image += np.abs(rng.normal(0, noise_sigma, image.shape))
+    return image.astype(np.uint16)
+
+
+def Sorted_Dict(image):
+    """Minimal sorted_dcm_dict holding one combined image"""
+    return {"20240101":{"070000":{1:{"Combined":{1:{"pixel_array":image}}}}}}
+
+
+def Masks(image, **kwargs):
+    return main.initialise_masks(Sorted_Dict(image), 0.1, 0.1, interactive=False, **kwargs)
+
+
+def test_auto_accepted_mask_is_stored_and_reused(monkeypatch, tmp_path):
+    monkeypatch.setattr(main.initialise_masks, "mask_cache_directory", str(tmp_path))
+    first = Masks(Phantom_Image(10), scanner_ID="0000", coil_name="Head")
+    assert first.mask_auto_accepted == True
+    assert os.listdir(str(tmp_path)) == ["0000_Head_256x256_slice_1.npz"]
+
+    def Not_Called(*args):
+        raise AssertionError("the cached mask should be reused")
+    monkeypatch.setattr(main.initialise_masks, "Get_Masks", Not_Called)
+    second = Masks(Phantom_Image(10, centre=(131, 118), seed=1), scanner_ID="0000", coil_name="Head")
+    assert np.count_nonzero(second.mask_dict[1]["phantom"]) == pytest.approx(np.count_nonzero(first.mask_dict[1]["phantom"]), rel=0.05)
+
+
+def Uncached_Masks(monkeypatch, image):
+    monkeypatch.setattr(main.initialise_masks, "mask_cache_directory", None)
+    return Masks(image)
+
+
+@pytest.fixture
+def clean_area(monkeypatch):
+    """Area of the phantom mask of the phantom without noise"""
+    return np.count_nonzero(Uncached_Masks(monkeypatch, Phantom_Image(0)).mask_dict[1]["phantom"])
+
+
+@pytest.mark.parametrize("noise_sigma", [2, 10, 30])
+def test_phantom_mask_is_accepted(monkeypatch, clean_area, noise_sigma):
+    masks = Uncached_Masks(monkeypatch, Phantom_Image(noise_sigma))
+    assert masks.mask_auto_accepted == True
+    assert np.count_nonzero(masks.mask_dict[1]["phantom"]) == pytest.approx(clean_area, rel=0.05)
+
+
+def test_noisy_phantom_on_offset_background_is_accepted(monkeypatch, clean_area):
+    image = Phantom_Image(0).astype(np.float32) + 100 + np.random.default_rng(0).normal(0, 10, (256, 256))
+    masks = Uncached_Masks(monkeypatch, np.clip(image, 0, None).astype(np.uint16))
+    assert masks.mask_auto_accepted == True
+    assert np.count_nonzero(masks.mask_dict[1]["phantom"]) == pytest.approx(clean_area, rel=0.05)
+
+
+@pytest.mark.parametrize("image", [np.abs(np.random.default_rng(0).normal(0, 100, (256, 256))).astype(np.uint16), 
+                                   np.random.default_rng(0).integers(0, 1000, (256, 256)).astype(np.uint16)], 
+                         ids=["noise", "uniform"])
+def test_no_phantom_is_skipped(monkeypatch, image):
+    with pytest.raises(Exception, match="Mask score below"):
+        Uncached_Masks(monkeypatch, image)
+
+
+def test_score_is_the_weakest_measure():
+    masks = main.initialise_masks.__new__(main.initialise_masks)
+    mask = Phantom_Image(0) > 0
+    scores = masks.Score_Mask(mask, [mask.sum()*1.1], expected_area=mask.sum())
+    assert scores["stability"] == pytest.approx(0.8)
+    assert scores["score"] == scores["stability"]
+    assert scores["size"] == scores["compactness"] == scores["holes"] == scores["border"] == 1
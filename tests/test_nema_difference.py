@@ -0,0 +1,56 @@
+"""NEMA SNR of repeats whose difference exceeds the int16 range (calculate_results.SNR_NEMA)"""
+import numpy as np
+import pytest
+
+import RF_Coil_QC_0_1
+from RF_Coil_QC_0_1 import main
+
+
+def Make_Repeats(size=128, saturated_fraction=0.01, seed=0):
+    """Phantom close to saturation with saturated/ dropped out voxels in the first/ second repeat"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    radius = (yy - size/2)**2 + (xx - size/2)**2
+    phantom_mask = radius < (size*0.3)**2
+    repeats = []
+    for repeat in range(2):
+        image = np.where(radius < (size*0.35)**2, 60000., 0.) + rng.normal(0, 300, (size, size))
+        image[rng.random((size, size)) < saturated_fraction] = 65535 if repeat == 0 else 0
+        repeats.append(np.uint16(np.clip(image, 0, 65535)))
+    return repeats[0], repeats[1], phantom_mask
+
+
+def Reference_NEMA(results, img_arr_1, img_arr_2, phantom_mask):
+    """NEMA SNR with the difference of the (truncated) repeats in float64"""
+    difference = np.trunc(img_arr_1.astype(np.float64)) - np.trunc(img_arr_2.astype(np.float64))
+    return round(results.bandwidth_scalar*(2**0.5)*np.mean(img_arr_1[phantom_mask])/np.std(difference[phantom_mask]), 2)
+
+
+@pytest.fixture(params=["numpy", pytest.param("numba", marks=pytest.mark.skipif(RF_Coil_QC_0_1.numba is None, 
+                                                                                   reason="numba not installed"))])
+def results(request):
+    results = main.calculate_results.__new__(main.calculate_results)
+    results.bandwidth_scalar = (222/130)**0.5
+    results.use_compiled_kernel = request.param == "numba"
+    return results
+
+
+def test_repeats_exceed_int16():
+    img_arr_1, img_arr_2, phantom_mask = Make_Repeats()
+    difference = np.int32(img_arr_1[phantom_mask]) - np.int32(img_arr_2[phantom_mask])
+    assert np.max(np.abs(difference)) > np.iinfo(np.int16).max
+    #the previous int16 difference wraps round
+    assert not np.array_equal(np.int16(difference), difference)
+
+
+def test_saturated_repeats_match_reference(results):
+    img_arr_1, img_arr_2, phantom_mask = Make_Repeats()
+    SNR = results.SNR_NEMA(img_arr_1, img_arr_2, phantom_mask, main.mask_plan(phantom_mask))
+    assert SNR == Reference_NEMA(results, img_arr_1, img_arr_2, phantom_mask)
+
+
+def test_calculated_images_are_truncated(results):
+    img_arr_1, img_arr_2, phantom_mask = Make_Repeats()
+    float_arr_1, float_arr_2 = np.float32(img_arr_1) + 0.4, np.float32(img_arr_2) + 0.7
+    SNR = results.SNR_NEMA(float_arr_1, float_arr_2, phantom_mask, main.mask_plan(phantom_mask))
+    assert SNR == Reference_NEMA(results, float_arr_1, float_arr_2, phantom_mask)
@@ -0,0 +1,49 @@
+"""Repeats of a series with different element images (calculate_results.Loop_Dicoms)"""
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+from RF_Coil_QC_0_1 import main
+
+
+def Image(seed):
+    rng = np.random.default_rng(seed)
+    image = np.zeros((64, 64))
+    cv2.circle(image, (32, 32), 20, 1000, -1)
+    return np.uint16(image + np.abs(rng.normal(0, 20, image.shape)))
+
+
+def Repeat(element_ns, seed):
+    """One repeat of a single slice: delrec images of element_ns and the combined image"""
+    return {"DelRec":{1:{element_n:{"path":"element_{}".format(element_n), 
+                                    "dcm":SimpleNamespace(pixel_array=Image(seed + element_n))} 
+                         for element_n in element_ns}}, 
+            "Combined":{1:{"pixel_array":Image(seed)}}}
+
+
+def Mask_Dict():
+    phantom = np.zeros((64, 64), dtype=np.uint8)
+    cv2.circle(phantom, (32, 32), 15, 1, -1)
+    air = np.zeros((64, 64), dtype=bool)
+    air[:8, :8] = True
+    return {1:{"phantom":phantom.astype(bool), "air":air}}
+
+
+def test_same_elements_are_analysed():
+    dcm_dict = {"20240101":{"070000":{"070001":Repeat([1, 2], 0), "070101":Repeat([1, 2], 10)}}}
+    results = main.calculate_results(dcm_dict, Mask_Dict(), 2)
+    assert list(results.SNR_Dict["NEMA"]["20240101"]["070000070001"]["DelRec"][1]) == [1, 2]
+
+
+def test_repeat_missing_elements_is_reported():
+    dcm_dict = {"20240101":{"070000":{"070001":Repeat([1, 2, 3], 0), "070101":Repeat([1, 3], 10)}}}
+    with pytest.raises(Exception, match="Repeat 2 of series 20240101 070000, slice 1 missing elements 2"):
+        main.calculate_results(dcm_dict, Mask_Dict(), 3)
+
+
+def test_repeat_with_extra_elements_is_reported():
+    dcm_dict = {"20240101":{"070000":{"070001":Repeat([1], 0), "070101":Repeat([1, 2], 10)}}}
+    with pytest.raises(Exception, match="Repeat 1 of series 20240101 070000, slice 1 missing elements 2"):
+        main.calculate_results(dcm_dict, Mask_Dict(), 2)
@@ -0,0 +1,75 @@
+"""Rule driven sorting (initialise_analysis.Sort_Dicom_Dict_By_Rules)"""
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset
+
+from RF_Coil_QC_0_1 import main
+
+
+def Make_Header(**tags):
+    header = Dataset()
+    header.AcquisitionDate = "20240101"
+    header.SeriesDate = "20240101"
+    for tag_name, value in tags.items():
+        setattr(header, tag_name, value)
+    return header
+
+
+def Sola_Dicom_Dict(n_repeats, n_elements):
+    """One Sola acquisition: a combined series and an individual element series of n_repeats repeats"""
+    headers = []
+    for instance_n in range(1, n_repeats+1):
+        headers.append(Make_Header(SeriesTime="070000", SeriesNumber=1, InstanceNumber=instance_n))
+    for instance_n in range(1, n_repeats*n_elements+1):
+        headers.append(Make_Header(SeriesTime="070001", SeriesNumber=2, InstanceNumber=instance_n))
+    cache = main.pixel_cache(len(headers)*8*8*2)
+    dcm_dict = {}
+    for i, header in enumerate(headers):
+        path = "image_" + str(i)
+        cache.Add(path, np.zeros((8, 8), dtype=np.uint16))
+        dcm_dict[path] = main.dicom_handle(path, header, cache)
+    return dcm_dict
+
+
+@pytest.mark.parametrize("scanner", ["Siemens_Sola_RBH", "Siemens_Sola_DCH"])
+@pytest.mark.parametrize("n_repeats", [2, 3, 4])
+def test_sola_repeats_follow_expected_repeats(monkeypatch, scanner, n_repeats):
+    n_elements = 4
+    analysis = main.initialise_analysis.__new__(main.initialise_analysis)
+    analysis.scanner_ID = "0000"
+    analysis.coil_name = "test"
+    monkeypatch.setitem(main.initialise_analysis.coil_dict["0000"], "test", {"n_slices":1, "n_elements":n_elements})
+    monkeypatch.setattr(main.initialise_analysis, "expected_repeats", n_repeats)
+    sorted_dcm_dict = analysis.Sort_Dicom_Dict_By_Rules(Sola_Dicom_Dict(n_repeats, n_elements), analysis.sort_rules[scanner])
+    [series] = [series for date in sorted_dcm_dict.values() for series in date.values()]
+    assert sorted(series.keys()) == list(range(1, n_repeats+1))
+    for repeat in series.values():
+        assert sorted(repeat["DelRec"][1].keys()) == list(range(1, n_elements+1))
+        assert "path" in repeat["Combined"][1]
+
+
+def test_unparsed_series_times_are_kept_as_their_own_series():
+    analysis = main.initialise_analysis.__new__(main.initialise_analysis)
+    rules = analysis.sort_rules["Siemens_Sola_DCH"]
+    series_times = [("20240101", "070000.10"), ("20240101", "070000.90"), ("20240101", ""), ("", "070000"), ("", "")]
+    series_keys, series_order = analysis.Cluster_Series_Times(series_times, rules)
+    assert series_order == [("20240101", "70000"), ("", ""), ("", "070000"), ("20240101", "")]
+    assert series_keys[("20240101", "070000.90")] == ("20240101", "70000")
+    assert series_keys[("20240101", "")] == ("20240101", "")
+
+
+@pytest.mark.parametrize("scanner", ["Siemens_Sola_DCH", "Elition_X_PHT"])
+def test_sort_with_anonymised_series_time(monkeypatch, scanner):
+    n_elements = 4
+    analysis = main.initialise_analysis.__new__(main.initialise_analysis)
+    analysis.scanner_ID = "0000"
+    analysis.coil_name = "test"
+    monkeypatch.setitem(main.initialise_analysis.coil_dict["0000"], "test", {"n_slices":1, "n_elements":n_elements})
+    dcm_dict = Sola_Dicom_Dict(2, n_elements)
+    for dcm in dcm_dict.values():
+        dcm.header.SeriesTime = ""
+        dcm.header.SeriesDate = ""
+        dcm.header.ProtocolName = "DelRec_SNR"
+    sorted_dcm_dict = analysis.Sort_Dicom_Dict_By_Rules(dcm_dict, analysis.sort_rules[scanner])
+    assert list(sorted_dcm_dict.keys()) == [""]
+    assert list(sorted_dcm_dict[""].keys()) == [""]
@@ -0,0 +1,77 @@
+"""Grouping of SNR images into acquisitions in the headless modes (watch_folder/ batch_run)"""
+import time
+
+import pytest
+from pydicom.dataset import Dataset
+
+from RF_Coil_QC_0_1 import main
+
+
+class Recording_Pool:
+    """Stands in for the process pool: records the groups submitted"""
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, function, images_root_dir, dcm_paths, *args):
+        self.submitted.append(dcm_paths)
+        return len(self.submitted)
+
+
+def Make_Header(study_uid, instance_uid):
+    header = Dataset()
+    header.DeviceSerialNumber = "0000"
+    header.ReceiveCoilName = "test"
+    header.SeriesDate = "20240101"
+    header.StudyInstanceUID = study_uid
+    header.SOPInstanceUID = instance_uid
+    return header
+
+
+@pytest.fixture
+def watch(monkeypatch, tmp_path):
+    #2 elements, no stored combined image, 2 repeats: 4 images per acquisition
+    monkeypatch.setitem(main.initialise_analysis.coil_dict["0000"], "test", {"n_slices":1, "n_elements":2})
+    return main.watch_folder(str(tmp_path))
+
+
+def Add(watch, study_uid, instance_uids, path_prefix):
+    before_debounce = time.time() - watch.debounce - 1
+    for instance_uid in instance_uids:
+        watch.Add_To_Group(path_prefix + instance_uid, Make_Header(study_uid, instance_uid), before_debounce)
+
+
+def test_copies_of_an_export_are_analysed_once(watch):
+    instance_uids = ["1.1", "1.2", "1.3", "1.4"]
+    Add(watch, "1", instance_uids, "export/")
+    Add(watch, "1", instance_uids, "export.zip::")
+    Add(watch, "1", instance_uids, "export.tar.gz::")
+    pool = Recording_Pool()
+    watch.Submit_Complete_Groups(pool)
+    assert pool.submitted == [sorted(["export/" + instance_uid for instance_uid in instance_uids])]
+    assert watch.groups == {}
+
+
+def test_sessions_on_the_same_day_are_analysed_separately(watch):
+    Add(watch, "1", ["1.1", "1.2", "1.3", "1.4"], "morning/")
+    Add(watch, "2", ["2.1", "2.2", "2.3", "2.4"], "afternoon/")
+    pool = Recording_Pool()
+    watch.Submit_Complete_Groups(pool)
+    assert sorted(pool.submitted) == [["afternoon/2." + str(i) for i in range(1, 5)], 
+                                      ["morning/1." + str(i) for i in range(1, 5)]]
+
+
+def test_groups_with_too_many_images_are_reported_not_analysed(watch, capsys):
+    Add(watch, "1", ["1.1", "1.2", "1.3", "1.4", "1.5", "1.6"], "repeated/")
+    pool = Recording_Pool()
+    watch.Submit_Complete_Groups(pool)
+    assert pool.submitted == []
+    assert watch.groups == {}
+    assert "Not analysed: 0000 test 20240101 (study 1) has 6 images, 4 expected" in capsys.readouterr().out
+
+
+def test_incomplete_groups_wait(watch):
+    Add(watch, "1", ["1.1", "1.2", "1.3"], "partial/")
+    pool = Recording_Pool()
+    watch.Submit_Complete_Groups(pool)
+    assert pool.submitted == []
+    assert len(watch.groups) == 1